@@ -0,0 +1,276 @@
+'''
+CAPP 30122 W'20: Final Poject
+
+This module caches the rendered visualizations (maps and barplots).
+
+Each visualization is stored under a name made from the hash of its kind,
+the query parameters it depends on and the version of the data, so the
+same query renders only once until the database or the precincts change,
+and concurrent requests never overwrite each other's results.
+Visualizations are rendered in memory and served from memory. A copy is
+kept in the viz/cache folder so that every worker process (and the next
+run of the server) can serve them too. Both stores are bounded in size
+(least recently used ones are evicted first).
+'''
+
+import os
+import json
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+import crime_cube
+import precincts
+
+
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         'viz', 'cache')
+MAX_DISK_BYTES = 500 * 1024 * 1024
+MAX_MEMORY_BYTES = 64 * 1024 * 1024
+
+_MEMORY = OrderedDict()
+_MEMORY_BYTES = 0
+# bytes in CACHE_DIR at the last scan plus the ones written since, None
+# before the first scan
+_DISK_BYTES = None
+_STATS = {'memory_hits': 0, 'disk_hits': 0, 'misses': 0,
+          'memory_evictions': 0, 'disk_evictions': 0}
+_LOCK = threading.Lock()
+
+logger = logging.getLogger(__name__)
+
+
+def data_version():
+    '''
+    Signature of the data the visualizations are made from.
+    '''
+
+    version = []
+    for filename in (crime_cube.DATABASE_FILENAME, precincts.GEOJSON_FILENAME):
+        try:
+            version.append(precincts.file_signature(filename))
+        except OSError:
+            version.append(None)
+
+    return version
+
+
+def make_name(kind, params, ext):
+    '''
+    Name of the cached file of a visualization.
+    Inputs:
+        kind (str): kind of visualization (e.g. 'map_all')
+        params (dictionary): query parameters the visualization depends on.
+            They must be json serializable and already normalized (e.g.
+            sorted lists of crime types)
+        ext (str): file extension
+    Output:
+        str
+    '''
+
+    key = json.dumps([kind, params, data_version()], sort_keys=True)
+    digest = hashlib.sha256(key.encode('utf-8')).hexdigest()[:32]
+
+    return '{}-{}.{}'.format(kind, digest, ext)
+
+
+def lookup(kind, params, ext):
+    '''
+    Name of a visualization, and whether it is in the cache. The missing
+    visualizations are rendered together (see render_pool), and then stored
+    with put.
+    Inputs:
+        kind, params, ext: see make_name
+    Output:
+        (name, True if it is cached)
+    '''
+
+    name = make_name(kind, params, ext)
+
+    if memory_get(name) is not None:
+        count('memory_hits')
+        return name, True
+
+    content = disk_get(name)
+    if content is not None:
+        count('disk_hits')
+        memory_put(name, content)
+        return name, True
+
+    count('misses')
+
+    return name, False
+
+
+def put(name, content):
+    '''
+    Stores a rendered visualization in the cache.
+    '''
+
+    memory_put(name, content)
+    disk_put(name, content)
+
+
+def get(name):
+    '''
+    Content of a cached visualization, None if it is not in the cache.
+    '''
+
+    content = memory_get(name)
+    if content is None:
+        content = disk_get(name)
+        if content is not None:
+            memory_put(name, content)
+
+    return content
+
+
+def memory_get(name):
+    '''
+    Content of a cached file if it is in memory, None otherwise.
+    '''
+
+    with _LOCK:
+        content = _MEMORY.get(name)
+        if content is not None:
+            _MEMORY.move_to_end(name)
+
+    return content
+
+
+def memory_put(name, content):
+    '''
+    Keeps the content of a cached file in memory, evicting the least
+    recently used ones above MAX_MEMORY_BYTES.
+    '''
+
+    global _MEMORY_BYTES
+
+    if len(content) > MAX_MEMORY_BYTES:
+        return
+
+    with _LOCK:
+        if name in _MEMORY:
+            _MEMORY_BYTES -= len(_MEMORY.pop(name))
+        _MEMORY[name] = content
+        _MEMORY_BYTES += len(content)
+
+        while _MEMORY_BYTES > MAX_MEMORY_BYTES:
+            _, old = _MEMORY.popitem(last=False)
+            _MEMORY_BYTES -= len(old)
+            _STATS['memory_evictions'] += 1
+
+
+def disk_get(name):
+    '''
+    Content of a cached file if it is on disk, None otherwise.
+    '''
+
+    path = os.path.join(CACHE_DIR, name)
+    try:
+        with open(path, 'rb') as f:
+            content = f.read()
+        os.utime(path)
+    except OSError:
+        return None
+
+    return content
+
+
+def disk_put(name, content):
+    '''
+    Writes a cached file to disk, evicting the least recently used ones
+    above MAX_DISK_BYTES. The file is written to a temporary path and moved
+    to its place, so that it is never read half written. If it can't be
+    written (e.g. a full or read-only disk), the error is logged and the
+    file is only kept in memory.
+    '''
+
+    global _DISK_BYTES
+
+    tmp_path = os.path.join(CACHE_DIR, 'tmp-{}-{}-{}'.format(
+        os.getpid(), threading.get_ident(), name))
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        with open(tmp_path, 'wb') as f:
+            f.write(content)
+        os.replace(tmp_path, os.path.join(CACHE_DIR, name))
+    except OSError as error:
+        logger.warning('Could not write %s to the disk cache: %s', name, error)
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        return
+
+    with _LOCK:
+        if _DISK_BYTES is not None:
+            _DISK_BYTES += len(content)
+        full = _DISK_BYTES is None or _DISK_BYTES > MAX_DISK_BYTES
+
+    if full:
+        evict_disk()
+
+
+def evict_disk():
+    '''
+    Removes the least recently used files of CACHE_DIR while it holds more
+    than MAX_DISK_BYTES. The directory is only scanned when the running
+    total of disk_put crosses the limit (the files written by other
+    processes are counted at the next scan).
+    '''
+
+    global _DISK_BYTES
+
+    files = []
+    total = 0
+    for entry in os.scandir(CACHE_DIR):
+        if entry.name.startswith('tmp-'):
+            continue
+        try:
+            stat = entry.stat()
+        except OSError:
+            continue
+        files.append((stat.st_mtime, stat.st_size, entry.path))
+        total += stat.st_size
+
+    files.sort()
+    for _, size, path in files:
+        if total <= MAX_DISK_BYTES:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
+        count('disk_evictions')
+
+    with _LOCK:
+        _DISK_BYTES = total
+
+
+def count(stat):
+    '''
+    Increments a counter of the cache metrics.
+    '''
+
+    with _LOCK:
+        _STATS[stat] += 1
+
+
+def stats():
+    '''
+    Metrics of the cache: hits, misses and evictions since the process
+    started, and current size of the memory cache.
+    '''
+
+    with _LOCK:
+        result = dict(_STATS)
+        result['memory_entries'] = len(_MEMORY)
+        result['memory_bytes'] = _MEMORY_BYTES
+
+    result['hits'] = result['memory_hits'] + result['disk_hits']
+    requests = result['hits'] + result['misses']
+    result['hit_ratio'] = result['hits'] / requests if requests else 0.0
+
+    return result
@@ -0,0 +1,27 @@
+'''
+CAPP 30122 W'20: Final Poject
+
+Benchmarks of the hot paths of the web app. Each benchmark compares the
+current implementation with the previous one on the same inputs. They are
+grouped by subsystem:
+    cube: cleaning of the crime export, database schema and connections,
+        count cube, queries by distance and columnar snapshot
+    geocoding: precinct lookup, nearest police stations and batch scoring
+    rendering: barplots and maps
+    startup: start up of a server process
+and run by runner.
+
+Run all of them with: python3 -m benchmarks
+or only some of them with: python3 -m benchmarks precinct
+
+The suite times the functions of the app one by one on synthetic databases
+of the given numbers of crimes (see synthetic.py, it runs offline) and
+writes the timings and peak memory of each one to json, to compare them
+between commits:
+    python3 -m benchmarks suite --rows 100000 1000000 --output new.json
+    python3 -m benchmarks compare old.json new.json [ratio]
+The databases and their columnar snapshots (see crime_columns) are kept in
+--data-dir, so they are only generated once.
+compare exits with status 1 if a function got slower than ratio (by
+default REGRESSION_RATIO) times its old timing.
+'''
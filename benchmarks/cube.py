@@ -0,0 +1,416 @@
+'''
+File name: cube.py
+
+Benchmarks of the crime data: the cleaning of the crime export, the schema
+of the database and its connections, the count cube, the queries by
+distance and the columnar snapshot.
+
+Calls ---> data_cleaning, crime_db, crime_cube, crime_columns and queries
+      ---> synthetic for the synthetic crimes
+'''
+
+import time
+import numpy as np
+from .runner import best_time, report
+
+
+def legacy_clean_crimes_data(crimes):
+    '''
+    Row by row categorization of data_cleaning before it was vectorized,
+    kept as the reference of bench_clean_crimes.
+    '''
+
+    import data_cleaning as dc
+    from datetime import datetime
+    import pandas as pd
+
+    crimes['tipo'] = 'NaN'
+    for i in range(len(crimes)):
+        if crimes['delito'][i] in dc.crimes_w:
+            crimes.at[i, 'tipo'] = 'walking'
+        elif crimes['delito'][i] in dc.crimes_pt:
+            crimes.at[i, 'tipo'] = 'public transit'
+        elif crimes['delito'][i] in dc.crimes_v:
+            crimes.at[i, 'tipo'] = 'personal vehicle'
+        elif crimes['delito'][i] in dc.homicides:
+            crimes.at[i, 'tipo'] = 'homicide'
+        elif crimes['delito'][i] in dc.rape:
+            crimes.at[i, 'tipo'] = 'rape'
+
+    crimes.drop(crimes[crimes.tipo == 'NaN'].index, inplace=True)
+    crimes.dropna(subset=["geometry"], inplace=True)
+
+    aux = crimes['fecha_hechos'].str.split(" ", n=1, expand=True)
+    crimes['date'] = aux[0]
+    crimes['time'] = aux[1]
+    crimes['hour'] = crimes['time'].str.split(":", n=1, expand=True)[0]
+    crimes['hour'] = pd.to_numeric(crimes["hour"])
+    crimes['date'] = pd.to_datetime(crimes['date'])
+    crimes['weekday'] = pd.to_datetime(crimes['date']).apply(
+        lambda x: datetime.strftime(x, '%A'))
+    crimes.drop(columns=['fecha_hechos', 'categoria_delito'], inplace=True)
+    crimes['date'] = crimes['date'].astype('str')
+
+
+def bench_clean_crimes(n_rows=1000000, n_legacy_rows=20000):
+    '''
+    Categorization of the crime export: row by row loop (on a sample, it
+    takes minutes on the full size) vs the vectorized data_cleaning.
+    '''
+
+    import data_cleaning as dc
+    from synthetic import raw_crimes
+
+    legacy = raw_crimes(n_legacy_rows)
+    legacy_time = best_time(lambda: legacy_clean_crimes_data(legacy.copy()),
+                            repeat=3)
+
+    crimes = raw_crimes(n_rows)
+    report('clean_crimes_data ({} rows)'.format(n_rows), [
+        ('row by row (extrapolated)', legacy_time * n_rows / n_legacy_rows),
+        ('vectorized', best_time(lambda: dc.clean_crimes_data(crimes.copy()),
+                                 repeat=3)),
+    ])
+
+
+def bench_schema(n_rows=500000, n_queries=200):
+    '''
+    Query of the crimes of a precinct, day, hour range and types of crime
+    (the points of map_cuad): pandas to_sql table vs the crime_db schema.
+    Also reports the size of the database file.
+    '''
+
+    import os
+    import random
+    import sqlite3
+    import tempfile
+    import pandas as pd
+    import crime_db
+    import queries
+    import data_cleaning as dc
+    from synthetic import raw_crimes
+
+    crimes = raw_crimes(n_rows)
+    dc.clean_crimes_data(crimes)
+    rng = np.random.RandomState(0)
+    crimes['id'] = rng.randint(0, 1000, len(crimes))
+    crimes['latitud'] = crimes.geometry.y
+    crimes['longitud'] = crimes.geometry.x
+    # as written by get_data.spacial_join
+    geometry = crimes['geometry'].astype('str')
+    crimes = pd.DataFrame(crimes.drop(columns='geometry'))
+    crimes['geometry'] = geometry
+    crimes['zona'] = 'ZONA NORTE'
+    crimes['sector'] = 'SECTOR CUAUHTEMOC'
+
+    random.seed(0)
+    dics = []
+    for _ in range(n_queries):
+        first = random.randint(0, 23)
+        dics.append({'day': random.choice(list(set(crimes['weekday']))),
+                     'hour': [first, random.randint(first, 23)],
+                     'address': (0, 0, random.randint(0, 999)),
+                     'crime_type': random.sample([1, 2, 3], 2)})
+
+    def legacy_query(conn, dic):
+        tipos = queries.get_crime_tipos(dic['crime_type'])
+        query = ("SELECT latitud, longitud, delito FROM crime WHERE "
+                 "weekday = ? AND hour >= ? AND hour <= ? AND id = ? AND "
+                 "tipo in ({})".format(', '.join(['?'] * len(tipos))))
+        args = (dic['day'], dic['hour'][0], dic['hour'][1],
+                dic['address'][2]) + tipos
+        return conn.execute(query, args).fetchall()
+
+    def compact_query(conn, dic):
+        args, query = queries.get_query(dic, None)
+        return conn.execute(query, args).fetchall()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        filename = os.path.join(tmp, 'crimes.sqlite3')
+        conn = sqlite3.connect(filename)
+        crimes.to_sql('crime', conn, index=False)
+        conn.close()
+        legacy_size = os.path.getsize(filename)
+
+        conn = sqlite3.connect(filename)
+        legacy_time = best_time(lambda: [legacy_query(conn, dic)
+                                         for dic in dics], repeat=3)
+        conn.close()
+
+        crime_db.migrate(filename)
+        conn = sqlite3.connect(filename)
+        compact_time = best_time(lambda: [compact_query(conn, dic)
+                                          for dic in dics], repeat=3)
+        conn.close()
+
+        report('query of the crimes of a precinct ({} rows, {} queries)'
+               .format(n_rows, n_queries), [
+                   ('to_sql table', legacy_time),
+                   ('crime_db schema', compact_time)])
+        print('    database size {:.1f} MB -> {:.1f} MB'.format(
+            legacy_size / 2**20, os.path.getsize(filename) / 2**20))
+
+
+def bench_connection(n_queries=1000):
+    '''
+    Query of the crimes of a precinct (the points of map_cuad) on
+    data/CrimesDB.sqlite3: a new connection per query vs the read-only
+    connection of the thread kept by crime_db.
+    '''
+
+    import random
+    import sqlite3
+    import crime_cube
+    import crime_db
+    import queries
+
+    random.seed(0)
+    dics = []
+    for _ in range(n_queries):
+        first = random.randint(0, 23)
+        dics.append({'day': random.choice(crime_cube.WEEK_DAYS),
+                     'hour': [first, random.randint(first, 23)],
+                     'address': (0, 0, random.randint(0, 999)),
+                     'crime_type': random.sample([1, 2, 3], 2)})
+
+    def new_connection(dic):
+        connection = sqlite3.connect(queries.DATABASE_FILENAME)
+        args, query = queries.get_query(dic, None)
+        data = connection.execute(query, args).fetchall()
+        connection.close()
+        return data
+
+    def kept_connection(dic):
+        connection = crime_db.get_connection(queries.DATABASE_FILENAME)
+        args, query = queries.get_query(dic, None)
+        return connection.execute(query, args).fetchall()
+
+    report('connections ({} queries)'.format(n_queries), [
+        ('connection per query', best_time(lambda: [new_connection(dic)
+                                                    for dic in dics])),
+        ('connection of the thread', best_time(lambda: [kept_connection(dic)
+                                                        for dic in dics])),
+    ])
+
+
+def bench_summary(n_queries=1000):
+    '''
+    Counts of the choropleth and the barplots of a query from the crime
+    cube: one call per aggregation vs CrimeCube.summary.
+    '''
+
+    import random
+    import crime_cube
+    import precincts
+    import queries
+
+    cube = crime_cube.get_cube()
+    ids = precincts.get_cuadrantes()['id']
+
+    random.seed(0)
+    args = []
+    for _ in range(n_queries):
+        first = random.randint(0, 23)
+        args.append((random.randint(0, cube.n_precincts - 1),
+                     random.choice(crime_cube.WEEK_DAYS),
+                     [first, random.randint(first, 23)],
+                     queries.get_crime_tipos(random.sample([1, 2, 3], 2))))
+
+    def separate(precinct, day, hour, tipos):
+        return (cube.total(precinct, day, hour, tipos),
+                cube.by_precinct(day, hour, tipos, ids),
+                cube.by_weekday(precinct, tipos),
+                cube.by_hour(precinct, day, tipos))
+
+    report('counts of a query ({} queries)'.format(n_queries), [
+        ('one call per aggregation', best_time(
+            lambda: [separate(*arg) for arg in args])),
+        ('summary', best_time(
+            lambda: [cube.summary(*arg, ids=ids) for arg in args])),
+    ])
+
+
+def bench_radius(n_rows=1000000, n_queries=200, meters=500):
+    '''
+    Number of crimes within a distance of a point, with the filters of a
+    query: scan of the crime table with a bounding box vs the R*Tree of
+    crime_db (queries.count_within), on a synthetic database.
+    '''
+
+    import os
+    import random
+    import sqlite3
+    import tempfile
+    import crime_db
+    import queries
+    import data_cleaning as dc
+    from synthetic import raw_crimes
+
+    crimes = raw_crimes(n_rows)
+    dc.clean_crimes_data(crimes)
+    crimes['id'] = np.random.RandomState(0).randint(0, 1000, len(crimes))
+    crimes['latitud'] = crimes.geometry.y
+    crimes['longitud'] = crimes.geometry.x
+    crimes = crimes.drop(columns='geometry')
+
+    random.seed(0)
+    dics = []
+    for _ in range(n_queries):
+        first = random.randint(0, 23)
+        dics.append({'day': random.choice(list(set(crimes['weekday']))),
+                     'hour': [first, random.randint(first, 23)],
+                     'address': (random.uniform(19.2, 19.55),
+                                 random.uniform(-99.25, -99.0), None),
+                     'crime_type': random.sample([1, 2, 3], 2)})
+
+    def scan(conn, dic):
+        args, query = queries.get_radius_query(dic, meters, 'total')
+        # the same filters on the crime table, without the R*Tree
+        query = (query.replace('crime_rtree r CROSS JOIN crime c ON c.n = r.n',
+                               'crime')
+                 .replace('max_lat >= ? AND min_lat <= ?',
+                          'latitud BETWEEN ? AND ?')
+                 .replace('max_lon >= ? AND min_lon <= ?',
+                          'longitud BETWEEN ? AND ?'))
+        return conn.execute(query, args).fetchone()[0]
+
+    def rtree(conn, dic):
+        args, query = queries.get_radius_query(dic, meters, 'total')
+        return conn.execute(query, args).fetchone()[0]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        filename = os.path.join(tmp, 'crimes.sqlite3')
+        conn = sqlite3.connect(filename)
+        crimes.to_sql('crime', conn, index=False)
+        conn.close()
+        crime_db.migrate(filename)
+
+        conn = crime_db.connect_read_only(filename)
+        assert [scan(conn, dic) for dic in dics[:20]] == \
+            [rtree(conn, dic) for dic in dics[:20]]
+        report('crimes within {} m ({} rows, {} queries)'
+               .format(meters, n_rows, n_queries), [
+                   ('crime table scan', best_time(
+                       lambda: [scan(conn, dic) for dic in dics], repeat=3)),
+                   ('r*tree', best_time(
+                       lambda: [rtree(conn, dic) for dic in dics], repeat=3))])
+        conn.close()
+
+
+def bench_columns(n_rows=1000000, n_queries=100):
+    '''
+    queries.filter_data from the crime table of the database vs its memory
+    mapped columnar snapshot (crime_columns), on a synthetic database: the
+    crimes of a precinct, their number per hour, and the number of crimes
+    of every precinct (a scan of all the crimes).
+    '''
+
+    import os
+    import random
+    import tempfile
+    import crime_cube
+    import crime_columns
+    import crime_db
+    import queries
+    import synthetic
+    import pandas as pd
+
+    with tempfile.TemporaryDirectory() as tmp:
+        filename = os.path.join(tmp, 'crimes.sqlite3')
+        synthetic.build_database(filename, n_rows)
+        start = time.time()
+        crime_columns.write_snapshot(filename)
+        print('snapshot of {} crimes written in {:.1f} s'.format(
+            n_rows, time.time() - start))
+
+        columns = crime_columns.load_snapshot(filename)
+        ids = np.unique(columns.columns['id'])
+        random.seed(0)
+        dics = []
+        for _ in range(n_queries):
+            first = random.randint(0, 22)
+            dics.append({'address': (0, 0, int(random.choice(ids))),
+                         'day': random.choice(crime_cube.WEEK_DAYS),
+                         'hour': [first, random.randint(first + 1, 23)],
+                         'crime_type': random.sample([1, 2, 3], 2)})
+
+        def database(dic, group_var):
+            args, query = queries.get_query(dic, group_var)
+            conn = crime_db.get_connection(filename)
+            # the dataframe of queries.filter_data
+            return pd.DataFrame(conn.execute(query, args).fetchall())
+
+        def snapshot(dic, group_var):
+            return columns.filter_data(
+                dic, group_var, queries.get_crime_tipos(dic['crime_type']))
+
+        report('load ({} rows)'.format(n_rows), [
+            ('map snapshot', best_time(
+                lambda: crime_columns.load_snapshot(filename)))])
+        for group_var, dics_group in ((None, dics), ('hour', dics),
+                                      ('id', dics[:10])):
+            assert [len(database(dic, group_var)) for dic in dics_group] == \
+                [len(snapshot(dic, group_var)) for dic in dics_group]
+            report('filter_data group by {} ({} rows, {} queries)'.format(
+                group_var, n_rows, len(dics_group)), [
+                    ('sqlite3', best_time(
+                        lambda: [database(dic, group_var)
+                                 for dic in dics_group])),
+                    ('columns', best_time(
+                        lambda: [snapshot(dic, group_var)
+                                 for dic in dics_group]))])
+
+
+BENCHMARKS = {
+    'clean_crimes': bench_clean_crimes,
+    'schema': bench_schema,
+    'connection': bench_connection,
+    'summary': bench_summary,
+    'radius': bench_radius,
+    'columns': bench_columns,
+}
+
+
+def suite_cases(n_rows, inputs):
+    '''
+    Functions of the crime data measured by the suite.
+    Inputs:
+        n_rows (int): number of crimes of the database
+        inputs (dictionary): see runner.suite_inputs
+    Output:
+        dictionary name -> (func, calls, repeat) as in runner.measure
+    '''
+
+    import crime_cube
+    import crime_columns
+    import data_cleaning as dc
+    import queries
+    import synthetic
+
+    cube, ids, dics = inputs['cube'], inputs['ids'], inputs['dics']
+    raw = synthetic.raw_crimes(min(n_rows, 1000000))
+
+    return {
+        'queries.filter_data': (
+            lambda: [queries.filter_data(dic, None) for dic in dics],
+            len(dics), 5),
+        'queries.filter_data_by_hour': (
+            lambda: [queries.filter_data(dic, 'hour') for dic in dics],
+            len(dics), 5),
+        'queries.filter_data_by_precinct': (
+            lambda: [queries.filter_data(dic, 'id') for dic in dics[:10]],
+            10, 3),
+        'crime_columns.load_snapshot': (
+            lambda: crime_columns.load_snapshot(queries.DATABASE_FILENAME),
+            1, 5),
+        'queries.count_within_500m': (
+            lambda: [queries.count_within(dic, 500) for dic in dics],
+            len(dics), 5),
+        'crime_cube.build_cube': (crime_cube.build_cube, 1, 3),
+        'crime_cube.summary': (
+            lambda: [cube.summary(dic['address'][2], dic['day'], dic['hour'],
+                                  queries.get_crime_tipos(dic['crime_type']),
+                                  ids) for dic in dics], len(dics), 5),
+        'data_cleaning.clean_crimes_data': (
+            lambda: dc.clean_crimes_data(raw.copy()), 1, 3),
+    }
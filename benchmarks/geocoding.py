@@ -0,0 +1,157 @@
+'''
+File name: geocoding.py
+
+Benchmarks of the locations of the app: the precinct of a point, the
+nearest police stations and the scoring of many points at once.
+
+Calls ---> geocoding_helper for the precinct locator
+      ---> shortest_distance for the police stations
+      ---> scoring for the batch scoring
+'''
+
+import numpy as np
+from .runner import best_time, report
+
+
+def bench_precinct(n_points=1000):
+    '''
+    Precinct lookup: linear scan over the precincts vs the R-tree locator,
+    on random points in the bounding box of Mexico City.
+    '''
+
+    import precincts
+    from getmaps import geocoding_helper as gh
+
+    cuadrantes = precincts.get_cuadrantes()
+    rng = np.random.RandomState(0)
+    min_lon, min_lat, max_lon, max_lat = cuadrantes.total_bounds
+    lats = rng.uniform(min_lat, max_lat, n_points)
+    lons = rng.uniform(min_lon, max_lon, n_points)
+    locator = gh.get_locator()
+
+    scan = [gh.scan_precinct(cuadrantes, lat, lon)
+            for lat, lon in zip(lats, lons)]
+    found = locator.locate_many(lats, lons)
+    assert [-1 if p is None else p for p in scan] == list(found)
+
+    report('precinct lookup ({} points)'.format(n_points), [
+        ('linear scan', best_time(lambda: [gh.scan_precinct(cuadrantes,
+                                                            lat, lon)
+                                           for lat, lon in zip(lats, lons)],
+                                  repeat=3)),
+        ('locator, one point at a time',
+         best_time(lambda: [locator.locate(lat, lon)
+                            for lat, lon in zip(lats, lons)], repeat=3)),
+        ('locator, locate_many',
+         best_time(lambda: locator.locate_many(lats, lons), repeat=3)),
+    ])
+
+
+def bench_police_station(n_points=1000):
+    '''
+    Nearest police station: haversine over every station in python (the
+    previous sqlite UDF scan) vs the KD-tree, one point at a time and as
+    a batch.
+    '''
+
+    import shortest_distance as sd
+
+    stations = sd.get_stations()
+    rng = np.random.RandomState(0)
+    lats = rng.uniform(19.15, 19.6, n_points)
+    lons = rng.uniform(-99.35, -98.95, n_points)
+
+    def scan(lat, lon):
+        return min(zip(stations.latitudes, stations.longitudes),
+                   key=lambda st: sd.distance(lat, lon, st[0], st[1]))
+
+    report('nearest police station ({} points)'.format(n_points), [
+        ('haversine scan', best_time(lambda: [scan(lat, lon) for lat, lon
+                                              in zip(lats, lons)], repeat=3)),
+        ('kd-tree, one point at a time',
+         best_time(lambda: [sd.get_police_station(lat, lon) for lat, lon
+                            in zip(lats, lons)], repeat=3)),
+        ('kd-tree, batch', best_time(lambda: stations.nearest(lats, lons),
+                                     repeat=3)),
+    ])
+
+
+def bench_score(n_points=10000):
+    '''
+    Batch scoring of locations: one point at a time (precinct locator,
+    CrimeCube.total and nearest police station) vs scoring.score_points.
+    '''
+
+    import random
+    import crime_cube
+    import queries
+    import shortest_distance as sd
+    from getmaps import geocoding_helper as gh
+    from getmaps import scoring
+
+    random.seed(0)
+    points = []
+    for _ in range(n_points):
+        first = random.randint(0, 22)
+        points.append({'lat': random.uniform(19.15, 19.6),
+                       'lon': random.uniform(-99.35, -98.95),
+                       'day': random.choice(crime_cube.WEEK_DAYS),
+                       'hour': [first, random.randint(first + 1, 23)],
+                       'crime_type': random.sample([1, 2, 3], 2)})
+
+    cube = crime_cube.get_cube()
+    locator = gh.get_locator()
+
+    def one_at_a_time(point):
+        precinct = locator.locate(point['lat'], point['lon'])
+        crimes = None
+        if precinct is not None:
+            crimes = cube.total(precinct, point['day'], point['hour'],
+                                queries.get_crime_tipos(point['crime_type']))
+        return (precinct, crimes,
+                sd.get_police_station(point['lat'], point['lon'])[2])
+
+    report('scoring ({} points)'.format(n_points), [
+        ('one point at a time', best_time(
+            lambda: [one_at_a_time(point) for point in points], repeat=3)),
+        ('score_points', best_time(lambda: scoring.score_points(points),
+                                   repeat=3)),
+    ])
+
+
+BENCHMARKS = {
+    'precinct': bench_precinct,
+    'police_station': bench_police_station,
+    'score': bench_score,
+}
+
+
+def suite_cases(n_rows, inputs):
+    '''
+    Functions of the locations measured by the suite.
+    Inputs:
+        n_rows (int): number of crimes of the database
+        inputs (dictionary): see runner.suite_inputs
+    Output:
+        dictionary name -> (func, calls, repeat) as in runner.measure
+    '''
+
+    import shortest_distance as sd
+    from getmaps import geocoding_helper as gh
+    from getmaps import scoring
+
+    cuadrantes, points = inputs['cuadrantes'], inputs['points']
+    lats, lons = inputs['lats'], inputs['lons']
+
+    return {
+        'geocoding_helper.get_precinct': (
+            lambda: [gh.get_precinct(cuadrantes, lat, lon)
+                     for lat, lon in zip(lats[:1000], lons[:1000])], 1000, 5),
+        'PrecinctLocator.locate_many_10k': (
+            lambda: gh.get_locator().locate_many(lats, lons), 1, 5),
+        'shortest_distance.get_police_station': (
+            lambda: [sd.get_police_station(lat, lon)
+                     for lat, lon in zip(lats[:1000], lons[:1000])], 1000, 5),
+        'scoring.score_points_10k': (
+            lambda: scoring.score_points(points), 1, 5),
+    }
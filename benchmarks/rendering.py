@@ -0,0 +1,171 @@
+'''
+File name: rendering.py
+
+Benchmarks of the visualizations: the barplots and the maps of viz.
+
+Calls ---> viz for the visualizations
+      ---> queries and crime_cube for the data they show
+'''
+
+import numpy as np
+from .runner import best_time, report
+
+
+def legacy_barplot(crimes, group_var, name_plot, dic):
+    '''
+    Barplot of crimes by day or hour as viz drew it before the barplot
+    templates: a new seaborn figure on every call.
+    '''
+
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+
+    sns.set(style="ticks")
+
+    if group_var == 'weekday':
+        d = {'Sunday': 0, 'Monday':1, 'Tuesday':2, 'Wednesday':3, 'Thursday':4,
+             'Friday':5, 'Saturday':6}
+        clrs = ['steelblue']*7
+        clrs[d[dic['day']]] = 'red'
+        order = ['Sunday', 'Monday', 'Tuesday', 'Wednesday', 'Thursday',
+                 'Friday', 'Saturday']
+    else:
+        clrs = ['red' if (x >= dic['hour'][0] and x <= dic['hour'][1]) else
+                'steelblue' for x in crimes.hour]
+        order = None
+
+    sns.set(font_scale=1.4)
+    fig, ax = plt.subplots(figsize=(10, 10))
+    sns.barplot(x=group_var, y='crimes', data=crimes, order=order,
+                palette=clrs)
+
+    if group_var == 'weekday':
+        title = 'Crime by day of the week (all hours)'
+    else:
+        title = 'Crime by time of the day' + ' ({})'.format(dic['day'])
+    plt.title(title, fontsize=20)
+
+    plt.savefig(name_plot, format='png')
+    plt.close()
+
+
+def bench_barplot(n_plots=20):
+    '''
+    Barplots of crimes by hour: a new seaborn figure per plot vs the
+    barplot templates of viz, at full size and with the small preset.
+    '''
+
+    import io
+    import pandas as pd
+    import viz
+
+    rng = np.random.RandomState(0)
+    plots = [pd.DataFrame({'hour': list(range(24)),
+                           'crimes': rng.randint(0, 50, 24)})
+             for _ in range(n_plots)]
+    dic = {'day': 'Monday', 'hour': [9, 12]}
+
+    def draw(func, **kwargs):
+        for crimes in plots:
+            func(crimes, 'hour', io.BytesIO(), dic, **kwargs)
+
+    report('barplots ({} plots)'.format(n_plots), [
+        ('seaborn figure per plot', best_time(lambda: draw(legacy_barplot),
+                                              repeat=3)),
+        ('template, png', best_time(lambda: draw(viz.barplot), repeat=3)),
+        ('template, small png', best_time(
+            lambda: draw(viz.barplot, preset='small'), repeat=3)),
+        ('template, svg', best_time(lambda: draw(viz.barplot, fmt='svg'),
+                                    repeat=3)),
+    ])
+
+
+def bench_map_cuad(n_crimes=2000):
+    '''
+    Precinct map with many crimes: one folium.Marker per crime vs the
+    CrimeMarkers layer. Also reports the size of the html.
+    '''
+
+    import io
+    import pandas as pd
+    import precincts
+    import viz
+
+    cuadrantes = precincts.get_cuadrantes()
+    cuadrante = cuadrantes[cuadrantes.id == cuadrantes.id.iloc[0]]
+    lon, lat = cuadrante.geometry.iloc[0].centroid.coords[0]
+    rng = np.random.RandomState(0)
+    delitos = ['ROBO A TRANSEUNTE', 'VIOLACION', 'HOMICIDIO DOLOSO']
+    crimes = pd.DataFrame({
+        'latitud': lat + rng.uniform(-0.005, 0.005, n_crimes),
+        'longitud': lon + rng.uniform(-0.005, 0.005, n_crimes),
+        'delito': rng.choice(delitos, n_crimes)})
+    sizes = {}
+
+    def draw(threshold):
+        output = io.BytesIO()
+        viz.map_cuad(crimes, cuadrante, output, lat, lon, (lat, lon, 0),
+                     cluster_threshold=threshold)
+        sizes[threshold] = len(output.getvalue())
+
+    report('precinct map ({} crimes)'.format(n_crimes), [
+        ('one marker per crime', best_time(lambda: draw(n_crimes), repeat=3)),
+        ('CrimeMarkers layer', best_time(lambda: draw(0), repeat=3)),
+    ])
+    print('    html size {:.1f} MB -> {:.2f} MB'.format(
+        sizes[n_crimes] / 2**20, sizes[0] / 2**20))
+
+
+BENCHMARKS = {
+    'barplot': bench_barplot,
+    'map_cuad': bench_map_cuad,
+}
+
+
+def suite_cases(n_rows, inputs):
+    '''
+    Visualizations measured by the suite, of the precinct with the most
+    crimes.
+    Inputs:
+        n_rows (int): number of crimes of the database
+        inputs (dictionary): see runner.suite_inputs
+    Output:
+        dictionary name -> (func, calls, repeat) as in runner.measure
+    '''
+
+    import io
+    import precincts
+    import queries
+    import shortest_distance as sd
+    import topology
+    import viz
+
+    cube, cuadrantes, ids = inputs['cube'], inputs['cuadrantes'], inputs['ids']
+
+    # the precinct with the most crimes, the whole day
+    dense = dict(inputs['dics'][0], hour=[0, 23], crime_type=[1, 2, 3])
+    tipos = queries.get_crime_tipos(dense['crime_type'])
+    counts = cube.by_precinct(dense['day'], dense['hour'], tipos, ids)
+    dense['address'] = (dense['address'][0], dense['address'][1],
+                        int(ids.iloc[int(np.argmax(counts))]))
+    dense_crimes = queries.filter_data(dense, None)
+    cuadrante = cuadrantes[cuadrantes.id == dense['address'][2]]
+    week = queries.crimes_by_weekday(cube.by_weekday(dense['address'][2],
+                                                     tipos))
+    geometry = precincts.get_topology(topology.level_for_zoom(viz.ZOOM_CITY))
+
+    return {
+        'viz.barplot': (
+            lambda: viz.barplot(week, 'weekday', io.BytesIO(), dense), 1, 3),
+        'viz.map': (
+            lambda: viz.map(queries.crimes_by_precinct(counts, ids), geometry,
+                            io.BytesIO(), dense['address'][0],
+                            dense['address'][1]), 1, 3),
+        'viz.map_cuad_densest': (
+            lambda: viz.map_cuad(dense_crimes, cuadrante, io.BytesIO(),
+                                 dense['address'][0], dense['address'][1],
+                                 sd.get_police_station(*dense['address'][:2])),
+            1, 3),
+    }
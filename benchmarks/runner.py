@@ -0,0 +1,309 @@
+'''
+File name: runner.py
+
+Runs the benchmarks of the subsystems (see the docstring of the package):
+the timing helpers they share, the command line, and the suite, which
+measures the cases of every subsystem on synthetic databases and compares
+the results between commits.
+
+Calls ---> cube, geocoding, rendering and startup for the benchmarks and
+           the cases of the suite
+      ---> synthetic for the synthetic databases
+'''
+
+import os
+import sys
+import json
+import time
+import timeit
+import platform
+import tempfile
+import statistics
+import subprocess
+import tracemalloc
+import numpy as np
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SUITE_ROWS = [100000]
+SUITE_DATA_DIR = os.path.join(tempfile.gettempdir(), 'mexcrimes-benchmarks')
+# slower than this times the old timing is reported as a regression
+REGRESSION_RATIO = 1.1
+
+
+def best_time(func, repeat=5, number=1):
+    '''
+    Best wall time (in seconds) of calling func number times, out of
+    repeat tries.
+    '''
+
+    return min(timeit.repeat(func, repeat=repeat, number=number)) / number
+
+
+def report(name, times):
+    '''
+    Prints the timings of a benchmark, relative to the first one.
+    Inputs:
+        name (str): name of the benchmark
+        times (list): (label, seconds) tuples
+    '''
+
+    print(name)
+    base = times[0][1]
+    for label, seconds in times:
+        print('    {:<30} {:>12.6f} s  x{:.1f}'.format(label, seconds,
+                                                      base / seconds))
+
+
+def subsystems():
+    '''
+    Modules of the benchmarks of each subsystem, in the order they run.
+    '''
+
+    from . import cube, geocoding, rendering, startup
+
+    return [cube, geocoding, rendering, startup]
+
+
+def all_benchmarks():
+    '''
+    Dictionary name -> benchmark function of every subsystem.
+    '''
+
+    benchmarks = {}
+    for module in subsystems():
+        benchmarks.update(module.BENCHMARKS)
+
+    return benchmarks
+
+
+def measure(func, calls=1, repeat=5):
+    '''
+    Timings and peak memory of a function.
+    Inputs:
+        func (function): runs the code to measure
+        calls (int): number of calls of the measured function made by func
+        repeat (int): number of times func is timed
+    Output:
+        dictionary with the best and median seconds per call, and the peak
+        of the memory allocated by python and numpy while running func once
+        (MB, from tracemalloc)
+    '''
+
+    times = [seconds / calls for seconds in
+             timeit.repeat(func, repeat=repeat, number=1)]
+
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return {'best': min(times), 'median': statistics.median(times),
+            'calls': calls, 'repeat': repeat, 'peak_mb': peak / 2**20}
+
+
+def suite_inputs():
+    '''
+    Inputs shared by the cases of the suite, on the database
+    data/CrimesDB.sqlite3 of the working directory: 10000 random points in
+    the precincts, and queries as the ones of the form at the first 50 of
+    them (also as points to score).
+    Output:
+        dictionary
+    '''
+
+    import random
+    import crime_cube
+    import precincts
+    import synthetic
+    from getmaps import geocoding_helper as gh
+
+    random.seed(0)
+    cube = crime_cube.get_cube()
+    cuadrantes = precincts.get_cuadrantes()
+    rng = np.random.RandomState(0)
+    lats, lons, _ = synthetic.sample_points(10000, rng)
+
+    dics = []
+    for lat, lon, precinct in zip(lats[:50], lons[:50],
+                                  gh.get_locator().locate_many(lats[:50],
+                                                               lons[:50])):
+        first = random.randint(0, 22)
+        dics.append({'address': (lat, lon, int(precinct)),
+                     'day': random.choice(crime_cube.WEEK_DAYS),
+                     'hour': [first, random.randint(first + 1, 23)],
+                     'crime_type': random.sample([1, 2, 3], 2)})
+    points = [{'lat': dic['address'][0], 'lon': dic['address'][1],
+               'day': dic['day'], 'hour': dic['hour'],
+               'crime_type': dic['crime_type']} for dic in dics] * 200
+
+    return {'cube': cube, 'cuadrantes': cuadrantes, 'ids': cuadrantes['id'],
+            'lats': lats, 'lons': lons, 'dics': dics, 'points': points}
+
+
+def suite_cases(n_rows):
+    '''
+    Functions measured by the suite: the cases of every subsystem.
+    Input:
+        n_rows (int): number of crimes of the database
+    Output:
+        dictionary name -> (func, calls, repeat) as in measure
+    '''
+
+    inputs = suite_inputs()
+    cases = {}
+    for module in subsystems():
+        cases.update(module.suite_cases(n_rows, inputs))
+
+    return cases
+
+
+def run_suite(n_rows, output):
+    '''
+    Measures the functions of suite_cases and writes the results to json.
+    Runs in its own process (see suite), in a working directory whose
+    data/CrimesDB.sqlite3 is the synthetic database.
+    '''
+
+    import resource
+
+    results = {}
+    for name, (func, calls, repeat) in suite_cases(n_rows).items():
+        results[name] = measure(func, calls, repeat)
+        print('    {:<40} {:>12.6f} s  {:>8.1f} MB'.format(
+            name, results[name]['best'], results[name]['peak_mb']),
+            flush=True)
+
+    # kilobytes on linux
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+    with open(output, 'w') as f:
+        json.dump({'rows': n_rows, 'max_rss_mb': max_rss,
+                   'results': results}, f)
+
+
+def git_commit():
+    '''
+    Commit of the working tree, None if it is not a git repository.
+    '''
+
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+            cwd=ROOT).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def suite(rows=SUITE_ROWS, output=None, data_dir=SUITE_DATA_DIR, seed=0):
+    '''
+    Runs the suite on a synthetic database of each number of crimes, each
+    one in a new process (so the caches of the app and the peak memory are
+    those of one database), and writes the results to json.
+    Inputs:
+        rows (list): numbers of crimes
+        output (str): json file, by default benchmark-<commit>.json
+        data_dir (str): folder of the synthetic databases
+        seed (int): seed of the synthetic data
+    '''
+
+    import synthetic
+    import crime_columns
+
+    commit = git_commit()
+    output = output or 'benchmark-{}.json'.format((commit or 'local')[:10])
+    os.makedirs(data_dir, exist_ok=True)
+    runs = []
+
+    for n_rows in rows:
+        database = os.path.join(data_dir, 'synthetic-{}-{}.sqlite3'.format(
+            n_rows, seed))
+        if not os.path.exists(database):
+            print('generating {} crimes in {}'.format(n_rows, database),
+                  flush=True)
+            start = time.time()
+            synthetic.build_database(database + '.tmp', n_rows, seed)
+            os.replace(database + '.tmp', database)
+            print('    {:.1f} s'.format(time.time() - start))
+        columns = crime_columns.snapshot_dir(database)
+        if crime_columns.load_snapshot(database) is None:
+            crime_columns.write_snapshot(database)
+
+        print('suite ({} crimes)'.format(n_rows), flush=True)
+        with tempfile.TemporaryDirectory() as workdir:
+            os.mkdir(os.path.join(workdir, 'data'))
+            os.symlink(database, os.path.join(workdir, 'data',
+                                              'CrimesDB.sqlite3'))
+            os.symlink(columns, os.path.join(workdir, 'data',
+                                             'CrimesDB.columns'))
+            result = os.path.join(workdir, 'result.json')
+            # the modules of the app are imported from the root directory
+            env = dict(os.environ, PYTHONPATH=os.pathsep.join(
+                filter(None, [ROOT, os.environ.get('PYTHONPATH')])))
+            subprocess.check_call([sys.executable, '-m', 'benchmarks',
+                                   'suite-run', str(n_rows), result],
+                                  cwd=workdir, env=env)
+            with open(result) as f:
+                runs.append(json.load(f))
+
+    with open(output, 'w') as f:
+        json.dump({'commit': commit, 'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                   'python': platform.python_version(),
+                   'platform': platform.platform(), 'cpus': os.cpu_count(),
+                   'seed': seed, 'runs': runs}, f, indent=2)
+    print('results written to {}'.format(output))
+
+
+def compare(old, new, ratio=REGRESSION_RATIO):
+    '''
+    Prints the timings of two suite results side by side, marking the
+    functions that got slower than ratio times the old timing.
+    Inputs:
+        old, new (str): json files written by suite
+    Output:
+        number of regressions
+    '''
+
+    with open(old) as f:
+        old_runs = {run['rows']: run['results'] for run in json.load(f)['runs']}
+    with open(new) as f:
+        new_runs = {run['rows']: run['results'] for run in json.load(f)['runs']}
+
+    regressions = 0
+    for n_rows in sorted(set(old_runs) & set(new_runs)):
+        print('{} crimes'.format(n_rows))
+        for name in sorted(set(old_runs[n_rows]) & set(new_runs[n_rows])):
+            before = old_runs[n_rows][name]['best']
+            after = new_runs[n_rows][name]['best']
+            slower = after > before * ratio
+            regressions += slower
+            print('    {:<40} {:>12.6f} s {:>12.6f} s  x{:.2f}{}'.format(
+                name, before, after, before / after,
+                '  slower' if slower else ''))
+
+    return regressions
+
+
+def main(args):
+    '''
+    Command line, see the docstring of the module.
+    '''
+
+    import argparse
+
+    if args[:1] == ['suite-run']:
+        run_suite(int(args[1]), args[2])
+    elif args[:1] == ['suite']:
+        parser = argparse.ArgumentParser(prog='python3 -m benchmarks suite')
+        parser.add_argument('--rows', type=int, nargs='+', default=SUITE_ROWS)
+        parser.add_argument('--output')
+        parser.add_argument('--data-dir', default=SUITE_DATA_DIR)
+        parser.add_argument('--seed', type=int, default=0)
+        options = parser.parse_args(args[1:])
+        suite(options.rows, options.output, options.data_dir, options.seed)
+    elif args[:1] == ['compare']:
+        ratio = float(args[3]) if len(args) > 3 else REGRESSION_RATIO
+        sys.exit(1 if compare(args[1], args[2], ratio) else 0)
+    else:
+        benchmarks = all_benchmarks()
+        for bench in args or list(benchmarks):
+            benchmarks[bench]()
@@ -0,0 +1,106 @@
+'''
+File name: startup.py
+
+Benchmarks of the start up of a server process, each run in a new python
+process.
+
+Calls ---> mexcrimes.wsgi and getmaps.startup for the warm up
+'''
+
+import sys
+import subprocess
+from .runner import report
+
+
+# the libraries the views imported, and the precincts they loaded, before
+# they were loaded on first use (see getmaps.startup)
+EAGER_IMPORTS = '''
+import pandas, geopandas, scipy.spatial, matplotlib.pyplot, seaborn, folium
+import shapely.geometry, rtree, requests
+import viz, precincts
+precincts.get_cuadrantes()
+'''
+
+# Loads the WSGI application as a server process does, in the mode given as
+# argument (eager, cold or warm), and asks for the maps of an address with
+# empty caches and a stub geocoder. With the warm up, the first request is
+# sent once /ready answers 200, as a load balancer would. Prints the
+# seconds from the start of the process until it is ready and until the
+# first response
+STARTUP_SCRIPT = '''
+import os, sys, time, logging, tempfile
+start = time.perf_counter()
+mode = sys.argv[1]
+sys.path.insert(0, os.getcwd())
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "mexcrimes.settings")
+if mode == "eager":
+    exec(sys.argv[2])
+import mexcrimes.settings
+mexcrimes.settings.WARM_UP = mode == "warm"
+mexcrimes.settings.ALLOWED_HOSTS = ["testserver"]
+import artifact_cache
+from getmaps import geocode_cache, geocoding_helper
+artifact_cache.CACHE_DIR = tempfile.mkdtemp()
+geocode_cache.CACHE_FILENAME = os.path.join(tempfile.mkdtemp(), "cache.sqlite3")
+geocoding_helper.GEOCODER = geocoding_helper.StubGeocoder(
+    {"Zocalo": (19.4326, -99.1332)})
+import mexcrimes.wsgi
+# the 503 of /ready until the warm up is done
+logging.getLogger("django.request").setLevel(logging.CRITICAL)
+from django.test import Client
+from getmaps import startup
+client = Client()
+while mode == "warm" and client.get("/ready").status_code != 200:
+    time.sleep(0.01)
+if startup.status()["degraded"]:
+    sys.exit(str(startup.status()["errors"]))
+ready = time.perf_counter() - start
+response = client.get("/", {"address": "Zocalo", "day": "Friday",
+                            "hour_0": 3, "hour_1": 9, "crime_type": [1, 3]})
+assert response.status_code == 200 and b"iframe" in response.content
+print(ready, time.perf_counter() - start)
+'''
+
+
+def bench_startup(repeat=3):
+    '''
+    Time to the first response of a new server process to / (the maps of
+    an address, with empty caches): with WARM_UP disabled, the request
+    loads everything it needs; with WARM_UP enabled, it is sent once the
+    warm up of getmaps.startup is done. Both next to the baseline of the
+    views importing the heavy libraries and loading the precincts when
+    they are imported.
+    '''
+
+    def run(mode):
+        args = [sys.executable, '-W', 'ignore', '-c', STARTUP_SCRIPT, mode]
+        if mode == 'eager':
+            args.append(EAGER_IMPORTS)
+        runs = [[float(seconds) for seconds in
+                 subprocess.check_output(args).split()]
+                for _ in range(repeat)]
+        return min(runs, key=lambda run: run[1])
+
+    modes = [('eager imports (baseline)', 'eager'),
+             ('WARM_UP = False', 'cold'),
+             ('WARM_UP = True, after /ready', 'warm')]
+    results = [(label, run(mode)) for label, mode in modes]
+
+    report('time to the first response of /', [
+        (label, first) for label, (_, first) in results])
+    for label, (ready, first) in results:
+        print('    {:<30} {:.2f} s to take requests, {:.2f} s the first '
+              'one'.format(label, ready, first - ready))
+
+
+BENCHMARKS = {
+    'startup': bench_startup,
+}
+
+
+def suite_cases(n_rows, inputs):
+    '''
+    None: the start up is measured in new processes, by bench_startup.
+    '''
+
+    return {}
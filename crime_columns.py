@@ -0,0 +1,328 @@
+'''
+CAPP 30122 W'20: Final Poject
+
+This module keeps a columnar snapshot of the crime table of
+CrimesDB.sqlite3: one .npy file per column next to the database (e.g.
+data/CrimesDB.columns/latitud.npy), which the processes of the app memory
+map instead of reading the rows through sqlite3. Loading it only maps the
+files (the pages are read by the operating system when a query touches
+them, and shared by all the processes), and a query is a few numpy
+comparisons over the columns it filters on.
+
+The string columns (weekday, tipo and delito) are dictionary encoded: the
+column holds small integer codes and meta.json the name of each code. The
+rows keep the order of the crime table (precinct, weekday, hour, tipo), so
+the crimes of a precinct are a contiguous slice of every column.
+
+get_data writes the snapshot after every full download, and running this
+file writes it again (the incremental updates of get_data leave it as it
+is). It records the size and modification time of the database it was
+built from, and get_columns ignores it once the database changes, so
+queries fall back to the database until the snapshot is written again.
+
+Run: python3 crime_columns.py [database filename]
+
+Calls --> CrimesDB.sqlite3 database
+'''
+
+import os
+import sys
+import json
+import shutil
+import threading
+import numpy as np
+import crime_cube
+import crime_db
+
+
+# name -> dtype of the columns of the snapshot, None for the dictionary
+# encoded ones (the dtype depends on the size of the dictionary)
+COLUMNS = [('id', np.int32), ('weekday', None), ('hour', np.int8),
+           ('tipo', None), ('delito', None), ('fecha', np.int64),
+           ('latitud', np.float64), ('longitud', np.float64)]
+LOOKUPS = {'weekday': 'weekday_lookup', 'tipo': 'tipo_lookup',
+           'delito': 'delito_lookup'}
+META_FILENAME = 'meta.json'
+# rows read from the database at a time while writing
+CHUNK_ROWS = 500000
+
+_COLUMNS = None
+_KEY = None
+_LOCK = threading.Lock()
+
+
+class CrimeColumns:
+    '''
+    The columns of a snapshot, memory mapped, and the filters of
+    queries.get_query applied to them as numpy masks.
+    '''
+
+    def __init__(self, directory, meta):
+        '''
+        Inputs:
+            directory (str): folder of the snapshot
+            meta (dictionary): contents of its meta.json
+        '''
+
+        self.rows = meta['rows']
+        self.columns = {}
+        for name, _ in COLUMNS:
+            column = np.load(os.path.join(directory, name + '.npy'),
+                             mmap_mode='r')
+            if len(column) != self.rows:
+                raise ValueError('{} has {} rows, expected {}'.format(
+                    name, len(column), self.rows))
+            self.columns[name] = column
+
+        self.names = {column: np.array(names, dtype=object)
+                      for column, names in meta['dictionaries'].items()}
+        self.codes = {column: {name: code for code, name in enumerate(names)}
+                      for column, names in meta['dictionaries'].items()}
+
+    def precinct_rows(self, precinct):
+        '''
+        Slice of the rows of a precinct (the id column is sorted).
+        '''
+
+        ids = self.columns['id']
+        # keys of another dtype would make numpy convert the whole column
+        start, end = np.searchsorted(ids, np.array([precinct, precinct + 1],
+                                                   dtype=ids.dtype))
+
+        return slice(int(start), int(end))
+
+    def mask(self, dic, group_var, tipos):
+        '''
+        Rows that match the filters of queries.get_query.
+        Inputs:
+            dic (dictionary): contains the data introduced by the user.
+            group_var (str): variable to group by (none, id, weekday, hour)
+            tipos (tuple): types of crime (see queries.get_crime_tipos)
+        Output:
+            (rows, mask): slice of the rows that can match (the precinct of
+            the address, or all of them when grouping by id) and boolean
+            numpy array over it
+        '''
+
+        if group_var == "id":
+            rows = slice(0, self.rows)
+        else:
+            rows = self.precinct_rows(int(dic["address"][2]))
+
+        # selected[code] is True for the codes of the types of crime
+        selected = np.zeros(len(self.names['tipo']), dtype=bool)
+        selected[[self.codes['tipo'][tipo] for tipo in tipos
+                  if tipo in self.codes['tipo']]] = True
+        mask = selected[self.columns['tipo'][rows]]
+
+        if group_var != "weekday":
+            day = self.codes['weekday'].get(dic["day"], -1)
+            mask &= self.columns['weekday'][rows] == day
+
+        if group_var == "id" or group_var is None:
+            hour = self.columns['hour'][rows]
+            mask &= ((hour >= int(dic["hour"][0])) &
+                     (hour <= int(dic["hour"][1])))
+
+        return rows, mask
+
+    def filter_data(self, dic, group_var, tipos):
+        '''
+        Same as queries.filter_data, from the snapshot.
+        Inputs:
+            dic (dictionary): contains the data introduced by the user.
+            group_var (str): variable to group by (none, id, weekday, hour)
+            tipos (tuple): types of crime (see queries.get_crime_tipos)
+        Outputs:
+            pandas dataframe
+        '''
+
+        import pandas as pd
+
+        rows, mask = self.mask(dic, group_var, tipos)
+
+        if group_var:
+            counts = np.bincount(self.columns[group_var][rows][mask])
+            groups = np.flatnonzero(counts)
+            if group_var in self.names:
+                keys = self.names[group_var][groups]
+            else:
+                keys = groups
+            return pd.DataFrame({group_var: keys, "crimes": counts[groups]})
+
+        delito = self.columns['delito'][rows][mask]
+
+        return pd.DataFrame({
+            "latitud": self.columns['latitud'][rows][mask],
+            "longitud": self.columns['longitud'][rows][mask],
+            "delito": self.names['delito'][delito]})
+
+
+def snapshot_dir(filename=crime_cube.DATABASE_FILENAME):
+    '''
+    Folder of the snapshot of a database (its name with .columns instead of
+    its extension).
+    '''
+
+    return os.path.splitext(filename)[0] + '.columns'
+
+
+def code_dtype(n_codes):
+    '''
+    Smallest integer dtype for the codes of a dictionary of n_codes names.
+    '''
+
+    for dtype in (np.int8, np.int16, np.int32):
+        if n_codes <= np.iinfo(dtype).max + 1:
+            return dtype
+
+    return np.int64
+
+
+def write_snapshot(filename=crime_cube.DATABASE_FILENAME,
+                   chunk_rows=CHUNK_ROWS):
+    '''
+    Writes the snapshot of the crime table of a database, replacing the
+    previous one. The rows are read in chunks and written to the files
+    directly, so memory use does not grow with the number of crimes. The
+    new snapshot is written to a temporary folder that is then renamed, so
+    other processes never map half of it.
+    Inputs:
+        filename (str): path of the sqlite3 database
+        chunk_rows (int): rows read at a time
+    Output:
+        number of crimes in the snapshot
+    '''
+
+    conn = crime_db.connect_read_only(filename)
+    if not crime_db.is_compact(conn):
+        conn.close()
+        raise ValueError('{} must be migrated first (python3 crime_db.py)'
+                         .format(filename))
+
+    signature = crime_cube.database_signature(filename)
+    dictionaries = {}
+    recode = {}
+    for column, lookup in LOOKUPS.items():
+        lookup_rows = conn.execute('SELECT code, name FROM {} ORDER BY code'
+                                   .format(lookup)).fetchall()
+        dictionaries[column] = [name for _, name in lookup_rows]
+        # database code -> position in the dictionary
+        recode[column] = np.full(max([c for c, _ in lookup_rows] + [-1]) + 1,
+                                 -1, dtype=np.int64)
+        for position, (code, _) in enumerate(lookup_rows):
+            recode[column][code] = position
+
+    n_rows = conn.execute('SELECT count(*) FROM crime').fetchone()[0]
+    target = snapshot_dir(filename)
+    tmp_dir = '{}.{}.tmp'.format(target, os.getpid())
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+
+    files = {}
+    for name, dtype in COLUMNS:
+        if dtype is None:
+            dtype = code_dtype(len(dictionaries[name]))
+        files[name] = np.lib.format.open_memmap(
+            os.path.join(tmp_dir, name + '.npy'), mode='w+', dtype=dtype,
+            shape=(n_rows,))
+
+    # the order of the primary key, see crime_db
+    cursor = conn.execute('SELECT {} FROM crime ORDER BY id, weekday, hour, '
+                          'tipo, n'.format(', '.join(n for n, _ in COLUMNS)))
+    start = 0
+    while True:
+        chunk = cursor.fetchmany(chunk_rows)
+        if not chunk:
+            break
+        # NULL coordinates become nan
+        values = np.array(chunk, dtype=np.float64)
+        end = start + len(chunk)
+        for i, (name, _) in enumerate(COLUMNS):
+            column = values[:, i]
+            if name in recode:
+                column = recode[name][column.astype(np.int64)]
+            files[name][start:end] = column
+        start = end
+    conn.close()
+
+    for column in files.values():
+        column.flush()
+    del files
+
+    with open(os.path.join(tmp_dir, META_FILENAME), 'w') as f:
+        json.dump({'signature': list(signature), 'rows': n_rows,
+                   'dictionaries': dictionaries}, f)
+
+    # processes that mapped the old files keep them until they load the
+    # new ones
+    old_dir = '{}.{}.old'.format(target, os.getpid())
+    if os.path.exists(target):
+        os.rename(target, old_dir)
+    os.rename(tmp_dir, target)
+    shutil.rmtree(old_dir, ignore_errors=True)
+
+    return n_rows
+
+
+def load_snapshot(filename=crime_cube.DATABASE_FILENAME):
+    '''
+    Maps the snapshot of a database if it was built from the database as
+    it is now. Returns None otherwise (no snapshot, or the database changed
+    after it was written).
+    '''
+
+    directory = snapshot_dir(filename)
+    try:
+        with open(os.path.join(directory, META_FILENAME)) as f:
+            meta = json.load(f)
+        if tuple(meta['signature']) != crime_cube.database_signature(filename):
+            return None
+        return CrimeColumns(directory, meta)
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def snapshot_key(filename):
+    '''
+    Signatures of the database and of the meta.json of its snapshot (None
+    if there is no snapshot), used to notice that either one changed.
+    '''
+
+    try:
+        meta = crime_cube.database_signature(
+            os.path.join(snapshot_dir(filename), META_FILENAME))
+    except OSError:
+        meta = None
+
+    return (filename, crime_cube.database_signature(filename), meta)
+
+
+def get_columns(filename=crime_cube.DATABASE_FILENAME):
+    '''
+    Returns the snapshot of the process, mapping it on first use and again
+    after the database or the snapshot change. None if there is no
+    snapshot of the current database.
+    Input:
+        filename (str): path of the sqlite3 database
+    Output:
+        CrimeColumns or None
+    '''
+
+    global _COLUMNS, _KEY
+
+    key = snapshot_key(filename)
+    if _KEY == key:
+        return _COLUMNS
+
+    with _LOCK:
+        if _KEY != key:
+            _COLUMNS, _KEY = load_snapshot(filename), key
+
+    return _COLUMNS
+
+
+if __name__ == "__main__":
+    filename = sys.argv[1] if len(sys.argv) > 1 else crime_cube.DATABASE_FILENAME
+    print('{} crimes written to {}'.format(write_snapshot(filename),
+                                           snapshot_dir(filename)))
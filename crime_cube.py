@@ -0,0 +1,248 @@
+'''
+CAPP 30122 W'20: Final Poject
+
+This module keeps in memory a dense count of the crimes in the database
+by precinct, day of the week, hour and type of crime. The count is built
+once per process (from the crime_counts table that get_data keeps up to
+date, see crime_db), and afterwards the aggregations needed for the
+visualizations are slices and sums of numpy arrays (no sql involved). It
+is rebuilt when the database file changes.
+
+Calls --> CrimesDB.sqlite3 database
+'''
+
+import sqlite3
+import os
+import threading
+import numpy as np
+
+
+DATABASE_FILENAME = os.path.join(os.getcwd(), 'data/CrimesDB.sqlite3')
+WEEK_DAYS = ['Sunday', 'Monday', 'Tuesday', 'Wednesday', 'Thursday',
+             'Friday', 'Saturday']
+HOURS = 24
+
+_CUBE = None
+_SIGNATURE = None
+_LOCK = threading.Lock()
+
+
+class CrimeCube:
+    '''
+    Number of crimes indexed by [precinct id, weekday, hour, tipo].
+
+    Besides the counts, it stores prefix sums over the hour axis, so the
+    number of crimes in an hour range is the difference of two slices.
+    '''
+
+    def __init__(self, ids, weekdays, hours, tipos, crimes):
+        '''
+        Inputs:
+            ids, weekdays, hours, tipos, crimes (arrays): one element per
+                group of the crime table (precinct id, weekday name, hour,
+                type of crime and number of crimes)
+        '''
+
+        self.tipos = sorted(set(tipos))
+        self.tipo_index = {tipo: i for i, tipo in enumerate(self.tipos)}
+        day_index = {day: i for i, day in enumerate(WEEK_DAYS)}
+
+        ids = np.asarray(ids, dtype=np.int64)
+        hours = np.asarray(hours, dtype=np.int64)
+        days = np.array([day_index.get(day, -1) for day in weekdays],
+                        dtype=np.int64)
+        tipo_codes = np.array([self.tipo_index[tipo] for tipo in tipos],
+                              dtype=np.int64)
+        crimes = np.asarray(crimes, dtype=np.int64)
+
+        keep = (ids >= 0) & (days >= 0) & (hours >= 0) & (hours < HOURS)
+        n_precincts = int(ids[keep].max()) + 1 if keep.any() else 0
+
+        self.counts = np.zeros((n_precincts, len(WEEK_DAYS), HOURS,
+                                len(self.tipos)), dtype=np.int32)
+        np.add.at(self.counts,
+                  (ids[keep], days[keep], hours[keep], tipo_codes[keep]),
+                  crimes[keep])
+
+        # hour_sums[:, :, h] is the number of crimes before hour h
+        self.hour_sums = np.zeros((n_precincts, len(WEEK_DAYS), HOURS + 1,
+                                   len(self.tipos)), dtype=np.int32)
+        np.cumsum(self.counts, axis=2, out=self.hour_sums[:, :, 1:])
+
+    @property
+    def n_precincts(self):
+        return self.counts.shape[0]
+
+    def tipo_codes(self, tipos):
+        '''
+        Positions in the tipo axis of the given types of crime. Types that
+        are not in the database are ignored.
+        '''
+
+        return [self.tipo_index[t] for t in tipos if t in self.tipo_index]
+
+    def by_precinct(self, day, hour, tipos, ids=None):
+        '''
+        Number of crimes per precinct on a day and hour range.
+        Inputs:
+            day (str): day of the week
+            hour (list): [first hour, last hour], both included
+            tipos (tuple): types of crime to count
+            ids (array): precinct ids to report, by default all of them
+        Output:
+            numpy array of counts, aligned with ids
+        '''
+
+        d = WEEK_DAYS.index(day)
+        codes = self.tipo_codes(tipos)
+        counts = (self.hour_sums[:, d, hour[1] + 1, codes] -
+                  self.hour_sums[:, d, hour[0], codes]).sum(axis=1)
+
+        return self._align(counts, ids)
+
+    def _align(self, counts, ids):
+        '''
+        Counts per precinct of the given precinct ids (0 for the ids that
+        are not in the cube). All the precincts if ids is None.
+        '''
+
+        if ids is None:
+            return counts
+
+        ids = np.asarray(ids, dtype=np.int64)
+        valid = (ids >= 0) & (ids < self.n_precincts)
+        result = np.zeros(len(ids), dtype=counts.dtype)
+        result[valid] = counts[ids[valid]]
+
+        return result
+
+    def by_weekday(self, precinct, tipos):
+        '''
+        Number of crimes in a precinct per day of the week (all hours),
+        in the order of WEEK_DAYS.
+        '''
+
+        if not 0 <= precinct < self.n_precincts:
+            return np.zeros(len(WEEK_DAYS), dtype=self.counts.dtype)
+
+        codes = self.tipo_codes(tipos)
+
+        return self.hour_sums[precinct, :, HOURS, codes].sum(axis=0)
+
+    def by_hour(self, precinct, day, tipos):
+        '''
+        Number of crimes in a precinct per hour of a day of the week.
+        '''
+
+        if not 0 <= precinct < self.n_precincts:
+            return np.zeros(HOURS, dtype=self.counts.dtype)
+
+        codes = self.tipo_codes(tipos)
+
+        return self.counts[precinct, WEEK_DAYS.index(day), :, codes].sum(axis=0)
+
+    def total(self, precinct, day, hour, tipos):
+        '''
+        Number of crimes in a precinct on a day and hour range.
+        '''
+
+        if not 0 <= precinct < self.n_precincts:
+            return 0
+
+        codes = self.tipo_codes(tipos)
+        d = WEEK_DAYS.index(day)
+
+        return int((self.hour_sums[precinct, d, hour[1] + 1, codes] -
+                    self.hour_sums[precinct, d, hour[0], codes]).sum())
+
+    def summary(self, precinct, day, hour, tipos, ids=None):
+        '''
+        All the counts of a query in one call: the same as by_precinct,
+        by_weekday, by_hour and total, with the types of crime and the day
+        looked up once, and the total taken from the counts per precinct.
+        Inputs:
+            precinct (int): id of the precinct of the address
+            day (str): day of the week
+            hour (list): [first hour, last hour], both included
+            tipos (tuple): types of crime to count
+            ids (array): precinct ids of by_precinct, by default all of them
+        Output:
+            dictionary with by_precinct, by_weekday and by_hour (numpy
+            arrays) and total (int)
+        '''
+
+        d = WEEK_DAYS.index(day)
+        codes = self.tipo_codes(tipos)
+        counts = (self.hour_sums[:, d, hour[1] + 1, codes] -
+                  self.hour_sums[:, d, hour[0], codes]).sum(axis=1)
+
+        if 0 <= precinct < self.n_precincts:
+            by_weekday = self.hour_sums[precinct, :, HOURS, codes].sum(axis=0)
+            by_hour = self.counts[precinct, d, :, codes].sum(axis=0)
+            total = int(counts[precinct])
+        else:
+            by_weekday = np.zeros(len(WEEK_DAYS), dtype=self.counts.dtype)
+            by_hour = np.zeros(HOURS, dtype=self.counts.dtype)
+            total = 0
+
+        return {"by_precinct": self._align(counts, ids),
+                "by_weekday": by_weekday, "by_hour": by_hour, "total": total}
+
+
+def build_cube(filename=DATABASE_FILENAME):
+    '''
+    Builds the count cube from the crime table of the database.
+    Input:
+        filename (str): path of the sqlite3 database
+    Output:
+        CrimeCube
+    '''
+
+    connection = sqlite3.connect(filename)
+    compact = connection.execute(
+        "SELECT count(*) FROM sqlite_master "
+        "WHERE type = 'table' AND name = 'weekday_lookup'").fetchone()[0]
+    if compact:
+        query = ("SELECT c.id, w.name, c.hour, t.name, c.crimes "
+                 "FROM crime_counts c "
+                 "JOIN weekday_lookup w ON w.code = c.weekday "
+                 "JOIN tipo_lookup t ON t.code = c.tipo")
+    else:
+        # database in the pandas to_sql layout, see crime_db
+        query = ("SELECT id, weekday, hour, tipo, count(*) FROM crime "
+                 "GROUP BY id, weekday, hour, tipo")
+    rows = connection.execute(query).fetchall()
+    connection.close()
+
+    columns = list(zip(*rows)) if rows else [()] * 5
+
+    return CrimeCube(*columns)
+
+
+def database_signature(filename=DATABASE_FILENAME):
+    '''
+    (size, modification time) of the database, used to notice updates.
+    '''
+
+    stat = os.stat(filename)
+
+    return (stat.st_size, stat.st_mtime_ns)
+
+
+def get_cube():
+    '''
+    Returns the count cube of the process, building it on first use and
+    after the database is updated.
+    '''
+
+    global _CUBE, _SIGNATURE
+
+    signature = database_signature(DATABASE_FILENAME)
+    if _CUBE is not None and _SIGNATURE == signature:
+        return _CUBE
+
+    with _LOCK:
+        if _CUBE is None or _SIGNATURE != signature:
+            _CUBE, _SIGNATURE = build_cube(DATABASE_FILENAME), signature
+
+    return _CUBE
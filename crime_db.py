@@ -0,0 +1,368 @@
+'''
+CAPP 30122 W'20: Final Poject
+
+This module defines the schema of the crime tables of CrimesDB.sqlite3 and
+loads the crimes into it.
+
+get_data writes the crimes, as they come out of data_cleaning and the
+spatial join, to a staging table. They are then copied to the crime table
+keeping only the columns the app uses: weekday, type of crime and delito
+as integer codes of lookup tables, the time of the crime as seconds since
+1970 and the location as REAL latitude and longitude (no WKT strings, the
+precinct attributes are in data/cuadrantes.geojson). The crime table is a
+WITHOUT ROWID table whose primary key starts with (id, weekday, hour,
+tipo): it is stored sorted by the columns the queries filter on, so it is
+its own covering index and the crimes of a query are read contiguously.
+The locations are also indexed by an R*Tree (crime_rtree), for the crimes
+within a distance of an address regardless of precinct borders. It only
+holds n and the location of each crime, the rest is read from the crime
+table (through the crime_n index).
+
+The web app reads the database through get_connection: one read-only
+connection per thread, kept open between requests, so the connection
+setup and the page cache are not paid again on every query.
+
+Running this file migrates the database from the pandas to_sql layout
+(or adds crime_rtree to databases written before it). Until then, the
+queries by distance raise MissingIndexError.
+
+Calls --> CrimesDB.sqlite3 database
+'''
+
+import os
+import sys
+import pathlib
+import sqlite3
+import threading
+import crime_cube
+
+
+SCHEMA = [
+    'CREATE TABLE weekday_lookup (code INTEGER PRIMARY KEY, '
+    'name TEXT NOT NULL UNIQUE)',
+    'CREATE TABLE tipo_lookup (code INTEGER PRIMARY KEY, '
+    'name TEXT NOT NULL UNIQUE)',
+    'CREATE TABLE delito_lookup (code INTEGER PRIMARY KEY, '
+    'name TEXT NOT NULL UNIQUE)',
+    # n numbers the crimes, to tell apart the crimes of the same group
+    'CREATE TABLE crime (id INTEGER NOT NULL, weekday INTEGER NOT NULL, '
+    'hour INTEGER NOT NULL, tipo INTEGER NOT NULL, n INTEGER NOT NULL, '
+    'delito INTEGER NOT NULL, fecha INTEGER NOT NULL, latitud REAL, '
+    'longitud REAL, PRIMARY KEY (id, weekday, hour, tipo, n)) WITHOUT ROWID',
+    'CREATE TABLE crime_counts (id INTEGER NOT NULL, '
+    'weekday INTEGER NOT NULL, hour INTEGER NOT NULL, '
+    'tipo INTEGER NOT NULL, crimes INTEGER NOT NULL, '
+    'PRIMARY KEY (id, weekday, hour, tipo)) WITHOUT ROWID',
+    'CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)',
+]
+# R*Tree of the locations of the crimes, for the queries by distance (see
+# queries.get_radius_query). The id is n of the crime table, whose rows are
+# found through crime_n
+RTREE_SCHEMA = ('CREATE VIRTUAL TABLE crime_rtree USING rtree(n, '
+                'min_lat, max_lat, min_lon, max_lon)')
+N_INDEX_SCHEMA = 'CREATE INDEX IF NOT EXISTS crime_n ON crime (n)'
+SCHEMA += [RTREE_SCHEMA, N_INDEX_SCHEMA]
+TABLES = ['weekday_lookup', 'tipo_lookup', 'delito_lookup', 'crime',
+          'crime_counts', 'crime_rtree']
+
+# read-only connections: the database is memory mapped (it is a few tens of
+# MB) and every connection keeps up to 16 MB of pages in its cache
+MMAP_SIZE = 256 * 1024 * 1024
+CACHE_KIB = 16 * 1024
+CACHED_STATEMENTS = 256
+
+_LOCAL = threading.local()
+
+
+class MissingIndexError(Exception):
+    '''
+    The database has no crime_rtree yet (it was written before it was part
+    of the schema), so the crimes within a distance can't be queried. It is
+    added by running this file.
+    '''
+
+
+def connect_read_only(filename=crime_cube.DATABASE_FILENAME):
+    '''
+    Opens a read-only connection to the database.
+    Input:
+        filename (str): path of the sqlite3 database
+    Output:
+        sqlite3 connection
+    '''
+
+    uri = pathlib.Path(os.path.abspath(filename)).as_uri() + '?mode=ro'
+    conn = sqlite3.connect(uri, uri=True, cached_statements=CACHED_STATEMENTS)
+    conn.execute('PRAGMA query_only = ON')
+    conn.execute('PRAGMA mmap_size = {}'.format(MMAP_SIZE))
+    conn.execute('PRAGMA cache_size = -{}'.format(CACHE_KIB))
+
+    return conn
+
+
+def get_connection(filename=crime_cube.DATABASE_FILENAME):
+    '''
+    Returns the read-only connection of the current thread to the database,
+    opening it on first use. sqlite3 connections can't be shared between
+    threads, so every thread (or worker process) keeps its own. It is opened
+    again if the database file is replaced by another one. The callers must
+    not close it.
+    Input:
+        filename (str): path of the sqlite3 database
+    Output:
+        sqlite3 connection
+    '''
+
+    connections = getattr(_LOCAL, 'connections', None)
+    if connections is None:
+        connections = _LOCAL.connections = {}
+
+    inode = os.stat(filename).st_ino
+    cached = connections.get(filename)
+    if cached is not None and cached[0] == inode:
+        return cached[1]
+
+    if cached is not None:
+        cached[1].close()
+    conn = connect_read_only(filename)
+    connections[filename] = (inode, conn)
+
+    return conn
+
+
+def create_schema(conn):
+    '''
+    Creates the crime tables, dropping the ones that exist.
+    Input:
+        conn: sqlite3 connection
+    '''
+
+    for table in TABLES:
+        conn.execute('DROP TABLE IF EXISTS {}'.format(table))
+    for statement in SCHEMA:
+        conn.execute(statement)
+
+    conn.executemany('INSERT INTO weekday_lookup VALUES (?, ?)',
+                     enumerate(crime_cube.WEEK_DAYS))
+    set_meta(conn, 'crimes', 0)
+
+
+def staging_joins(staging):
+    '''
+    FROM clause of the rows of a staging table with the codes of their
+    weekday (w), tipo (t) and delito (d). Rows without a valid date and
+    time are left out (fecha can't be NULL).
+    '''
+
+    return ('FROM {} s '
+            'JOIN weekday_lookup w ON w.name = s.weekday '
+            'JOIN tipo_lookup t ON t.name = s.tipo '
+            'JOIN delito_lookup d ON d.name = s.delito '
+            "AND strftime('%s', s.date || ' ' || s.time) IS NOT NULL "
+            .format(staging))
+
+
+def drop_stored(conn, staging, high_water_mark):
+    '''
+    Deletes from a staging table the crimes dated at the high-water mark
+    that the crime table already has: an update asks for the crimes from
+    the mark on, so the ones published after the previous update with the
+    same date and time are not lost. Identical crimes are told apart by
+    their number, so the ones beyond the count already stored are kept.
+    The stored crimes are found through the primary key (id, weekday, hour,
+    tipo).
+    Inputs:
+        conn: sqlite3 connection
+        staging (str): name of the staging table
+        high_water_mark (str): date and time of the latest crime in the
+            database ('YYYY-MM-DD HH:MM:SS')
+    Output:
+        number of crimes deleted
+    '''
+
+    stored = ('SELECT count(*) FROM crime c WHERE c.id = s.id AND '
+              'c.weekday = w.code AND c.hour = s.hour AND c.tipo = t.code AND '
+              "c.delito = d.code AND c.fecha = CAST(strftime('%s', :mark) "
+              'AS INTEGER) AND c.latitud IS s.latitud AND '
+              'c.longitud IS s.longitud')
+    cursor = conn.execute(
+        'DELETE FROM {} WHERE rowid IN (SELECT r FROM ('
+        'SELECT s.rowid AS r, row_number() OVER (PARTITION BY s.id, '
+        's.weekday, s.hour, s.tipo, s.delito, s.latitud, s.longitud '
+        'ORDER BY s.rowid) AS k, ({}) AS stored {}'
+        "WHERE s.date || ' ' || s.time = :mark) WHERE k <= stored)".format(
+            staging, stored, staging_joins(staging)),
+        {'mark': high_water_mark})
+
+    return cursor.rowcount
+
+
+def load_staging(conn, staging, high_water_mark):
+    '''
+    Copies the crimes of a staging table (with the columns of the merged
+    dataframes of get_data) to the crime table, and adds them to the counts
+    of crime_counts.
+    Inputs:
+        conn: sqlite3 connection
+        staging (str): name of the staging table
+        high_water_mark (str): date and time of the latest crime in the
+            database after the load ('YYYY-MM-DD HH:MM:SS')
+    '''
+
+    for lookup, column in (('tipo_lookup', 'tipo'), ('delito_lookup', 'delito')):
+        conn.execute('INSERT OR IGNORE INTO {} (name) SELECT DISTINCT {} '
+                     'FROM {} WHERE {} IS NOT NULL'.format(lookup, column,
+                                                           staging, column))
+
+    # the same joins for the three tables, so crime_counts counts the rows
+    # of crime (crimes without weekday, tipo, delito or a valid date and
+    # time are left out of all)
+    joins = staging_joins(staging)
+
+    offset = int(get_meta(conn, 'crimes') or 0)
+    conn.execute('INSERT INTO crime '
+                 'SELECT s.id, w.code, s.hour, t.code, ? + s.rowid, d.code, '
+                 "CAST(strftime('%s', s.date || ' ' || s.time) AS INTEGER), "
+                 's.latitud, s.longitud ' + joins, (offset,))
+
+    conn.execute('INSERT INTO crime_rtree '
+                 'SELECT ? + s.rowid, s.latitud, s.latitud, s.longitud, '
+                 's.longitud ' + joins +
+                 'WHERE s.latitud IS NOT NULL AND s.longitud IS NOT NULL',
+                 (offset,))
+
+    conn.execute('INSERT INTO crime_counts '
+                 'SELECT s.id, w.code, s.hour, t.code, count(*) ' + joins +
+                 'WHERE true GROUP BY s.id, w.code, s.hour, t.code '
+                 'ON CONFLICT (id, weekday, hour, tipo) '
+                 'DO UPDATE SET crimes = crimes + excluded.crimes')
+
+    last = conn.execute('SELECT max(rowid) FROM {}'.format(staging)).fetchone()
+    set_meta(conn, 'crimes', offset + (last[0] or 0))
+    set_meta(conn, 'high_water_mark', high_water_mark)
+
+
+def set_meta(conn, key, value):
+    '''
+    Stores a value in the meta table of the database.
+    '''
+
+    conn.execute('CREATE TABLE IF NOT EXISTS meta '
+                 '(key TEXT PRIMARY KEY, value TEXT)')
+    conn.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', (key, value))
+
+
+def get_meta(conn, key):
+    '''
+    Value stored in the meta table of the database, None if it is not there.
+    '''
+
+    try:
+        row = conn.execute('SELECT value FROM meta WHERE key = ?',
+                           (key,)).fetchone()
+    except sqlite3.OperationalError:
+        return None
+
+    return row[0] if row else None
+
+
+def is_compact(conn):
+    '''
+    True if the crime table has the schema of this module.
+    '''
+
+    columns = [row[1] for row in conn.execute('PRAGMA table_info(crime)')]
+
+    return 'fecha' in columns and 'date' not in columns
+
+
+def has_rtree(conn):
+    '''
+    True if the database has crime_rtree and crime_n.
+    '''
+
+    return conn.execute("SELECT count(*) FROM sqlite_master WHERE name IN "
+                        "('crime_rtree', 'crime_n')").fetchone()[0] == 2
+
+
+def require_rtree(conn):
+    '''
+    Raises MissingIndexError if the database has no crime_rtree.
+    '''
+
+    if not has_rtree(conn):
+        raise MissingIndexError('The index of the crimes by location is not '
+                                'built (run python3 crime_db.py)')
+
+
+def add_rtree(conn):
+    '''
+    Creates and fills crime_rtree (and crime_n) from the crime table, for
+    databases written before it was part of the schema. An R*Tree with the
+    columns of the crime table stored along (as written by earlier
+    versions) is replaced by one with the locations only. Does nothing if
+    it is up to date.
+    Input:
+        conn: sqlite3 connection
+    Output:
+        True if it was created
+    '''
+
+    columns = conn.execute('PRAGMA table_info(crime_rtree)').fetchall()
+    if has_rtree(conn) and len(columns) == 5:
+        return False
+
+    with conn:
+        conn.execute('DROP TABLE IF EXISTS crime_rtree')
+        conn.execute(RTREE_SCHEMA)
+        conn.execute('INSERT INTO crime_rtree '
+                     'SELECT n, latitud, latitud, longitud, longitud '
+                     'FROM crime '
+                     'WHERE latitud IS NOT NULL AND longitud IS NOT NULL')
+        conn.execute(N_INDEX_SCHEMA)
+
+    return True
+
+
+def migrate(filename=crime_cube.DATABASE_FILENAME):
+    '''
+    Converts a crime table written by pandas to_sql to the schema of this
+    module, and reclaims the space of the old table. Databases already in
+    this schema only get the tables added to it since (crime_rtree).
+    Input:
+        filename (str): path of the sqlite3 database
+    Output:
+        True if the database was changed
+    '''
+
+    conn = sqlite3.connect(filename)
+    if is_compact(conn):
+        added = add_rtree(conn)
+        if added:
+            # reclaim the space of a replaced crime_rtree
+            conn.execute('VACUUM')
+        conn.close()
+        return added
+
+    with conn:
+        high_water_mark = conn.execute(
+            "SELECT max(date || ' ' || time) FROM crime").fetchone()[0]
+        conn.execute('DROP TABLE IF EXISTS crime_old')
+        conn.execute('ALTER TABLE crime RENAME TO crime_old')
+        create_schema(conn)
+        load_staging(conn, 'crime_old', high_water_mark)
+        conn.execute('DROP TABLE crime_old')
+    conn.execute('VACUUM')
+    conn.close()
+
+    return True
+
+
+if __name__ == "__main__":
+    filename = sys.argv[1] if len(sys.argv) > 1 else crime_cube.DATABASE_FILENAME
+    before = os.path.getsize(filename)
+    if migrate(filename):
+        print('Migrated {}: {:.1f} MB -> {:.1f} MB'.format(
+            filename, before / 2**20, os.path.getsize(filename) / 2**20))
+    else:
+        print('{} is already migrated'.format(filename))
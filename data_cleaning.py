@@ -9,8 +9,8 @@ be categorized (date and location)
 '''
 
 import geopandas as gpd
+import numpy as np
 import pandas as pd
-from datetime import datetime
 
 crimes_w = ['DENUNCIA DE HECHOS POR ROBO DE CELULAR',\
 'ROBO A TRANSEUNTE EN CINE CON VIOLENCIA', \
@@ -87,34 +87,65 @@ rape = ['VIOLACION TUMULTUARIA','VIOLACION','VIOLACION TUMULTUARIA EQUIPARADA'\
 'TENTATIVA DE VIOLACION','VIOLACION EQUIPARADA']
 
 
+# type of each crime (delito), with the names queries.get_crime_tipos asks
+# for. A crime in more than one list gets the type of the first one
+DELITO_TIPO = {}
+for delitos, tipo in [(crimes_w, 'walking'), (crimes_pt, 'public transit'),
+                      (crimes_v, 'personal vehicle'), (homicides, 'homicide'),
+                      (rape, 'rape')]:
+    for delito in delitos:
+        DELITO_TIPO.setdefault(delito, tipo)
+
+
+def categorize(delitos):
+    '''
+    Type of crime of each delito, NaN for crimes that are not considered.
+    The mapping is done once per distinct delito through categorical codes.
+
+    Input:
+        delitos: pandas series of crimes (delito)
+    Returns:
+        numpy array of types of crime
+    '''
+
+    delitos = delitos.astype('category')
+    tipos = delitos.cat.categories.map(DELITO_TIPO).to_numpy(dtype=object)
+    codes = delitos.cat.codes.to_numpy()
+
+    # code -1 (missing delito) takes the NaN appended at the end
+    return np.append(tipos, np.nan)[codes]
+
+
+def format_unique(times, fmt):
+    '''
+    Formats datetimes as strings, formatting each distinct value only once
+    (there are few distinct days and times of the day in the data).
+
+    Input:
+        times: pandas series of datetimes
+        fmt: strftime format
+    Returns:
+        numpy array of strings
+    '''
+
+    unique, inverse = np.unique(times.to_numpy(), return_inverse=True)
+    formatted = pd.DatetimeIndex(unique).strftime(fmt).to_numpy(dtype=object)
+
+    return formatted[inverse.ravel()]
+
+
 def clean_crimes_data(geopandas_dataframe):
 
     crimes = geopandas_dataframe
-    crimes['tipo']='NaN' 
-
-    for i in range(len(crimes)): 
-        if crimes['delito'][i] in crimes_w: 
-            crimes.at[i,'tipo']='walking' 
-        elif crimes['delito'][i] in crimes_pt: 
-            crimes.at[i,'tipo']='public transport'
-        elif crimes['delito'][i] in crimes_v: 
-            crimes.at[i,'tipo']='personal vehicle'
-        elif crimes['delito'][i] in homicides:
-            crimes.at[i,'tipo']='homicide'
-        elif crimes['delito'][i] in rape:
-            crimes.at[i,'tipo']='rape'
-
-
-    crimes.drop(crimes[crimes.tipo == 'NaN'].index, inplace = True)
+    crimes['tipo'] = categorize(crimes['delito'])
+
+    crimes.drop(crimes.index[crimes['tipo'].isna()], inplace = True)
     crimes.dropna(subset=["geometry"], inplace=True)
-    crimes.dropna()
-
-    aux = crimes['fecha_hechos'].str.split(" ", n = 1, expand = True) 
-    crimes['date']= aux[0] 
-    crimes['time']= aux[1]
-    crimes['hour']= crimes['time'].str.split(":", n = 1, expand = True)[0]
-    crimes['hour'] = pd.to_numeric(crimes["hour"]) 
-    crimes['date']= pd.to_datetime(crimes['date'])
-    crimes['weekday'] = pd.to_datetime(crimes['date']).apply(lambda x: datetime.strftime(x, '%A'))
+
+    when = pd.to_datetime(crimes['fecha_hechos'])
+    day = when.dt.normalize()
+    crimes['date'] = format_unique(day, '%Y-%m-%d')
+    crimes['time'] = format_unique(pd.Timestamp(0) + (when - day), '%H:%M:%S')
+    crimes['hour'] = when.dt.hour
+    crimes['weekday'] = when.dt.day_name()
     crimes.drop(columns=['fecha_hechos','categoria_delito'], inplace = True)
-    crimes['date'] = crimes['date'].astype('str')
@@ -4,10 +4,15 @@ File: Get_data.py
 -Obtains the crime data and police districts(cuadrantes)
 from datos.cdmx.gob.mx (Mexico City Open Data)
 
-Creates 2 files:
+Creates these files:
     -geojson file of police districts
+    -topojson files of police districts, simplified for each zoom level of
+     the maps (see topology.LEVELS)
     -.sqlite3 database with 2 tables. One of crime data (clean) merged with 
-     precinct data (table:crimes) and the second of police stations
+     precinct data (table:crimes, see crime_db) and the second of police
+     stations
+    -columnar snapshot of the crime table, memory mapped by the app (see
+     crime_columns), on full downloads only
 
 Note: We only use crime data of 2018 and 2019
 '''
@@ -15,7 +20,17 @@ Note: We only use crime data of 2018 and 2019
 import requests
 import csv
 import os
+import re
+import sys
+import json
+import codecs
+from urllib.parse import urlencode, quote
 import data_cleaning
+import crime_db
+import crime_columns
+import precincts
+import topology
+import pandas as pd
 import geopandas as gpd
 from shapely.geometry import shape, Polygon
 import sqlite3
@@ -35,39 +50,383 @@ url_crimes = "https://datos.cdmx.gob.mx/api/v2/catalog/datasets/carpetas-de-"+\
 url_police_station = "https://datos.cdmx.gob.mx/api/v2/catalog/datasets/ubicacion-de-ministerios-publicos"+\
         "/exports/geojson?rows=-1&timezone=UTC&pretty=false"
 
-def go():
+CRIMES_SELECT = ("delito, ao_hechos, fecha_hechos, categoria_delito, "
+                 "colonia_hechos, alcaldia_hechos, longitud, latitud, geopoint")
+DATABASE = 'data/CrimesDB.sqlite3'
+
+# features of the crime export cleaned and inserted at a time
+BATCH_SIZE = 50000
+CHUNK_SIZE = 1024 * 1024
+# text kept while parsing the crime export: a feature (or the header before
+# the features) larger than this is not a crime of the export
+MAX_BUFFER = 64 * 1024 * 1024
+# (connect, read) seconds of the requests to the portal
+TIMEOUT = (10, 120)
+SPACES = re.compile(r'[\s,]*')
+
+
+def go(crimes_source=url_crimes, cuad_source=url_cuad,
+       police_source=url_police_station):
     '''
     Gets crime data and police district data from Mexico City Portal API,
     merges the two dataframes and creates an .sqlite3 database.
     Also a geojson file is created with the police district data polygons.
+
+    The crime export is streamed: it is read, cleaned, merged and inserted
+    in batches of BATCH_SIZE crimes, so memory does not grow with its size.
+
+    Input:
+        -crimes_source: (str) url or path of a local geojson file with the
+         crime export
+        -cuad_source: (str) url or path of a local geojson file with the
+         police precincts
+        -police_source: (str) url or path of a local geojson file with the
+         police stations
     '''
 
-    crimes = api_to_gpd(url_crimes)
-    cuad = api_to_gpd(url_cuad)
-    police = api_to_gpd(url_police_station)
+    cuad = api_to_gpd(cuad_source)
+    police = api_to_gpd(police_source)
     cuad["id"] = cuad.index
-    data_cleaning.clean_crimes_data(crimes)
-    crimes_merge = spacial_join(crimes, cuad)
-    data_to_sql(crimes_merge, police, 'data/CrimesDB.sqlite3')
+    stream_crimes_to_sql(crimes_source, cuad, DATABASE)
+    police_to_sql(police, DATABASE)
     data_to_csv(cuad, 'data/cuadrantes.geojson')
+    data_to_topojson(cuad, 'data/cuadrantes')
+    crime_columns.write_snapshot(DATABASE)
+
+
+def update(crimes_source=None):
+    '''
+    Adds to the database the crimes from the latest one it has (its
+    high-water mark) on, instead of downloading everything again. The ones
+    at the mark that it already has are skipped. The police
+    precincts are the ones of data/cuadrantes.geojson, and the police
+    stations are not updated.
+
+    Crimes reported late, with a date before the high-water mark, are only
+    added by a full download (go).
+
+    The columnar snapshot is not written again: rewriting every row for a
+    few new crimes would make each update as slow as a full download. The
+    queries read the database while the snapshot is older than it, until
+    python3 crime_columns.py rewrites it (e.g. once after a day of
+    updates).
+
+    Input:
+        -crimes_source: (str) url or path of a local geojson file with the
+         crime export, by default the crimes from the high-water mark on
+         from the portal
+    Return:
+        -number of crimes added
+    '''
+
+    since = get_high_water_mark(DATABASE)
+    if crimes_source is None:
+        crimes_source = crimes_url(since)
+
+    added = update_crimes_to_sql(crimes_source, precincts.get_cuadrantes(),
+                                 DATABASE, since)
+
+    return added
 
 
 def api_to_gpd(url):
     '''
     Conects to API and returns data as geopandas dataframe
     Inputs:
-        url: (str) url to connect to the API
+        url: (str) url to connect to the API, or path of a local geojson
+         file
     Outputs:
         data (geopandas dataframe)
     '''
 
-    r = requests.get(url)
+    if not url.startswith(('http://', 'https://')):
+        return gpd.read_file(url)
+
+    r = requests.get(url, timeout=TIMEOUT)
     r.raise_for_status()
     data = gpd.read_file(r.text)
 
     return data
 
 
+def read_chunks(source):
+    '''
+    Reads a url or a local file as an iterator of text chunks.
+
+    Input:
+        -source: (str) url or path of the file
+    '''
+
+    if source.startswith(('http://', 'https://')):
+        r = requests.get(source, stream=True, timeout=TIMEOUT)
+        r.raise_for_status()
+        decoder = codecs.getincrementaldecoder('utf-8')()
+        for chunk in r.iter_content(chunk_size=CHUNK_SIZE):
+            yield decoder.decode(chunk)
+        yield decoder.decode(b'', final=True)
+    else:
+        with open(source, encoding='utf-8') as f:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), ''):
+                yield chunk
+
+
+def iter_features(chunks, max_buffer=MAX_BUFFER):
+    '''
+    Parses the features of a geojson FeatureCollection one at a time from
+    an iterator of text chunks, keeping in memory only the chunk that is
+    being parsed.
+
+    Input:
+        -chunks: iterator of str
+        -max_buffer: (int) maximum number of characters kept, raises
+         ValueError if a feature does not fit in them
+    Returns:
+        -iterator of features (dictionaries)
+    '''
+
+    decoder = json.JSONDecoder()
+    chunks = iter(chunks)
+    buffer = ''
+
+    # skip everything up to the opening bracket of the features array
+    while True:
+        start = buffer.find('"features"')
+        if start >= 0 and buffer.find('[', start) >= 0:
+            pos = buffer.find('[', start) + 1
+            break
+        chunk = next(chunks, None)
+        if chunk is None:
+            return
+        buffer += chunk
+        if len(buffer) > max_buffer:
+            raise ValueError('No features array in the first {} characters '
+                             'of the geojson'.format(max_buffer))
+
+    while True:
+        pos = SPACES.match(buffer, pos).end()
+        if buffer.startswith(']', pos):
+            return
+
+        try:
+            feature, pos = decoder.raw_decode(buffer, pos)
+        except ValueError:
+            # the feature continues in the next chunk
+            chunk = next(chunks, None)
+            if chunk is None:
+                raise ValueError('The geojson ends in the middle of a feature')
+            buffer = buffer[pos:] + chunk
+            pos = 0
+            if len(buffer) > max_buffer:
+                raise ValueError('A feature of the geojson is longer than {} '
+                                 'characters'.format(max_buffer))
+            continue
+
+        yield feature
+
+
+def iter_batches(items, size):
+    '''
+    Groups an iterator in lists of at most size items.
+    '''
+
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+
+    if batch:
+        yield batch
+
+
+def nested_to_json(feature):
+    '''
+    Writes the nested properties of a feature (e.g. geopoint) as json
+    strings, as geopandas.read_file does, so they can go to the database.
+    '''
+
+    properties = feature['properties']
+    for key, value in properties.items():
+        if isinstance(value, (dict, list)):
+            properties[key] = json.dumps(value)
+
+    return feature
+
+
+def merged_batches(source, cuad_data, batch_size=BATCH_SIZE):
+    '''
+    Reads the crime export in batches of features, and cleans and merges
+    each batch with the precinct data.
+
+    Input:
+        -source: (str) url or path of a local geojson file
+        -cuad_data: (geopandas dataframe) police precinct data
+        -batch_size: (int) number of features per batch
+    Returns:
+        -iterator of merged geopandas dataframes
+    '''
+
+    features = map(nested_to_json, iter_features(read_chunks(source)))
+    for batch in iter_batches(features, batch_size):
+        crimes = gpd.GeoDataFrame.from_features(batch, crs=cuad_data.crs)
+        data_cleaning.clean_crimes_data(crimes)
+        yield spacial_join(crimes, cuad_data)
+
+
+def write_batches(batches, conn, columns=None, since=None):
+    '''
+    Appends the merged batches of crimes to the crime_new table.
+
+    Input:
+        -batches: iterator of merged geopandas dataframes
+        -conn: sqlite3 connection
+        -columns: (list) columns of the table, by default the ones of the
+         first batch
+        -since: (str) high-water mark 'YYYY-MM-DD HH:MM:SS', only the crimes
+         from it on are written (see crime_db.drop_stored for the ones at
+         the mark)
+    Return:
+        -(number of crimes written, high-water mark of the crimes written)
+    '''
+
+    conn.execute('DROP TABLE IF EXISTS crime_new')
+
+    total = 0
+    high_water_mark = since
+    for crimes in batches:
+        when = crimes['date'] + ' ' + crimes['time']
+        if since is not None:
+            crimes = crimes[when >= since]
+            when = when[when >= since]
+        if crimes.empty:
+            continue
+
+        # every batch is written with the same columns
+        if columns is None:
+            columns = list(crimes.columns)
+        crimes = crimes.reindex(columns=columns)
+        crimes.to_sql('crime_new', conn, if_exists='append', index=False)
+
+        total += len(crimes)
+        if high_water_mark is None or when.max() > high_water_mark:
+            high_water_mark = when.max()
+
+    return total, high_water_mark
+
+
+def stream_crimes_to_sql(source, cuad_data, filename, batch_size=BATCH_SIZE):
+    '''
+    Reads the crime export in batches of features and, for each one, cleans
+    it, merges it with the precinct data and appends it to the crime table
+    of the database. The new table replaces the old one only once all the
+    crimes are in, so the app never sees a partial table. The counts of
+    crime_counts and the high-water mark are rebuilt with it (see
+    crime_db).
+
+    Input:
+        -source: (str) url or path of a local geojson file
+        -cuad_data: (geopandas dataframe) police precinct data
+        -filename: filename for the database
+        -batch_size: (int) number of features per batch
+    Return:
+        -number of crimes inserted
+    '''
+
+    path = os.path.join(os.getcwd(), filename)
+    conn = sqlite3.connect(path)
+
+    batches = merged_batches(source, cuad_data, batch_size)
+    total, high_water_mark = write_batches(batches, conn)
+    if not total:
+        conn.close()
+        raise ValueError('No crimes found in {}'.format(source))
+
+    with conn:
+        crime_db.create_schema(conn)
+        crime_db.load_staging(conn, 'crime_new', high_water_mark)
+        conn.execute('DROP TABLE crime_new')
+    # reclaim the space of the previous tables
+    conn.execute('VACUUM')
+    conn.close()
+
+    return total
+
+
+def update_crimes_to_sql(source, cuad_data, filename, since,
+                         batch_size=BATCH_SIZE):
+    '''
+    Appends to the crime table the crimes of the export from the
+    high-water mark on that it does not have yet, and adds them to the
+    counts of crime_counts. The rows
+    already in the database are not read again, so the time of an update
+    depends on the number of new crimes only.
+
+    Input:
+        -source: (str) url or path of a local geojson file
+        -cuad_data: (geopandas dataframe) police precinct data
+        -filename: filename for the database
+        -since: (str) high-water mark 'YYYY-MM-DD HH:MM:SS'
+        -batch_size: (int) number of features per batch
+    Return:
+        -number of crimes inserted
+    '''
+
+    path = os.path.join(os.getcwd(), filename)
+    conn = sqlite3.connect(path)
+
+    batches = merged_batches(source, cuad_data, batch_size)
+    total, high_water_mark = write_batches(batches, conn, since=since)
+
+    with conn:
+        if total:
+            total -= crime_db.drop_stored(conn, 'crime_new', since)
+        if total:
+            crime_db.load_staging(conn, 'crime_new', high_water_mark)
+        conn.execute('DROP TABLE IF EXISTS crime_new')
+    conn.close()
+
+    return total
+
+
+def get_high_water_mark(filename):
+    '''
+    Date and time ('YYYY-MM-DD HH:MM:SS') of the latest crime in the
+    database. Databases in the pandas to_sql layout are migrated first (see
+    crime_db).
+    '''
+
+    path = os.path.join(os.getcwd(), filename)
+    conn = sqlite3.connect(path)
+    tables = {row[0] for row in conn.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table'")}
+    conn.close()
+    if 'crime' not in tables:
+        raise ValueError('No crime table in {}, run a full download '
+                         'first'.format(filename))
+
+    crime_db.migrate(path)
+    conn = sqlite3.connect(path)
+    high_water_mark = crime_db.get_meta(conn, 'high_water_mark')
+    conn.close()
+
+    return high_water_mark
+
+
+def crimes_url(since):
+    '''
+    Url of the export of the crimes from a date and time on
+    ('YYYY-MM-DD HH:MM:SS').
+    '''
+
+    where = ("categoria_delito != 'HECHO NO DELICTIVO' AND "
+             "fecha_hechos >= date'{}'".format(since.replace(' ', 'T')))
+    query = urlencode({'where': where, 'rows': -1, 'select': CRIMES_SELECT,
+                       'timezone': 'UTC', 'delimiter': ','}, quote_via=quote)
+
+    return url_crimes.split('?')[0] + '?' + query
+
+
 def spacial_join(crime_data, cuad_data):
     '''
     Merges the crime_data with the precinct data according to their location.
@@ -81,9 +440,18 @@ def spacial_join(crime_data, cuad_data):
         -merge (geopandas dataframe) merged data
     '''
 
-    merge = gpd.sjoin(crime_data, cuad_data, how="inner", op="intersects")
+    try:
+        merge = gpd.sjoin(crime_data, cuad_data, how="inner",
+                          predicate="intersects")
+    except TypeError:
+        # geopandas before 0.10 (the pinned 0.7) names the argument op
+        merge = gpd.sjoin(crime_data, cuad_data, how="inner", op="intersects")
     merge.index = range(len(merge))
-    merge['geometry'] = merge['geometry'].astype('str')
+    # the locations go to the database as strings, which a GeoDataFrame
+    # does not take as its geometry column
+    geometry = merge['geometry'].astype('str')
+    merge = pd.DataFrame(merge.drop(columns='geometry'))
+    merge['geometry'] = geometry
     merge['geo_point_2d'] = merge['geo_point_2d'].astype('str')
 
     return merge
@@ -99,11 +467,31 @@ def data_to_sql(crime_data, police_stations, filename):
         -filename: filename for the database
     '''
 
+    path = os.path.join(os.getcwd(), filename)
+    conn = sqlite3.connect(path)
+    crime_data.to_sql('crime_new', conn, if_exists='replace', index = False)
+    high_water_mark = (crime_data['date'] + ' ' + crime_data['time']).max()
+    with conn:
+        crime_db.create_schema(conn)
+        crime_db.load_staging(conn, 'crime_new', high_water_mark)
+        conn.execute('DROP TABLE crime_new')
+    conn.close()
+    police_to_sql(police_stations, filename)
+
+
+def police_to_sql(police_stations, filename):
+    '''
+    Writes the police stations to the police_station table of the database.
+
+    Input:
+        -police_stations: geopandas datafrane
+        -filename: filename for the database
+    '''
+
     police = police_stations.drop(columns=['geometry'])
 
     path = os.path.join(os.getcwd(), filename)
     conn = sqlite3.connect(path)
-    crime_data.to_sql('crime', conn, if_exists='replace', index = False)
     police.to_sql('police_station', conn, if_exists='replace', index = False)
     conn.close()
 
@@ -116,5 +504,26 @@ def data_to_csv(cuad_data, filename):
     cuad_data.to_file(filename, driver='GeoJSON')
 
 
+def data_to_topojson(cuad_data, prefix):
+    '''
+    Simplifies the police districts at each level of topology.LEVELS and
+    writes them as quantized topojson, one file per level.
+
+    Input:
+        -cuad_data: geopandas dataframe of police districts
+        -prefix: filename prefix, the level is added as _z<min zoom>.topojson
+    '''
+
+    for min_zoom, tolerance in topology.LEVELS:
+        topo = topology.to_topology(cuad_data, tolerance)
+        topology.write_topology(topo, '{}_z{}.topojson'.format(prefix, min_zoom))
+
+
 if __name__ == "__main__":
-    go()
+    # --update adds only the new crimes. Optionally, a local geojson file
+    # with the crime export can be given instead of the download
+    args = sys.argv[1:]
+    if args[:1] == ['--update']:
+        print(update(*args[1:2]), 'crimes added')
+    else:
+        go(*args[:1])
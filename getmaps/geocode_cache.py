@@ -0,0 +1,243 @@
+'''
+CAPP 30122 W'20: Final Poject
+
+This module caches the results of the geocoding of the addresses
+introduced by the users, so popular addresses are not sent to the
+Google Geocoding API again.
+
+The cache has two tiers: a least recently used dictionary in the memory of
+the process, and a sqlite3 database (data/geocode_cache.sqlite3) shared by
+all the worker processes and kept between runs, where the results expire
+after a while. The key of an address is its normalized text (see
+normalize_address), and the result stored is the location and the
+precinct it falls into.
+'''
+
+import os
+import re
+import time
+import sqlite3
+import threading
+import unicodedata
+from collections import OrderedDict
+
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'data')
+CACHE_FILENAME = os.path.join(DATA_DIR, 'geocode_cache.sqlite3')
+MAX_MEMORY_ENTRIES = 10000
+# seconds a result is kept; addresses that were not found are asked again
+# sooner, in case the API learns them
+TTL = 30 * 24 * 3600
+NOT_FOUND_TTL = 24 * 3600
+
+# whole words replaced before looking up an address
+ABBREVIATIONS = {
+    'av': 'avenida', 'ave': 'avenida', 'avda': 'avenida',
+    'blvd': 'bulevar', 'calz': 'calzada', 'cjon': 'callejon',
+    'prol': 'prolongacion', 'priv': 'privada', 'cda': 'cerrada',
+    'col': 'colonia', 'fracc': 'fraccionamiento', 'esq': 'esquina',
+    'no': 'numero', 'num': 'numero', 'gral': 'general', 'lic': 'licenciado',
+    'ing': 'ingeniero', 'dr': 'doctor', 'sta': 'santa', 'sto': 'santo',
+    'cp': 'codigo postal', 'alc': 'alcaldia',
+    'cdmx': 'ciudad de mexico', 'mx': 'mexico',
+}
+NOT_WORD = re.compile(r'[^a-z0-9#]+')
+
+_CACHE = None
+_LOCK = threading.Lock()
+
+
+def normalize_address(address):
+    '''
+    Normalized text of an address: lowercase, without accents or
+    punctuation, with single spaces and with common abbreviations expanded.
+    e.g. 'Av. Insurgentes  Sur 339, Col. Hipódromo' ->
+    'avenida insurgentes sur 339 colonia hipodromo'
+    Input:
+        address (str)
+    Output:
+        str
+    '''
+
+    text = unicodedata.normalize('NFKD', address)
+    text = ''.join(c for c in text if not unicodedata.combining(c)).lower()
+    words = NOT_WORD.sub(' ', text).split()
+
+    return ' '.join(ABBREVIATIONS.get(word, word) for word in words)
+
+
+class GeocodeCache:
+    '''
+    Two tier cache of geocoding results (memory and sqlite3), keyed by
+    normalized address. A result is a tuple (lat, lon, precinct_id), or
+    None for addresses that were not found.
+    '''
+
+    def __init__(self, filename=CACHE_FILENAME,
+                 max_entries=MAX_MEMORY_ENTRIES):
+        '''
+        Inputs:
+            filename (str): path of the sqlite3 database, None to only
+                keep the results in memory
+            max_entries (int): size of the memory tier
+        '''
+
+        self.filename = filename
+        self.max_entries = max_entries
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.stats = {'memory_hits': 0, 'disk_hits': 0, 'misses': 0}
+
+    def connection(self):
+        '''
+        sqlite3 connection of the current thread, None if there is no
+        database.
+        '''
+
+        if self.filename is None:
+            return None
+
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            try:
+                os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+                conn = sqlite3.connect(self.filename, timeout=5)
+                conn.execute('PRAGMA journal_mode = WAL')
+                conn.execute('CREATE TABLE IF NOT EXISTS geocode '
+                             '(address TEXT PRIMARY KEY, found INTEGER, '
+                             'lat REAL, lon REAL, precinct INTEGER, '
+                             'version TEXT, expires REAL)')
+            except (OSError, sqlite3.Error):
+                # a read-only data folder: keep the memory tier only
+                self.filename = None
+                return None
+            self.local.conn = conn
+
+        return conn
+
+    def get(self, address):
+        '''
+        Cached result of an address.
+        Input:
+            address (str): normalized address
+        Output:
+            (found, result, version): found is False if the address is not
+            in the cache, result is (lat, lon, precinct_id) or None, and
+            version is the version of the precincts given to put
+        '''
+
+        now = time.time()
+        with self.lock:
+            entry = self.memory.get(address)
+            if entry is not None and entry[2] > now:
+                self.memory.move_to_end(address)
+                self.stats['memory_hits'] += 1
+                return True, entry[0], entry[1]
+
+        entry = self.disk_get(address, now)
+        if entry is None:
+            with self.lock:
+                self.stats['misses'] += 1
+            return False, None, None
+
+        self.memory_put(address, entry)
+        with self.lock:
+            self.stats['disk_hits'] += 1
+
+        return True, entry[0], entry[1]
+
+    def put(self, address, result, version):
+        '''
+        Stores the result of an address.
+        Inputs:
+            address (str): normalized address
+            result: (lat, lon, precinct_id) or None if it was not found.
+                precinct_id is None for locations outside Mexico City
+            version (str): version of the precincts precinct_id comes from
+        '''
+
+        ttl = TTL if result is not None else NOT_FOUND_TTL
+        entry = (result, version, time.time() + ttl)
+        self.memory_put(address, entry)
+
+        conn = self.connection()
+        if conn is None:
+            return
+
+        lat, lon, precinct = result if result is not None else (None,) * 3
+        try:
+            with conn:
+                conn.execute('INSERT OR REPLACE INTO geocode VALUES '
+                             '(?, ?, ?, ?, ?, ?, ?)',
+                             (address, result is not None, lat, lon,
+                              precinct, version, entry[2]))
+        except sqlite3.Error:
+            # the memory tier still works without the database
+            pass
+
+    def memory_put(self, address, entry):
+        '''
+        Keeps an entry (result, version, expiration time) in memory,
+        evicting the least recently used ones above max_entries.
+        '''
+
+        with self.lock:
+            self.memory[address] = entry
+            self.memory.move_to_end(address)
+            while len(self.memory) > self.max_entries:
+                self.memory.popitem(last=False)
+
+    def disk_get(self, address, now):
+        '''
+        Entry (result, version, expiration time) of an address in the
+        database, None if it is not there or it expired.
+        '''
+
+        conn = self.connection()
+        if conn is None:
+            return None
+
+        try:
+            row = conn.execute('SELECT found, lat, lon, precinct, version, '
+                               'expires FROM geocode WHERE address = ?',
+                               (address,)).fetchone()
+        except sqlite3.Error:
+            return None
+
+        if row is None or row[5] <= now:
+            return None
+
+        found, lat, lon, precinct, version, expires = row
+        result = (lat, lon, precinct) if found else None
+
+        return (result, version, expires)
+
+    def clear(self):
+        '''
+        Removes every entry of both tiers.
+        '''
+
+        with self.lock:
+            self.memory.clear()
+
+        conn = self.connection()
+        if conn is not None:
+            with conn:
+                conn.execute('DELETE FROM geocode')
+
+
+def get_cache():
+    '''
+    Returns the geocoding cache of the process, creating it on first use.
+    '''
+
+    global _CACHE
+
+    if _CACHE is None:
+        with _LOCK:
+            if _CACHE is None:
+                _CACHE = GeocodeCache()
+
+    return _CACHE
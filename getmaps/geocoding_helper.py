@@ -1,13 +1,133 @@
-import requests
-import csv
-import os
-import pandas as pd
-import geopandas as gpd
-from shapely.geometry import Point, Polygon
+import time
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import precincts
+import timing
+from . import geocode_cache
+from .geocode_cache import normalize_address
+
+# shapely, rtree and requests are imported on first use (see
+# getmaps.startup), as are the precincts
+GEOCODE_URL = "https://maps.googleapis.com/maps/api/geocode/json"
+API_KEY = "YOURKEY"
+# (connect, read) seconds
+TIMEOUT = (3.05, 5)
+RETRIES = 2
+BACKOFF = 0.2
+MAX_CONCURRENT = 8
+TRANSIENT_STATUS = ('OVER_QUERY_LIMIT', 'UNKNOWN_ERROR')
+
+_LOCATOR = None
+_CLIENT = None
+_LOCK = threading.Lock()
+
+
+class PrecinctLocator:
+    '''
+    Finds the precinct that contains a point. An R-tree over the bounding
+    boxes of the precincts gives the few candidates for each point, which
+    are then tested with prepared geometries.
+    '''
+
+    def __init__(self, precincts):
+        '''
+        Input:
+            -precincts: (geopandas dataframe) precincts information
+        '''
+        from rtree import index
+        from shapely.prepared import prep
+
+        self.precincts = precincts
+        self.ids = list(precincts.id)
+        # the raw geometries for locate_many, prepared ones for locate
+        self.shapes = list(precincts.geometry)
+        self.geometries = [prep(geom) for geom in self.shapes]
+        self.bounds = [geom.bounds for geom in precincts.geometry]
+        self.tree = index.Index((i, geom.bounds, None) for i, geom
+                                in enumerate(precincts.geometry))
+
+    def locate(self, latitude, longitude):
+        '''
+        Returns the id of the precinct that contains the point or None
+        if the point is not in Mexico City.
+        '''
+        from shapely.geometry import Point
+
+        point = Point(longitude, latitude)
+        bounds = (longitude, latitude, longitude, latitude)
+
+        # sorted so that overlapping precincts resolve as in the linear scan
+        for i in sorted(self.tree.intersection(bounds)):
+            if self.geometries[i].contains(point):
+                return self.ids[i]
+
+        return None
+
+    def locate_many(self, latitudes, longitudes):
+        '''
+        Vectorized version of locate. The points are sorted by longitude
+        once, so the candidates of each precinct are a slice of them, which
+        is tested with shapely.contains_xy.
+
+        Input:
+            -latitudes: (array) latitudes of the points
+            -longitudes: (array) longitudes of the points
+        Returns:
+            -numpy array with the id of the precinct of each point,
+             -1 for points that are not in Mexico City
+        '''
+        try:
+            from shapely import contains_xy
+        except ImportError:
+            # Shapely < 2.0
+            from shapely.vectorized import contains as contains_xy
+
+        latitudes = np.asarray(latitudes, dtype=float)
+        longitudes = np.asarray(longitudes, dtype=float)
+        ids = np.full(len(latitudes), -1, dtype=np.int64)
+
+        order = np.argsort(longitudes, kind='mergesort')
+        sorted_longitudes = longitudes[order]
+
+        # in order, so that overlapping precincts resolve as in locate
+        for i, (minx, miny, maxx, maxy) in enumerate(self.bounds):
+            start = np.searchsorted(sorted_longitudes, minx, side='left')
+            end = np.searchsorted(sorted_longitudes, maxx, side='right')
+            if start == end:
+                continue
+
+            candidates = order[start:end]
+            candidates = candidates[(ids[candidates] == -1) &
+                                    (latitudes[candidates] >= miny) &
+                                    (latitudes[candidates] <= maxy)]
+            if len(candidates) == 0:
+                continue
+
+            inside = contains_xy(self.shapes[i], longitudes[candidates],
+                                 latitudes[candidates])
+            ids[candidates[inside]] = self.ids[i]
+
+        return ids
+
+
+def get_locator():
+    '''
+    Returns the precinct locator over the precincts of the process (see
+    precincts.get_cuadrantes), building it on first use and again when the
+    precincts change.
+    '''
+    global _LOCATOR
+
+    cuadrantes = precincts.get_cuadrantes()
+    if _LOCATOR is None or _LOCATOR.precincts is not cuadrantes:
+        with _LOCK:
+            if _LOCATOR is None or _LOCATOR.precincts is not cuadrantes:
+                _LOCATOR = PrecinctLocator(cuadrantes)
+
+    return _LOCATOR
 
-FILE_DIR = os.path.join(os.path.dirname(__file__), './../data/cuadrantes.geojson')
-CUAD = gpd.read_file(FILE_DIR)
-CUAD["id"] = CUAD.index
 
 def get_precinct(precincts, latitude, longitude):
     '''
@@ -21,44 +141,277 @@ def get_precinct(precincts, latitude, longitude):
     Returns:
         -id number of the precint or None if the point is not in Mexico City
     '''
+    locator = get_locator()
+    if precincts is locator.precincts:
+        return locator.locate(latitude, longitude)
+
+    return scan_precinct(precincts, latitude, longitude)
+
+
+def scan_precinct(precincts, latitude, longitude):
+    '''
+    Same as get_precinct, testing every precinct in order. Used for
+    precinct dataframes other than the ones of the process and as the
+    benchmark reference.
+    '''
+    from shapely.geometry import Point
+
     point = Point(longitude, latitude)
-    
+
     for row in precincts.itertuples():
         if row.geometry.contains(point):
             return row.id
 
     return None
 
-def geo_code(address):
+
+class GeocodingError(Exception):
     '''
-    Computes the geo code (longitude and latitude) from a given address
+    The geocoding API could not answer. Unlike addresses that are not
+    found, these errors are not cached.
+    '''
+
+
+class TransientGeocodingError(GeocodingError):
+    '''
+    An error of the geocoding API that may not happen again (timeouts,
+    overloaded server or quota), so the request is retried.
+    '''
+
+
+class GeocodingClient:
+    '''
+    Client of the Google Geocoding API. It keeps a pool of keep-alive
+    connections, gives up on requests that take longer than its timeouts,
+    retries transient errors with exponential backoff, and sends at most
+    max_concurrent requests at a time, so a slow API can't tie up every
+    worker of the server.
+    '''
+
+    def __init__(self, url=GEOCODE_URL, key=API_KEY, timeout=TIMEOUT,
+                 retries=RETRIES, backoff=BACKOFF,
+                 max_concurrent=MAX_CONCURRENT):
+        '''
+        Inputs:
+            -url (str): url of the API (e.g. a local stand-in for tests)
+            -key (str): API key
+            -timeout (tuple): (connect, read) timeouts in seconds
+            -retries (int): number of retries of transient errors
+            -backoff (float): seconds before the first retry, doubled after
+             every retry
+            -max_concurrent (int): maximum number of requests at a time
+        '''
+        import requests
+
+        self.url = url
+        self.key = key
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.semaphore = threading.BoundedSemaphore(max_concurrent)
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                                pool_maxsize=max_concurrent)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def __call__(self, address):
+        '''
+        Computes the geo code (latitude and longitude) from a given address.
+
+        Input:
+            -address (str): address to request the geocode
+        Returns:
+            -(lat, lon) or None if the address was not found
+        Raises GeocodingError if the API did not answer after the retries.
+        '''
+        for attempt in range(self.retries + 1):
+            try:
+                return self.request(address)
+            except TransientGeocodingError as error:
+                last_error = error
+            if attempt < self.retries:
+                # random jitter, so retries of many clients don't line up
+                time.sleep(self.backoff * 2 ** attempt *
+                           random.uniform(0.5, 1.5))
+
+        raise last_error
+
+    def request(self, address):
+        '''
+        One request to the API, see __call__.
+        '''
+        import requests
+
+        try:
+            with self.semaphore:
+                r = self.session.get(self.url, timeout=self.timeout,
+                                     params={'address': address,
+                                             'key': self.key})
+        except (requests.ConnectionError, requests.Timeout) as error:
+            raise TransientGeocodingError(str(error)) from error
+        except requests.RequestException as error:
+            raise GeocodingError(str(error)) from error
+
+        if r.status_code == 429 or r.status_code >= 500:
+            raise TransientGeocodingError('HTTP {}'.format(r.status_code))
+        if r.status_code != 200:
+            raise GeocodingError('HTTP {}'.format(r.status_code))
+
+        try:
+            data = r.json()
+        except ValueError as error:
+            raise TransientGeocodingError('Invalid response') from error
+
+        if data['status'] == 'OK':
+            dic = data['results'][0]['geometry']['location']
+            return (dic['lat'], dic['lng'])
+
+        if data['status'] == 'ZERO_RESULTS':
+            return None
+
+        if data['status'] in TRANSIENT_STATUS:
+            raise TransientGeocodingError(data['status'])
+
+        raise GeocodingError(data['status'])
+
+
+def get_client():
+    '''
+    Returns the geocoding client of the process, creating it on first use.
+    '''
+    global _CLIENT
+
+    if _CLIENT is None:
+        with _LOCK:
+            if _CLIENT is None:
+                _CLIENT = GeocodingClient()
+
+    return _CLIENT
+
+
+def google_geocode(address):
+    '''
+    Computes the geo code (latitude and longitude) from a given address
     through the Google Geocoding API
-    
+
     Input:
         -address (str): address to request the geocode
+    Returns:
+        -(lat, lon) or None if the address was not found
+    '''
+
+    return get_client()(address)
+
+
+class StubGeocoder:
+    '''
+    Geocoder that answers from a dictionary instead of the API, to run
+    without network or API key (e.g. in tests). Use it with
+    geo_code(address, geocoder=StubGeocoder({...})) or by setting GEOCODER.
+    '''
+
+    def __init__(self, locations):
+        '''
+        Input:
+            -locations (dictionary): address -> (lat, lon). Addresses are
+             matched after normalization
+        '''
+        self.locations = {normalize_address(address): tuple(location)
+                          for address, location in locations.items()}
+        self.calls = 0
+
+    def __call__(self, address):
+        self.calls += 1
+        return self.locations.get(normalize_address(address))
+
+
+GEOCODER = google_geocode
+
+
+def geo_code(address, geocoder=None, cache=None):
+    '''
+    Computes the geo code (longitude and latitude) from a given address
+    through the Google Geocoding API (or another geocoder), and the
+    precinct it falls into.
+
+    Results are cached by normalized address (see geocode_cache). A cached
+    location whose precinct was computed with other precincts gets its
+    precinct computed again, without asking the API.
+
+    Input:
+        -address (str): address to request the geocode
+        -geocoder (function): address -> (lat, lon) or None, by default
+         GEOCODER
+        -cache (GeocodeCache): by default the one of the process
 
     Returns:
-        -a tuple: ((lat, lon), precinct_id)
+        -a tuple: (lat, lon, precinct_id)
             *lat, lon: The geocode of address
             *precinct_id: the id of the precinct in which the point falls
         
         If the point is not in Mexico City returns None
 
+    Raises GeocodingError if the geocoder could not answer, so the address
+    is not taken for one outside Mexico City (nothing is cached).
     '''
 
-    url = "https://maps.googleapis.com/maps/api/geocode/json?address={}".format(address)
-    url = url + "&key=YOURKEY"
+    geocoder = geocoder or GEOCODER
+    cache = cache or geocode_cache.get_cache()
+    key = normalize_address(address)
+    version = precincts.geojson_etag()
 
-    r = requests.get(url)
-    data = r.json()
+    with timing.stage('geocode_cache'):
+        found, result, cached_version = cache.get(key)
+    if not found:
+        with timing.stage('geocoding_api'):
+            location = geocoder(address)
+        if location is not None:
+            result = (float(location[0]), float(location[1]), None)
 
-    if data['status'] == 'OK':
-        dic = r.json()['results'][0]['geometry']['location']
-        lat = dic['lat']
-        lon = dic['lng']
+    if result is not None and (not found or cached_version != version):
+        with timing.stage('get_precinct'):
+            precinct_id = get_locator().locate(result[0], result[1])
+        if precinct_id is not None:
+            precinct_id = int(precinct_id)
+        result = (result[0], result[1], precinct_id)
+        cache.put(key, result, version)
+    elif not found:
+        cache.put(key, None, version)
 
-        precinct_id = get_precinct(CUAD, lat, lon)
-        if precinct_id:
-            return (lat,lon, precinct_id)
-    
-    return None
+    if result is None or result[2] is None:
+        return None
+
+    return result
+
+
+def geo_code_many(addresses, geocoder=None, cache=None,
+                  max_workers=MAX_CONCURRENT):
+    '''
+    geo_code of many addresses, resolved concurrently. Addresses that are
+    the same after normalization are geocoded once.
+
+    Input:
+        -addresses (list of str)
+        -geocoder, cache: see geo_code
+        -max_workers (int): number of addresses resolved at a time
+    Returns:
+        -list with the result of geo_code of each address
+    Raises the GeocodingError of the first address the geocoder could not
+    answer.
+    '''
+
+    keys = [normalize_address(address) for address in addresses]
+    unique = {}
+    for key, address in zip(keys, addresses):
+        unique.setdefault(key, address)
+
+    if not unique:
+        return []
+
+    with ThreadPoolExecutor(min(max_workers, len(unique))) as pool:
+        results = pool.map(lambda address: geo_code(address, geocoder, cache),
+                           unique.values())
+        by_key = dict(zip(unique, results))
+
+    return [by_key[key] for key in keys]
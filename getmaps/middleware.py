@@ -0,0 +1,44 @@
+'''
+File name: middleware.py
+
+Times the requests of the web app and their stages (see the timing module)
+
+Calls ---> timing to collect the stages of each request and keep the
+           histograms served by views.metrics
+'''
+import time
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+import timing
+
+
+class TimingMiddleware:
+    '''
+    Times every request: the duration of each of its stages is sent in the
+    Server-Timing header of the response (shown by the network panel of the
+    browser) and added to the histograms of timing. It is disabled, along
+    with the stages, with REQUEST_TIMING = False in settings.
+    '''
+
+    def __init__(self, get_response):
+        if not getattr(settings, 'REQUEST_TIMING', True):
+            timing.ENABLED = False
+            raise MiddlewareNotUsed
+
+        self.get_response = get_response
+
+    def __call__(self, request):
+        begin = time.perf_counter()
+        timing.start()
+        try:
+            response = self.get_response(request)
+        finally:
+            stages = timing.stop()
+        seconds = time.perf_counter() - begin
+
+        match = request.resolver_match
+        view = match.url_name if match and match.url_name else 'other'
+        timing.observe(view, seconds, stages)
+        response['Server-Timing'] = timing.server_timing(stages, seconds)
+
+        return response
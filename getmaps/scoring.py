@@ -0,0 +1,155 @@
+'''
+File name: scoring.py
+
+Scores many locations at once, for services that need the crime counts of
+thousands of points (e.g. the stops of a delivery route). Each point comes
+with its coordinates (no geocoding), a day of the week, an hour range and
+the ways of getting around, as in the form of the site, and gets the
+precinct it falls into, the number of crimes of that precinct and the
+distance to the nearest police station.
+
+Everything is computed for the whole batch with numpy: the precincts with
+PrecinctLocator.locate_many, the counts from the hour prefix sums of the
+crime cube and the police stations with the KD-tree.
+
+Calls ---> get_locator from geocoding_helper for the precincts
+      ---> crime_cube for the number of crimes
+      ---> shortest_distance for the nearest police stations
+'''
+import numpy as np
+import crime_cube
+import shortest_distance
+import timing
+from queries import get_crime_tipos
+from .geocoding_helper import get_locator
+
+CRIME_TYPES = (1, 2, 3)
+MAX_POINTS = 20000
+
+
+class ScoringError(ValueError):
+    '''
+    A batch of points that can't be scored. The message says which point
+    and why.
+    '''
+
+
+def parse_points(points):
+    '''
+    Validates a batch of points and converts it to columns.
+
+    Input:
+        -points (list of dictionaries): lat, lon, day, hour (optional,
+         [first hour, last hour] as in the form, by default [0, 23]) and
+         crime_type (list of 1: walking, 2: public transit, 3: driving)
+    Returns:
+        -dictionary of numpy arrays: lat, lon, day (position in
+         crime_cube.WEEK_DAYS), first and last hour, and types (the crime
+         types of each point as a bit mask)
+    Raises ScoringError if a point is not valid.
+    '''
+    if not isinstance(points, list):
+        raise ScoringError('points must be a list')
+    if len(points) > MAX_POINTS:
+        raise ScoringError('At most {} points per request'.format(MAX_POINTS))
+
+    day_index = {day: i for i, day in enumerate(crime_cube.WEEK_DAYS)}
+    columns = {name: [] for name in ('lat', 'lon', 'day', 'first', 'last',
+                                     'types')}
+
+    for i, point in enumerate(points):
+        try:
+            lat, lon = float(point['lat']), float(point['lon'])
+            day = day_index[point['day']]
+            first, last = point.get('hour', [0, 23])
+            types = set(point['crime_type'])
+        except (AttributeError, KeyError, TypeError, ValueError):
+            raise ScoringError('Point {}: expected lat, lon, day, hour and '
+                               'crime_type'.format(i))
+
+        # bool is a subclass of int, but true is not an hour
+        if not (isinstance(first, int) and isinstance(last, int) and
+                not isinstance(first, bool) and not isinstance(last, bool)
+                and 0 <= first < last <= 23):
+            raise ScoringError('Point {}: the hour range must be two hours '
+                               'between 0 and 23, the first one lower'.format(i))
+        if (not types or not types <= set(CRIME_TYPES) or
+                any(isinstance(t, bool) for t in types)):
+            raise ScoringError('Point {}: crime_type must be a list of '
+                               '{}'.format(i, CRIME_TYPES))
+
+        columns['lat'].append(lat)
+        columns['lon'].append(lon)
+        columns['day'].append(day)
+        columns['first'].append(first)
+        columns['last'].append(last)
+        columns['types'].append(sum(1 << (t - 1) for t in types))
+
+    return {name: np.array(values, dtype=float if name in ('lat', 'lon')
+                           else np.int64)
+            for name, values in columns.items()}
+
+
+def count_crimes(precinct_ids, days, first, last, types):
+    '''
+    Number of crimes of each point, from the crime cube.
+
+    Inputs:
+        -precinct_ids, days, first, last, types (arrays): one element per
+         point, as returned by parse_points (precinct -1 out of Mexico City)
+    Returns:
+        -numpy array with the number of crimes of each point
+    '''
+    cube = crime_cube.get_cube()
+    crimes = np.zeros(len(precinct_ids), dtype=np.int64)
+    inside = (precinct_ids >= 0) & (precinct_ids < cube.n_precincts)
+
+    # one group per combination of crime types (at most 7)
+    for mask in np.unique(types[inside]):
+        tipos = get_crime_tipos([t for t in CRIME_TYPES
+                                 if mask & (1 << (t - 1))])
+        hour_sums = cube.hour_sums[..., cube.tipo_codes(tipos)].sum(axis=3)
+
+        group = np.flatnonzero(inside & (types == mask))
+        p, d = precinct_ids[group], days[group]
+        crimes[group] = (hour_sums[p, d, last[group] + 1] -
+                         hour_sums[p, d, first[group]])
+
+    return crimes
+
+
+def score_points(points):
+    '''
+    Scores a batch of points.
+
+    Input:
+        -points (list of dictionaries): see parse_points
+    Returns:
+        -list with a dictionary per point: precinct (id, None if the point
+         is not in Mexico City), crimes (number of crimes of the precinct at
+         the day, hour range and crime types of the point, None out of
+         Mexico City) and station_km (distance to the nearest police
+         station in km, None if there are none)
+    Raises ScoringError if a point is not valid.
+    '''
+    with timing.stage('parse_points'):
+        columns = parse_points(points)
+    if not points:
+        return []
+
+    with timing.stage('locate_many'):
+        precinct_ids = get_locator().locate_many(columns['lat'],
+                                                 columns['lon'])
+    with timing.stage('count_crimes'):
+        crimes = count_crimes(precinct_ids, columns['day'], columns['first'],
+                              columns['last'], columns['types'])
+    with timing.stage('nearest_station'):
+        _, kilometers = shortest_distance.get_stations().nearest(
+            columns['lat'], columns['lon'])
+
+    return [{'precinct': precinct if precinct >= 0 else None,
+             'crimes': count if precinct >= 0 else None,
+             'station_km': km if km != float('inf') else None}
+            for precinct, count, km in zip(precinct_ids.tolist(),
+                                           crimes.tolist(),
+                                           kilometers[:, 0].tolist())]
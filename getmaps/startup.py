@@ -0,0 +1,139 @@
+'''
+File name: startup.py
+
+Warms up a server process. The modules of the app import pandas,
+geopandas, scipy, matplotlib, seaborn and folium, and load the precincts,
+the crime cube and the rest of their data, on first use, so importing the
+views (and running manage.py commands) takes a fraction of a second. The
+warm up loads all of them before the first request needs them.
+
+It runs in a background thread, started when the WSGI application is
+loaded (see mexcrimes/wsgi.py and WARM_UP in settings), so the process
+answers requests while it runs (loading what they need on the spot).
+Until it is done, the readiness check (/ready) answers 503, so load
+balancers and autoscalers only send traffic to warm processes. A step that
+fails is retried a few times; if it keeps failing the process is marked
+ready anyway, in a degraded state (the requests load what the step did on
+first use), instead of answering 503 until it is restarted.
+
+Calls ---> precincts, crime_cube, crime_columns and shortest_distance for
+           the data of the app
+      ---> geocoding_helper for the precinct locator and the API client
+      ---> render_pool to load the renderers and start the worker pool
+'''
+import os
+import time
+import threading
+import crime_cube
+import crime_columns
+import precincts
+import render_pool
+import shortest_distance
+import topology
+from . import geocode_cache
+from .geocoding_helper import get_client, get_locator
+
+# retries of a step that fails, after BACKOFF seconds doubled every retry
+RETRIES = 2
+BACKOFF = 1.0
+
+_STATE = {'started': False, 'ready': False, 'degraded': False,
+          'errors': {}, 'steps': {}}
+_LOCK = threading.Lock()
+
+
+def load_precincts():
+    '''
+    Loads the precincts, their locator and the topojson of every level.
+    '''
+    precincts.get_cuadrantes()
+    get_locator()
+    for level in range(len(topology.LEVELS)):
+        precincts.get_topojson(level)
+
+
+def load_renderers():
+    '''
+    Loads the renderers in this process (they are used when a single
+    visualization is missing from the cache) and, with more than one
+    worker, starts the worker pool and waits for the workers to load them.
+    '''
+    render_pool.warm_up()
+
+    if render_pool.WORKERS > 1:
+        pool = render_pool.get_pool()
+        futures = [pool.submit(os.getpid) for _ in range(render_pool.WORKERS)]
+        for future in futures:
+            future.result()
+
+
+STEPS = [
+    ('precincts', load_precincts),
+    ('crime_cube', crime_cube.get_cube),
+    ('crime_columns', crime_columns.get_columns),
+    ('police_stations', shortest_distance.get_stations),
+    ('geocoding', lambda: (get_client(), geocode_cache.get_cache())),
+    ('renderers', load_renderers),
+]
+
+
+def run_step(name, step):
+    '''
+    Runs a step of STEPS, retrying it up to RETRIES times, and records its
+    time or its last error.
+    Returns:
+        -True if it was done
+    '''
+    for attempt in range(RETRIES + 1):
+        start = time.perf_counter()
+        try:
+            step()
+        except Exception as error:
+            with _LOCK:
+                _STATE['errors'][name] = repr(error)
+            if attempt < RETRIES:
+                time.sleep(BACKOFF * 2 ** attempt)
+            continue
+        with _LOCK:
+            _STATE['errors'].pop(name, None)
+            _STATE['steps'][name] = round(time.perf_counter() - start, 3)
+        return True
+
+    return False
+
+
+def warm_up():
+    '''
+    Runs the steps of STEPS in order, recording the time of each one, and
+    marks the process ready. If a step fails after its retries, the rest
+    still run and the process is ready in a degraded state.
+    '''
+    done = [run_step(name, step) for name, step in STEPS]
+
+    with _LOCK:
+        _STATE['degraded'] = not all(done)
+        _STATE['ready'] = True
+
+
+def start():
+    '''
+    Starts the warm up in a background thread, once per process.
+    '''
+    with _LOCK:
+        if _STATE['started']:
+            return
+        _STATE['started'] = True
+
+    threading.Thread(target=warm_up, name='warm-up', daemon=True).start()
+
+
+def status():
+    '''
+    Returns:
+        -dictionary: ready (bool), started (bool), degraded (bool, some
+         step failed), errors (last error of the steps that failed) and
+         steps (seconds of each step done)
+    '''
+    with _LOCK:
+        return dict(_STATE, errors=dict(_STATE['errors']),
+                    steps=dict(_STATE['steps']))
@@ -1,3 +1,1344 @@
-from django.test import TestCase
+import io
+import os
+import re
+import json
+import time
+import sqlite3
+import tempfile
+import threading
+from concurrent.futures import Future
+from concurrent.futures.process import BrokenProcessPool
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+from django.test import SimpleTestCase
+import numpy as np
+import geopandas as gpd
+import artifact_cache
+import crime_columns
+import crime_cube
+import crime_db
+import data_cleaning
+import get_data
+import precincts
+import queries
+import render_pool
+import shortest_distance
+import timing
+from . import geocode_cache
+from . import geocoding_helper
+from . import scoring
+from . import startup
+from . import views
+from .geocode_cache import GeocodeCache, normalize_address
+from .geocoding_helper import (GeocodingClient, GeocodingError, StubGeocoder,
+                               TransientGeocodingError, geo_code)
 
-# Create your tests here.
+
+# (hour, tipo, latitud, longitud) of the crimes of the test database, all on
+# Mondays, in precinct 1
+CRIMES = [(10, 'walking', 19.4326, -99.1332), (11, 'walking', 19.4330, -99.1330),
+          (10, 'homicide', 19.4340, -99.1340), (10, 'walking', 19.5000, -99.2000),
+          (22, 'walking', 19.4326, -99.1332), (10, 'walking', None, None)]
+
+
+def write_crimes(filename, rows=None):
+    '''
+    Writes CRIMES, or rows of (id, weekday, hour, tipo, delito, date, time,
+    latitud, longitud), to a database with the schema of crime_db.
+    '''
+
+    if rows is None:
+        rows = [(1, 'Monday', hour, tipo, 'ROBO', '2019-01-07', '10:00:00',
+                 lat, lon) for hour, tipo, lat, lon in CRIMES]
+
+    conn = sqlite3.connect(filename)
+    with conn:
+        crime_db.create_schema(conn)
+        conn.execute('CREATE TABLE staging (id, weekday, hour, tipo, delito, '
+                     'date, time, latitud, longitud)')
+        conn.executemany('INSERT INTO staging VALUES (?, ?, ?, ?, ?, ?, ?, '
+                         '?, ?)', rows)
+        crime_db.load_staging(conn, 'staging', '2019-01-07 10:00:00')
+        conn.execute('DROP TABLE staging')
+    conn.close()
+
+
+def random_crimes(n, seed=0):
+    '''
+    n crimes for write_crimes, in 8 precincts, on every day and hour.
+    '''
+
+    rng = np.random.RandomState(seed)
+    tipos = ['walking', 'public transit', 'personal vehicle', 'homicide',
+             'rape']
+    delitos = ['ROBO A NEGOCIO CON VIOLENCIA', 'ROBO DE ACCESORIOS DE AUTO',
+               'HOMICIDIO CULPOSO', 'VIOLACION']
+    # one crime in 20 without location
+    located = rng.rand(n) >= 0.05
+
+    return [(int(rng.randint(8)), crime_cube.WEEK_DAYS[rng.randint(7)],
+             int(rng.randint(24)), tipos[rng.randint(len(tipos))],
+             delitos[rng.randint(len(delitos))], '2019-01-07', '10:00:00',
+             round(19.3 + rng.rand() * 0.2, 6) if located[i] else None,
+             round(-99.2 + rng.rand() * 0.2, 6) if located[i] else None)
+            for i in range(n)]
+
+
+class LoadStagingTests(SimpleTestCase):
+    '''
+    crime_db.load_staging with crimes that have no delito, tipo or date.
+    '''
+
+    def test_counts_match_crimes(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            filename = os.path.join(tmp, 'crimes.sqlite3')
+            write_crimes(filename)
+            conn = sqlite3.connect(filename)
+            with conn:
+                conn.execute('CREATE TABLE staging (id, weekday, hour, tipo, '
+                             'delito, date, time, latitud, longitud)')
+                conn.executemany(
+                    'INSERT INTO staging VALUES (1, "Monday", 10, ?, ?, '
+                    '"2019-01-08", "10:00:00", 19.4326, -99.1332)',
+                    [('walking', None), (None, 'ROBO'), ('walking', 'ROBO')])
+                crime_db.load_staging(conn, 'staging', '2019-01-08 10:00:00')
+            crimes, = conn.execute('SELECT count(*) FROM crime').fetchone()
+            counted, = conn.execute('SELECT sum(crimes) FROM crime_counts'
+                                    ).fetchone()
+            located, = conn.execute('SELECT count(*) FROM crime_rtree'
+                                    ).fetchone()
+            conn.close()
+
+        self.assertEqual(crimes, len(CRIMES) + 1)
+        self.assertEqual(counted, crimes)
+        self.assertEqual(located, crimes - 1)
+
+    def test_no_date(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            filename = os.path.join(tmp, 'crimes.sqlite3')
+            rows = [(1, 'Monday', 10, 'walking', 'ROBO', date, time, 19.43,
+                     -99.13)
+                    for date, time in [('2019-01-07', '10:00:00'),
+                                       (None, '10:00:00'),
+                                       ('2019-01-07', None),
+                                       ('07/01/2019', '10:00:00')]]
+            write_crimes(filename, rows)
+            conn = sqlite3.connect(filename)
+            counts = conn.execute('SELECT (SELECT count(*) FROM crime), '
+                                  '(SELECT sum(crimes) FROM crime_counts), '
+                                  '(SELECT count(*) FROM crime_rtree)'
+                                  ).fetchone()
+            conn.close()
+
+        self.assertEqual(counts, (1, 1, 1))
+
+
+class CrimeTypesTests(SimpleTestCase):
+    '''
+    The types of crime of the queries are the ones data_cleaning writes.
+    '''
+
+    def test_same_names(self):
+        self.assertEqual(set(queries.get_crime_tipos([1, 2, 3])),
+                         set(data_cleaning.DELITO_TIPO.values()))
+
+
+class RadiusTests(SimpleTestCase):
+    '''
+    /radius.json on a database written before crime_rtree, and on the same
+    database once migrated.
+    '''
+
+    QUERY = {'lat': 19.4326, 'lon': -99.1332, 'meters': 500, 'day': 'Monday',
+             'hour_0': 9, 'hour_1': 12, 'crime_type': 1}
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.filename = os.path.join(tmp.name, 'crimes.sqlite3')
+        write_crimes(self.filename)
+        patcher = mock.patch.object(queries, 'DATABASE_FILENAME', self.filename)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def unmigrate(self):
+        conn = sqlite3.connect(self.filename)
+        with conn:
+            conn.execute('DROP TABLE crime_rtree')
+            conn.execute('DROP INDEX crime_n')
+        conn.close()
+
+    def test_migrated(self):
+        response = self.client.get('/radius.json', self.QUERY)
+        self.assertEqual(response.status_code, 200)
+        # the walking crimes and the homicide near the point, between 9 and 12
+        self.assertEqual(response.json()['crimes'], 3)
+
+    def test_unmigrated(self):
+        self.unmigrate()
+        response = self.client.get('/radius.json', self.QUERY)
+        self.assertEqual(response.status_code, 503)
+        self.assertIn('not built', response.json()['errors'])
+
+        self.assertTrue(crime_db.migrate(self.filename))
+        self.assertFalse(crime_db.migrate(self.filename))
+        response = self.client.get('/radius.json', self.QUERY)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['crimes'], 3)
+
+
+class ConnectionTests(SimpleTestCase):
+    '''
+    The read-only connections of crime_db.get_connection.
+    '''
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.tmp = tmp.name
+        self.filename = os.path.join(tmp.name, 'crimes.sqlite3')
+        write_crimes(self.filename)
+
+    def in_thread(self, function):
+        result = []
+        thread = threading.Thread(target=lambda: result.append(function()))
+        thread.start()
+        thread.join()
+        return result[0]
+
+    def test_one_per_thread(self):
+        conn = crime_db.get_connection(self.filename)
+        self.assertIs(crime_db.get_connection(self.filename), conn)
+        other = self.in_thread(lambda: crime_db.get_connection(self.filename))
+        self.assertIsNot(other, conn)
+
+    def test_read_only(self):
+        conn = crime_db.get_connection(self.filename)
+        self.assertEqual(conn.execute('SELECT count(*) FROM crime'
+                                      ).fetchone()[0], len(CRIMES))
+        for statement in ('DELETE FROM crime', 'CREATE TABLE t (a)'):
+            with self.assertRaises(sqlite3.OperationalError):
+                conn.execute(statement)
+
+    def test_reopened_when_replaced(self):
+        conn = crime_db.get_connection(self.filename)
+        replacement = os.path.join(self.tmp, 'new.sqlite3')
+        write_crimes(replacement, [(1, 'Monday', 10, 'walking', 'ROBO',
+                                    '2019-01-07', '10:00:00', None, None)])
+        os.replace(replacement, self.filename)
+
+        reopened = crime_db.get_connection(self.filename)
+        self.assertIsNot(reopened, conn)
+        self.assertEqual(reopened.execute('SELECT count(*) FROM crime'
+                                          ).fetchone()[0], 1)
+        self.assertIs(crime_db.get_connection(self.filename), reopened)
+
+
+class CrimeCubeTests(SimpleTestCase):
+    '''
+    The counts of CrimeCube against the same counts in SQL over the crime
+    table, on a database of random crimes.
+    '''
+
+    # (day, hour range, types of crime), arson is not in the database
+    FILTERS = [('Monday', [0, 23], ('walking',)),
+               ('Friday', [3, 9], ('walking', 'personal vehicle')),
+               ('Sunday', [22, 23], ('walking', 'public transit',
+                                     'personal vehicle', 'homicide', 'rape')),
+               ('Wednesday', [12, 12], ('homicide', 'arson'))]
+    PRECINCT = 3
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.tmp = tmp.name
+        self.filename = os.path.join(tmp.name, 'crimes.sqlite3')
+        self.rows = random_crimes(3000)
+        write_crimes(self.filename, self.rows)
+
+    def sql(self, group, tipos, day=None, hour=None, precinct=None):
+        '''
+        Number of crimes per value of group (a column of the query below).
+        '''
+
+        where = ['t.name IN ({})'.format(', '.join('?' * len(tipos)))]
+        params = list(tipos)
+        if day is not None:
+            where.append('w.name = ?')
+            params.append(day)
+        if hour is not None:
+            where.append('c.hour BETWEEN ? AND ?')
+            params += hour
+        if precinct is not None:
+            where.append('c.id = ?')
+            params.append(precinct)
+
+        conn = sqlite3.connect(self.filename)
+        rows = conn.execute(
+            'SELECT {}, count(*) FROM crime c '
+            'JOIN weekday_lookup w ON w.code = c.weekday '
+            'JOIN tipo_lookup t ON t.code = c.tipo WHERE {} '
+            'GROUP BY 1'.format(group, ' AND '.join(where)), params).fetchall()
+        conn.close()
+
+        return dict(rows)
+
+    def expected(self, day, hour, tipos):
+        by_precinct = self.sql('c.id', tipos, day, hour)
+        by_weekday = self.sql('w.name', tipos, precinct=self.PRECINCT)
+        by_hour = self.sql('c.hour', tipos, day, precinct=self.PRECINCT)
+
+        return {'by_precinct': [by_precinct.get(i, 0) for i in range(8)],
+                'by_weekday': [by_weekday.get(d, 0)
+                               for d in crime_cube.WEEK_DAYS],
+                'by_hour': [by_hour.get(h, 0) for h in range(24)],
+                'total': by_precinct.get(self.PRECINCT, 0)}
+
+    def check(self, cube):
+        self.assertEqual(cube.n_precincts, 8)
+        for day, hour, tipos in self.FILTERS:
+            expected = self.expected(day, hour, tipos)
+            self.assertEqual(list(cube.by_precinct(day, hour, tipos)),
+                             expected['by_precinct'])
+            self.assertEqual(list(cube.by_weekday(self.PRECINCT, tipos)),
+                             expected['by_weekday'])
+            self.assertEqual(list(cube.by_hour(self.PRECINCT, day, tipos)),
+                             expected['by_hour'])
+            self.assertEqual(cube.total(self.PRECINCT, day, hour, tipos),
+                             expected['total'])
+
+            summary = cube.summary(self.PRECINCT, day, hour, tipos)
+            self.assertEqual({key: value if key == 'total' else list(value)
+                              for key, value in summary.items()}, expected)
+            # precincts that are not in the cube count 0
+            summary = cube.summary(99, day, hour, tipos, ids=[3, 99, 0])
+            self.assertEqual(list(summary['by_precinct']), [
+                expected['by_precinct'][3], 0, expected['by_precinct'][0]])
+            self.assertEqual(summary['total'], 0)
+            self.assertEqual(list(summary['by_hour']), [0] * 24)
+
+    def test_crime_counts(self):
+        self.check(crime_cube.build_cube(self.filename))
+
+    def test_pandas_layout(self):
+        # the crime table as written by pandas to_sql, before crime_db
+        legacy = os.path.join(self.tmp, 'legacy.sqlite3')
+        conn = sqlite3.connect(legacy)
+        with conn:
+            conn.execute('CREATE TABLE crime (id, weekday, hour, tipo, '
+                         'delito, date, time, latitud, longitud)')
+            conn.executemany('INSERT INTO crime VALUES (?, ?, ?, ?, ?, ?, ?, '
+                             '?, ?)', self.rows)
+        conn.close()
+        self.check(crime_cube.build_cube(legacy))
+
+    def test_rebuilt_on_update(self):
+        for name, value in [('DATABASE_FILENAME', self.filename),
+                            ('_CUBE', None), ('_SIGNATURE', None)]:
+            patcher = mock.patch.object(crime_cube, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        cube = crime_cube.get_cube()
+        self.assertIs(crime_cube.get_cube(), cube)
+
+        # 100 more Monday crimes in precinct 3, from 10 to 11
+        conn = sqlite3.connect(self.filename)
+        with conn:
+            conn.execute("INSERT INTO crime_counts SELECT 3, 1, 10, code, 100 "
+                         "FROM tipo_lookup WHERE name = 'walking' "
+                         "ON CONFLICT (id, weekday, hour, tipo) "
+                         "DO UPDATE SET crimes = crimes + excluded.crimes")
+        conn.close()
+        os.utime(self.filename, ns=(0, os.stat(self.filename).st_mtime_ns + 1))
+
+        rebuilt = crime_cube.get_cube()
+        self.assertIsNot(rebuilt, cube)
+        self.assertEqual(rebuilt.total(3, 'Monday', [10, 10], ('walking',)),
+                         cube.total(3, 'Monday', [10, 10], ('walking',)) + 100)
+        self.assertIs(crime_cube.get_cube(), rebuilt)
+
+
+class CrimeColumnsTests(SimpleTestCase):
+    '''
+    queries.filter_data from the snapshot of crime_columns and from the
+    database, on a database of random crimes.
+    '''
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.filename = os.path.join(tmp.name, 'crimes.sqlite3')
+        write_crimes(self.filename, random_crimes(3000))
+        crime_columns.write_snapshot(self.filename)
+        patcher = mock.patch.object(queries, 'DATABASE_FILENAME',
+                                    self.filename)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @staticmethod
+    def rows(df):
+        # NULL locations are None from the database and nan from the snapshot
+        return sorted((tuple(None if value != value else value
+                             for value in row)
+                       for row in df.itertuples(index=False)), key=str)
+
+    def sql(self, dic, group_var):
+        with mock.patch.object(queries.crime_columns, 'get_columns',
+                               return_value=None):
+            return queries.filter_data(dic, group_var)
+
+    def test_same_as_sql(self):
+        self.assertIsNotNone(crime_columns.get_columns(self.filename))
+        rng = np.random.RandomState(1)
+        for _ in range(100):
+            first = int(rng.randint(24))
+            types = [t for t in (1, 2, 3) if rng.rand() < 0.6] or [1]
+            dic = {'address': (19.4, -99.1, int(rng.randint(9))),
+                   'day': crime_cube.WEEK_DAYS[rng.randint(7)],
+                   'hour': [first, int(rng.randint(first, 24))],
+                   'crime_type': types}
+            for group_var in (None, 'id', 'weekday', 'hour'):
+                snapshot = queries.filter_data(dic, group_var)
+                expected = self.sql(dic, group_var)
+                self.assertEqual(list(snapshot.columns),
+                                 list(expected.columns))
+                self.assertEqual(self.rows(snapshot), self.rows(expected),
+                                 (dic, group_var))
+
+    def test_stale_signature(self):
+        dic = {'address': (19.4, -99.1, 3), 'day': 'Monday', 'hour': [0, 23],
+               'crime_type': [1, 3]}
+        self.assertIsNotNone(crime_columns.load_snapshot(self.filename))
+
+        conn = sqlite3.connect(self.filename)
+        with conn:
+            conn.execute('DELETE FROM crime WHERE id = 3')
+        conn.close()
+
+        self.assertIsNone(crime_columns.load_snapshot(self.filename))
+        self.assertIsNone(crime_columns.get_columns(self.filename))
+        # the queries read the database instead
+        self.assertTrue(queries.filter_data(dic, None).empty)
+
+
+class TimingTests(SimpleTestCase):
+    '''
+    The Server-Timing header of the responses and /metrics.
+    '''
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        filename = os.path.join(tmp.name, 'crimes.sqlite3')
+        write_crimes(filename)
+        for target, name, value in [
+                (queries, 'DATABASE_FILENAME', filename),
+                (geocode_cache, 'get_cache', lambda: GeocodeCache(None))]:
+            patcher = mock.patch.object(target, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        timing.reset()
+        self.addCleanup(timing.reset)
+
+    def test_server_timing(self):
+        response = self.client.get('/radius.json', RadiusTests.QUERY)
+        self.assertEqual(response.status_code, 200)
+        self.assertRegex(response['Server-Timing'],
+                         r'^count_within;dur=\d+\.\d, total;dur=\d+\.\d$')
+
+    def test_metrics(self):
+        self.client.get('/radius.json', RadiusTests.QUERY)
+        response = self.client.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        content = response.content.decode()
+        self.assertIn('mexcrimes_request_seconds_count{view="radius_counts"} 1',
+                      content)
+        self.assertIn('mexcrimes_stage_seconds_count{stage="count_within"} 1',
+                      content)
+        self.assertIn('mexcrimes_geocode_cache_', content)
+
+    def test_metrics_not_allowed(self):
+        response = self.client.get('/metrics', REMOTE_ADDR='192.0.2.1')
+        self.assertEqual(response.status_code, 404)
+        with self.settings(METRICS_ALLOWED_IPS=['192.0.2.1']):
+            response = self.client.get('/metrics', REMOTE_ADDR='192.0.2.1')
+        self.assertEqual(response.status_code, 200)
+
+
+# location returned by FakeGeocodingAPI, in the Zocalo
+ZOCALO = (19.4326, -99.1332)
+
+
+class FakeGeocodingAPI(BaseHTTPRequestHandler):
+    '''
+    Stand-in for the Google Geocoding API. It answers the responses of
+    the server in order ((HTTP status, API status) pairs), then OK with
+    ZOCALO, after waiting server.delay seconds, and records the addresses
+    asked and the most requests it had at a time.
+    '''
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.addresses.append(self.path.split('address=')[1]
+                                    .split('&')[0])
+            server.active += 1
+            server.max_active = max(server.max_active, server.active)
+            response = server.responses.pop(0) if server.responses \
+                else (200, 'OK')
+        try:
+            time.sleep(server.delay)
+            status, api_status = response
+            results = [{'geometry': {'location': {'lat': ZOCALO[0],
+                                                  'lng': ZOCALO[1]}}}]
+            body = json.dumps({'status': api_status,
+                               'results': results if api_status == 'OK'
+                                          else []}).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        finally:
+            with server.lock:
+                server.active -= 1
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeServer(ThreadingHTTPServer):
+
+    def handle_error(self, request, client_address):
+        # the client gave up on a slow response
+        pass
+
+
+class GeocodingClientTests(SimpleTestCase):
+    '''
+    GeocodingClient against FakeGeocodingAPI on a local port.
+    '''
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server = FakeServer(('127.0.0.1', 0), FakeGeocodingAPI)
+        cls.server.lock = threading.Lock()
+        cls.url = 'http://127.0.0.1:{}/json'.format(cls.server.server_port)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        super().tearDownClass()
+
+    def setUp(self):
+        self.server.responses = []
+        self.server.addresses = []
+        self.server.delay = 0
+        self.server.active = self.server.max_active = 0
+        # no waiting between retries, and no jitter
+        patcher = mock.patch.object(geocoding_helper, 'time')
+        self.time = patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(geocoding_helper, 'random')
+        patcher.start().uniform.return_value = 1
+        self.addCleanup(patcher.stop)
+
+    def sleeps(self):
+        return [call[0][0] for call in self.time.sleep.call_args_list]
+
+    def api_client(self, **kwargs):
+        kwargs.setdefault('timeout', (1, 1))
+        return GeocodingClient(url=self.url, key='test', **kwargs)
+
+    def test_ok(self):
+        self.assertEqual(self.api_client()('Zocalo'), ZOCALO)
+        self.assertEqual(self.server.addresses, ['Zocalo'])
+
+    def test_read_timeout(self):
+        self.server.delay = 0.5
+        with self.assertRaises(TransientGeocodingError):
+            self.api_client(timeout=(1, 0.1), retries=0)('Zocalo')
+
+    def test_retries_with_backoff(self):
+        self.server.responses = [(500, 'UNKNOWN_ERROR'), (429, 'OK'),
+                                 (200, 'OVER_QUERY_LIMIT')]
+        location = self.api_client(retries=3, backoff=0.1)('Zocalo')
+        self.assertEqual(location, ZOCALO)
+        self.assertEqual(len(self.server.addresses), 4)
+        self.assertEqual(self.sleeps(), [0.1, 0.2, 0.4])
+
+    def test_gives_up_after_retries(self):
+        self.server.responses = [(503, 'UNKNOWN_ERROR')] * 3
+        with self.assertRaises(TransientGeocodingError):
+            self.api_client(retries=2)('Zocalo')
+        self.assertEqual(len(self.server.addresses), 3)
+
+    def test_request_denied_not_retried(self):
+        self.server.responses = [(200, 'REQUEST_DENIED')]
+        with self.assertRaises(GeocodingError) as error:
+            self.api_client(retries=2)('Zocalo')
+        self.assertNotIsInstance(error.exception, TransientGeocodingError)
+        self.assertEqual(len(self.server.addresses), 1)
+        self.assertEqual(self.sleeps(), [])
+
+    def test_zero_results(self):
+        self.server.responses = [(200, 'ZERO_RESULTS')]
+        self.assertIsNone(self.api_client()('Nowhere'))
+        self.assertEqual(len(self.server.addresses), 1)
+
+    def test_max_concurrent(self):
+        self.server.delay = 0.2
+        client = self.api_client(max_concurrent=2)
+        threads = [threading.Thread(target=client, args=(str(i),))
+                   for i in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(self.server.addresses), 6)
+        self.assertEqual(self.server.max_active, 2)
+
+    def test_geo_code_many_deduplicates(self):
+        addresses = ['Av. Insurgentes Sur 339', 'avenida insurgentes sur 339',
+                     'AV  INSURGENTES SUR, 339', 'Zocalo']
+        results = geocoding_helper.geo_code_many(
+            addresses, geocoder=self.api_client(), cache=GeocodeCache(None))
+        self.assertEqual(len(self.server.addresses), 2)
+        self.assertEqual(len(results), 4)
+        self.assertEqual(results[0][:2], ZOCALO)
+        self.assertEqual(len(set(results)), 1)
+
+
+class FakeLocator:
+    '''
+    Stand-in for geocoding_helper.PrecinctLocator that puts every point in
+    the same precinct.
+    '''
+
+    def __init__(self, precinct):
+        self.precinct = precinct
+        self.calls = 0
+
+    def locate(self, latitude, longitude):
+        self.calls += 1
+        return self.precinct
+
+
+class GeocodeCacheTests(SimpleTestCase):
+    '''
+    geo_code and GeocodeCache with StubGeocoder, a database in a temporary
+    folder and the precincts replaced by FakeLocator.
+    '''
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.filename = os.path.join(tmp.name, 'geocode_cache.sqlite3')
+        self.stub = StubGeocoder({'Av. Insurgentes Sur 339': ZOCALO})
+        self.locator = FakeLocator(5)
+        self.version = 'v1'
+        self.now = 1e9
+        for target, name, value in [
+                (geocoding_helper, 'get_locator', lambda: self.locator),
+                (geocoding_helper.precincts, 'geojson_etag',
+                 lambda: self.version)]:
+            patcher = mock.patch.object(target, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(geocode_cache, 'time')
+        patcher.start().time.side_effect = lambda: self.now
+        self.addCleanup(patcher.stop)
+
+    def cache(self, **kwargs):
+        return GeocodeCache(self.filename, **kwargs)
+
+    def test_normalize_address(self):
+        self.assertEqual(
+            normalize_address('Av. Insurgentes  Sur 339, Col. Hipódromo'),
+            'avenida insurgentes sur 339 colonia hipodromo')
+        self.assertEqual(normalize_address(' CALZ. de Tlalpan No.  1,CDMX '),
+                         'calzada de tlalpan numero 1 ciudad de mexico')
+        self.assertEqual(normalize_address('Mixcóac #5'),
+                         normalize_address('mixcoac #5'))
+
+    def test_hits_skip_geocoder(self):
+        cache = self.cache()
+        result = (ZOCALO[0], ZOCALO[1], 5)
+        self.assertEqual(geo_code('Av. Insurgentes Sur 339', self.stub, cache),
+                         result)
+        self.assertEqual(geo_code('avenida insurgentes sur 339', self.stub,
+                                  cache), result)
+        self.assertEqual(self.stub.calls, 1)
+        self.assertEqual(cache.stats['memory_hits'], 1)
+
+        # another process: found in the database
+        other = self.cache()
+        self.assertEqual(geo_code('AV INSURGENTES SUR 339', self.stub, other),
+                         result)
+        self.assertEqual(self.stub.calls, 1)
+        self.assertEqual(other.stats['disk_hits'], 1)
+        self.assertEqual(self.locator.calls, 1)
+
+    def test_not_found_cached(self):
+        cache = self.cache()
+        self.assertIsNone(geo_code('Nowhere', self.stub, cache))
+        self.assertIsNone(geo_code('nowhere', self.stub, cache))
+        self.assertEqual(self.stub.calls, 1)
+
+    def test_errors_not_cached(self):
+        cache = self.cache()
+        failing = mock.Mock(side_effect=GeocodingError('OVER_DAILY_LIMIT'))
+        with self.assertRaises(GeocodingError):
+            geo_code('Av. Insurgentes Sur 339', failing, cache)
+        self.assertFalse(cache.get(
+            normalize_address('Av. Insurgentes Sur 339'))[0])
+        self.assertEqual(geo_code('Av. Insurgentes Sur 339', self.stub, cache),
+                         (ZOCALO[0], ZOCALO[1], 5))
+
+    def test_lru_eviction(self):
+        cache = GeocodeCache(None, max_entries=2)
+        cache.put('a', (1, 1, 1), 'v1')
+        cache.put('b', (2, 2, 2), 'v1')
+        cache.get('a')
+        cache.put('c', (3, 3, 3), 'v1')
+        self.assertEqual(list(cache.memory), ['a', 'c'])
+        self.assertFalse(cache.get('b')[0])
+        self.assertEqual(cache.get('a'), (True, (1, 1, 1), 'v1'))
+
+    def test_ttl(self):
+        cache = self.cache()
+        cache.put('found', (1, 1, 1), 'v1')
+        cache.put('not found', None, 'v1')
+
+        self.now += geocode_cache.NOT_FOUND_TTL - 1
+        self.assertTrue(cache.get('not found')[0])
+        self.now += 2
+        self.assertFalse(cache.get('not found')[0])
+        self.assertFalse(self.cache().get('not found')[0])
+
+        self.now += geocode_cache.TTL - geocode_cache.NOT_FOUND_TTL - 2
+        self.assertTrue(cache.get('found')[0])
+        self.assertTrue(self.cache().get('found')[0])
+        self.now += 2
+        self.assertFalse(cache.get('found')[0])
+        self.assertFalse(self.cache().get('found')[0])
+
+    def test_expired_asks_again(self):
+        cache = self.cache()
+        geo_code('Av. Insurgentes Sur 339', self.stub, cache)
+        self.now += geocode_cache.TTL + 1
+        geo_code('Av. Insurgentes Sur 339', self.stub, cache)
+        self.assertEqual(self.stub.calls, 2)
+
+    def test_precincts_changed(self):
+        cache = self.cache()
+        geo_code('Av. Insurgentes Sur 339', self.stub, cache)
+        self.version, self.locator = 'v2', FakeLocator(7)
+        self.assertEqual(geo_code('Av. Insurgentes Sur 339', self.stub, cache),
+                         (ZOCALO[0], ZOCALO[1], 7))
+        self.assertEqual(self.stub.calls, 1)
+        self.assertEqual(self.locator.calls, 1)
+
+        key = normalize_address('Av. Insurgentes Sur 339')
+        self.assertEqual(self.cache().get(key),
+                         (True, (ZOCALO[0], ZOCALO[1], 7), 'v2'))
+
+
+class QueryFormTests(SimpleTestCase):
+    '''
+    The errors of the form of / when the address can't be geocoded.
+    '''
+
+    QUERY = {'address': 'Av. Insurgentes Sur 339', 'day': 'Monday',
+             'hour_0': 9, 'hour_1': 12, 'crime_type': 1}
+
+    def get(self, **kwargs):
+        with mock.patch.object(views, 'geo_code', **kwargs):
+            response = self.client.get('/', self.QUERY)
+        self.assertEqual(response.status_code, 200)
+        return response.content.decode()
+
+    def test_not_in_mexico_city(self):
+        content = self.get(return_value=None)
+        self.assertIn('not in Mexico City', content)
+
+    def test_geocoding_unavailable(self):
+        content = self.get(side_effect=GeocodingError('HTTP 503'))
+        self.assertIn('temporarily unavailable', content)
+        self.assertNotIn('not in Mexico City', content)
+
+
+class ReadyTests(SimpleTestCase):
+    '''
+    /ready during and after the warm up of getmaps.startup, with steps that
+    fail and without waiting between retries.
+    '''
+
+    def setUp(self):
+        self.calls = 0
+        state = {'started': False, 'ready': False, 'degraded': False,
+                 'errors': {}, 'steps': {}}
+        for name, value in [('_STATE', state), ('time', mock.Mock())]:
+            patcher = mock.patch.object(startup, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        startup.time.perf_counter.return_value = 0
+
+    def steps(self, failures):
+        '''
+        STEPS with a step that fails its first failures calls.
+        '''
+
+        def flaky():
+            self.calls += 1
+            if self.calls <= failures:
+                raise OSError('database is locked')
+
+        return [('first', lambda: None), ('flaky', flaky),
+                ('last', lambda: None)]
+
+    def ready(self):
+        response = self.client.get('/ready')
+        return response.status_code, response.json()
+
+    def test_not_ready_until_warm(self):
+        status, body = self.ready()
+        self.assertEqual(status, 503)
+        self.assertFalse(body['ready'])
+        # the probe does not start the warm up
+        self.assertFalse(startup.status()['started'])
+
+    def test_retried(self):
+        with mock.patch.object(startup, 'STEPS', self.steps(2)):
+            startup.warm_up()
+        status, body = self.ready()
+        self.assertEqual(status, 200)
+        self.assertFalse(body['degraded'])
+        self.assertEqual(body['errors'], {})
+        self.assertEqual(sorted(body['steps']), ['first', 'flaky', 'last'])
+        self.assertEqual(self.calls, 3)
+        self.assertEqual(startup.time.sleep.call_count, 2)
+
+    def test_degraded(self):
+        with mock.patch.object(startup, 'STEPS',
+                               self.steps(startup.RETRIES + 1)):
+            startup.warm_up()
+        status, body = self.ready()
+        self.assertEqual(status, 200)
+        self.assertTrue(body['degraded'])
+        self.assertIn('database is locked', body['errors']['flaky'])
+        self.assertEqual(sorted(body['steps']), ['first', 'last'])
+
+
+# crime export in the format of the portal, with a nested property
+EXPORT = json.dumps({'type': 'FeatureCollection', 'features': [
+    {'type': 'Feature',
+     'geometry': {'type': 'Point', 'coordinates': [lon, lat]},
+     'properties': {'delito': delito, 'ao_hechos': 2019,
+                    'fecha_hechos': '2019-01-07 10:{:02}:00'.format(i),
+                    'latitud': lat, 'longitud': lon,
+                    'geopoint': {'lat': lat, 'lon': lon}}}
+    for i, (delito, lat, lon) in enumerate([
+        ('ROBO A TRANSEÚNTE EN VÍA PÚBLICA', 19.4326, -99.1332),
+        ('HOMICIDIO DOLOSO', 19.3, -99.2),
+        ('ROBO DE VEHÍCULO "CON VIOLENCIA"', 19.5, -99.1),
+        ('FRAUDE', 19.35, -99.05)])]}, ensure_ascii=False)
+
+
+class IterFeaturesTests(SimpleTestCase):
+    '''
+    get_data.iter_features on the crime export split in chunks.
+    '''
+
+    def features(self, size, **kwargs):
+        chunks = (EXPORT[i:i + size] for i in range(0, len(EXPORT), size))
+        return list(get_data.iter_features(chunks, **kwargs))
+
+    @staticmethod
+    def values(column):
+        # read_file may parse the dates, and the geopoint json
+        if column.name == 'geopoint':
+            return [json.loads(value) if isinstance(value, str) else value
+                    for value in column]
+        return [str(value) for value in column]
+
+    def test_same_rows_as_read_file(self):
+        expected = gpd.read_file(EXPORT)
+        columns = sorted(expected.columns)
+        # chunks of 7 characters split every feature, 100000 holds them all
+        for size in (1, 7, 100000):
+            features = map(get_data.nested_to_json, self.features(size))
+            crimes = gpd.GeoDataFrame.from_features(features,
+                                                    crs=expected.crs)
+            self.assertEqual(sorted(crimes.columns), columns)
+            for column in columns:
+                if column == 'geometry':
+                    self.assertTrue(crimes.geometry.geom_equals(
+                        expected.geometry).all())
+                else:
+                    self.assertEqual(self.values(crimes[column]),
+                                     self.values(expected[column]))
+
+    def test_max_buffer(self):
+        with self.assertRaises(ValueError):
+            self.features(7, max_buffer=100)
+        self.assertEqual(len(self.features(7, max_buffer=400)), 4)
+
+    def test_truncated(self):
+        chunks = iter([EXPORT[:len(EXPORT) // 2]])
+        with self.assertRaises(ValueError):
+            list(get_data.iter_features(chunks))
+
+
+# geojson files of two precincts, a police station and the crime export of
+# the crimes in them (a crime that is not considered and a crime outside
+# both precincts are dropped)
+FIXTURES = os.path.join(os.path.dirname(__file__), 'fixtures')
+
+
+def fixture(name):
+    return os.path.join(FIXTURES, name + '.geojson')
+
+
+class GoTests(SimpleTestCase):
+    '''
+    get_data.go and get_data.update on the fixtures, in a temporary working
+    directory.
+    '''
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        os.makedirs(os.path.join(tmp.name, 'data'))
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(tmp.name)
+        cuadrantes = precincts.read_geojson(fixture('cuadrantes'))
+        patcher = mock.patch.object(get_data.precincts, 'get_cuadrantes',
+                                    return_value=cuadrantes)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @staticmethod
+    def export(crimes):
+        '''
+        Writes a crime export with the crimes (delito, fecha_hechos, latitud,
+        longitud) and returns its filename.
+        '''
+
+        features = [{'type': 'Feature',
+                     'geometry': {'type': 'Point', 'coordinates': [lon, lat]},
+                     'properties': {'delito': delito, 'ao_hechos': 2019,
+                                    'fecha_hechos': fecha,
+                                    'categoria_delito': 'ROBO',
+                                    'latitud': lat, 'longitud': lon,
+                                    'geopoint': {'lat': lat, 'lon': lon}}}
+                    for delito, fecha, lat, lon in crimes]
+        filename = 'update{}.geojson'.format(len(os.listdir('.')))
+        with open(filename, 'w') as f:
+            json.dump({'type': 'FeatureCollection', 'features': features}, f)
+
+        return filename
+
+    def go(self):
+        get_data.go(fixture('crimes'), fixture('cuadrantes'),
+                    fixture('police_stations'))
+        conn = sqlite3.connect(get_data.DATABASE)
+        self.addCleanup(conn.close)
+        return conn
+
+    def counts(self, conn):
+        return conn.execute(
+            'SELECT c.id, w.name, c.hour, t.name, c.crimes '
+            'FROM crime_counts c JOIN weekday_lookup w ON w.code = c.weekday '
+            'JOIN tipo_lookup t ON t.code = c.tipo ORDER BY 1, 2, 3').fetchall()
+
+    def test_go(self):
+        conn = self.go()
+        crimes = conn.execute(
+            'SELECT c.id, w.name, c.hour, t.name, c.n, c.latitud, c.longitud '
+            'FROM crime c JOIN weekday_lookup w ON w.code = c.weekday '
+            'JOIN tipo_lookup t ON t.code = c.tipo ORDER BY c.n').fetchall()
+        self.assertEqual([row[:4] for row in crimes], [
+            (0, 'Monday', 10, 'walking'), (0, 'Monday', 10, 'walking'),
+            (1, 'Monday', 18, 'public transit'),
+            (1, 'Tuesday', 22, 'personal vehicle')])
+
+        self.assertEqual(self.counts(conn), [
+            (0, 'Monday', 10, 'walking', 2),
+            (1, 'Monday', 18, 'public transit', 1),
+            (1, 'Tuesday', 22, 'personal vehicle', 1)])
+
+        boxes = conn.execute('SELECT n, min_lat, max_lat, min_lon, max_lon '
+                             'FROM crime_rtree ORDER BY n').fetchall()
+        self.assertEqual([box[0] for box in boxes],
+                         [crime[4] for crime in crimes])
+        for (_, min_lat, max_lat, min_lon, max_lon), crime in zip(boxes,
+                                                                 crimes):
+            # the R*Tree stores 32-bit floats
+            self.assertAlmostEqual(min_lat, crime[5], places=4)
+            self.assertAlmostEqual(max_lat, crime[5], places=4)
+            self.assertAlmostEqual(min_lon, crime[6], places=4)
+            self.assertAlmostEqual(max_lon, crime[6], places=4)
+
+        self.assertEqual(crime_db.get_meta(conn, 'high_water_mark'),
+                         '2019-01-08 22:30:00')
+        self.assertEqual(int(crime_db.get_meta(conn, 'crimes')), 4)
+        tables = {row[0] for row in conn.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table'")}
+        self.assertNotIn('crime_new', tables)
+        self.assertEqual(conn.execute('SELECT count(*) FROM police_station'
+                                      ).fetchone()[0], 1)
+        self.assertTrue(os.path.exists('data/cuadrantes.geojson'))
+
+    def test_go_replaces_crimes(self):
+        # a second download swaps the whole table instead of appending to it
+        self.go().close()
+        conn = self.go()
+        self.assertEqual(conn.execute('SELECT count(*) FROM crime'
+                                      ).fetchone()[0], 4)
+        self.assertEqual(conn.execute('SELECT sum(crimes) FROM crime_counts'
+                                      ).fetchone()[0], 4)
+        self.assertEqual(conn.execute('SELECT count(*) FROM crime_rtree'
+                                      ).fetchone()[0], 4)
+
+    def test_updates_at_the_mark(self):
+        self.go().close()
+        # the latest crime of the fixture, already in the database
+        stored = ('ROBO DE VEHICULO DE SERVICIO PARTICULAR CON VIOLENCIA',
+                  '2019-01-08T22:30:00+00:00', 19.438, -99.122)
+        # published after it, with the same date and time
+        late = ('ROBO A TRANSEUNTE DE CELULAR SIN VIOLENCIA',
+                '2019-01-08T22:30:00+00:00', 19.432, -99.135)
+        before = ('ROBO A NEGOCIO CON VIOLENCIA', '2019-01-08T21:00:00+00:00',
+                  19.432, -99.135)
+        after = ('ROBO A NEGOCIO CON VIOLENCIA', '2019-01-09T07:00:00+00:00',
+                 19.432, -99.135)
+
+        self.assertEqual(get_data.update(self.export([stored, late, before])),
+                         1)
+        # an identical crime to late is a second one
+        self.assertEqual(get_data.update(self.export([stored, late, late,
+                                                      after])), 2)
+        self.assertEqual(get_data.update(self.export([stored, late, late,
+                                                      after])), 0)
+
+        conn = sqlite3.connect(get_data.DATABASE)
+        self.addCleanup(conn.close)
+        self.assertEqual(self.counts(conn), [
+            (0, 'Monday', 10, 'walking', 2),
+            (0, 'Tuesday', 22, 'walking', 2),
+            (0, 'Wednesday', 7, 'walking', 1),
+            (1, 'Monday', 18, 'public transit', 1),
+            (1, 'Tuesday', 22, 'personal vehicle', 1)])
+        self.assertEqual(conn.execute('SELECT count(*), count(DISTINCT n) '
+                                      'FROM crime').fetchone(), (7, 7))
+        self.assertEqual(conn.execute('SELECT count(*) FROM crime_rtree'
+                                      ).fetchone()[0], 7)
+        self.assertEqual(crime_db.get_meta(conn, 'high_water_mark'),
+                         '2019-01-09 07:00:00')
+
+    def test_update_keeps_snapshot(self):
+        self.go().close()
+        meta = os.path.join(crime_columns.snapshot_dir(get_data.DATABASE),
+                            crime_columns.META_FILENAME)
+        written = os.stat(meta).st_mtime_ns
+        self.assertIsNotNone(crime_columns.load_snapshot(get_data.DATABASE))
+
+        added = get_data.update(self.export([
+            ('ROBO A NEGOCIO CON VIOLENCIA', '2019-01-09T08:00:00+00:00',
+             19.432, -99.135)]))
+        self.assertEqual(added, 1)
+        # the snapshot is left as it was, and no longer used
+        self.assertEqual(os.stat(meta).st_mtime_ns, written)
+        self.assertIsNone(crime_columns.load_snapshot(get_data.DATABASE))
+
+
+class ScoringTests(SimpleTestCase):
+    '''
+    Validation of scoring.parse_points and the precincts of locate_many.
+    '''
+
+    POINT = {'lat': 19.4326, 'lon': -99.1332, 'day': 'Monday',
+             'hour': [9, 12], 'crime_type': [1]}
+
+    def test_valid(self):
+        columns = scoring.parse_points([self.POINT])
+        self.assertEqual(list(columns['first']), [9])
+        self.assertEqual(list(columns['last']), [12])
+
+    def test_rejects_bool(self):
+        for point in (dict(self.POINT, hour=[False, 12]),
+                      dict(self.POINT, hour=[0, True]),
+                      dict(self.POINT, crime_type=[True])):
+            with self.assertRaises(scoring.ScoringError):
+                scoring.parse_points([point])
+
+    def test_locate_many(self):
+        locator = geocoding_helper.get_locator()
+        rng = np.random.RandomState(0)
+        lats = rng.uniform(19.1, 19.6, 500)
+        lons = rng.uniform(-99.4, -98.9, 500)
+        expected = [locator.locate(lat, lon) for lat, lon in zip(lats, lons)]
+        self.assertEqual(list(locator.locate_many(lats, lons)),
+                         [-1 if i is None else i for i in expected])
+
+
+class StationIndexTests(SimpleTestCase):
+    '''
+    shortest_distance with the police stations of a temporary database.
+    '''
+
+    STATIONS = [(19.4326, -99.1332), (19.4400, -99.1400), (19.3000, -99.2000)]
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.filename = os.path.join(tmp.name, 'crimes.sqlite3')
+        conn = sqlite3.connect(self.filename)
+        with conn:
+            conn.execute('CREATE TABLE police_station (nomenclatu TEXT, '
+                         'latitud REAL, longitud REAL)')
+        conn.close()
+        for name, value in (('DATABASE_FILENAME', self.filename),
+                            ('_STATIONS', None), ('_SIGNATURE', None)):
+            patcher = mock.patch.object(shortest_distance, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def add_stations(self, stations):
+        conn = sqlite3.connect(self.filename)
+        with conn:
+            conn.executemany('INSERT INTO police_station VALUES ("MP", ?, ?)',
+                             stations)
+        conn.close()
+        # a new modification time, even within the resolution of the clock
+        stat = os.stat(self.filename)
+        os.utime(self.filename, ns=(stat.st_atime_ns,
+                                    stat.st_mtime_ns + 10 ** 9))
+
+    def test_empty(self):
+        stations = shortest_distance.get_stations()
+        self.assertEqual(len(stations.latitudes), 0)
+        indices, kilometers = stations.nearest([19.4, 19.5], [-99.1, -99.2])
+        self.assertEqual(indices.tolist(), [[-1], [-1]])
+        self.assertTrue(np.isinf(kilometers).all())
+        self.assertEqual([len(i) for i in stations.within([19.4], [-99.1], 5)],
+                         [0])
+        self.assertIsNone(shortest_distance.get_police_station(19.4, -99.1))
+
+    def test_reloads_after_update(self):
+        empty = shortest_distance.get_stations()
+        self.assertIs(shortest_distance.get_stations(), empty)
+        self.add_stations(self.STATIONS)
+        stations = shortest_distance.get_stations()
+        self.assertIsNot(stations, empty)
+        self.assertEqual(len(stations.latitudes), 3)
+        lat, lon, km = shortest_distance.get_police_station(19.4327, -99.1333)
+        self.assertEqual((lat, lon), self.STATIONS[0])
+
+    def test_within(self):
+        self.add_stations(self.STATIONS)
+        stations = shortest_distance.get_stations()
+        points = [(19.4330, -99.1335), (19.4400, -99.1399), (19.0, -98.0)]
+        within = stations.within([p[0] for p in points],
+                                 [p[1] for p in points], 2)
+        for (lat, lon), indices in zip(points, within):
+            distances = [shortest_distance.distance(lat, lon, *station)
+                         for station in self.STATIONS]
+            expected = sorted((d, i) for i, d in enumerate(distances) if d <= 2)
+            self.assertEqual(indices.tolist(), [i for _, i in expected])
+
+
+class ArtifactCacheTests(SimpleTestCase):
+    '''
+    The disk tier of artifact_cache, in a temporary folder.
+    '''
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.cache_dir = os.path.join(tmp.name, 'cache')
+        for name, value in (('CACHE_DIR', self.cache_dir),
+                            ('MAX_DISK_BYTES', 1000),
+                            ('_MEMORY', artifact_cache.OrderedDict()),
+                            ('_MEMORY_BYTES', 0), ('_DISK_BYTES', None)):
+            patcher = mock.patch.object(artifact_cache, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_scans_when_full(self):
+        with mock.patch.object(artifact_cache.os, 'scandir',
+                               wraps=os.scandir) as scandir:
+            for i in range(4):
+                artifact_cache.put('a{}'.format(i), b'x' * 300)
+                if i < 3:
+                    # older files, evicted first
+                    os.utime(os.path.join(self.cache_dir, 'a{}'.format(i)),
+                             (i, i))
+            # the first put, to learn the size, and the fourth one
+            self.assertEqual(scandir.call_count, 2)
+
+        self.assertEqual(sorted(os.listdir(self.cache_dir)),
+                         ['a1', 'a2', 'a3'])
+        self.assertEqual(artifact_cache._DISK_BYTES, 900)
+
+    def test_disk_error(self):
+        # a file where the folder should be
+        with open(self.cache_dir, 'w'):
+            pass
+        with self.assertLogs('artifact_cache', 'WARNING'):
+            artifact_cache.put('a', b'content')
+        self.assertEqual(artifact_cache.get('a'), b'content')
+
+
+def write_name(output, name):
+    '''
+    Renderer of RenderPoolTests: writes its argument.
+    '''
+
+    output.write(name.encode())
+
+
+class BrokenPool:
+    '''
+    Worker pool whose workers died: its futures raise BrokenProcessPool.
+    '''
+
+    def __init__(self):
+        self.shut_down = False
+
+    def submit(self, func, *args):
+        future = Future()
+        future.set_exception(BrokenProcessPool('a worker died'))
+        return future
+
+    def shutdown(self, wait=True):
+        self.shut_down = True
+
+
+class RenderPoolTests(SimpleTestCase):
+    '''
+    render_pool.render_all when the worker pool breaks.
+    '''
+
+    JOBS = {'a': (write_name, ('a',)), 'b': (write_name, ('b',))}
+
+    def test_serial_after_broken_pool(self):
+        pool = BrokenPool()
+        for name, value in [('WORKERS', 2), ('_POOL', pool)]:
+            patcher = mock.patch.object(render_pool, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        self.assertEqual(render_pool.render_all(self.JOBS),
+                         {'a': b'a', 'b': b'b'})
+        # the next request starts a new pool
+        self.assertTrue(pool.shut_down)
+        self.assertIsNone(render_pool._POOL)
+
+    def test_serial_with_one_worker(self):
+        with mock.patch.object(render_pool, 'WORKERS', 1), \
+                mock.patch.object(render_pool, 'get_pool') as get_pool:
+            self.assertEqual(render_pool.render_all(self.JOBS),
+                             {'a': b'a', 'b': b'b'})
+        get_pool.assert_not_called()
+
+
+class CrimeMarkersTests(SimpleTestCase):
+    '''
+    The markers of the crimes in viz.map_cuad, one per crime up to
+    CLUSTER_THRESHOLD and a CrimeMarkers layer above it.
+    '''
+
+    PRECINCT = {'type': 'Polygon', 'coordinates': [[
+        [-99.14, 19.43], [-99.13, 19.43], [-99.13, 19.44], [-99.14, 19.43]]]}
+
+    def setUp(self):
+        import pandas as pd
+
+        self.crimes = pd.DataFrame({
+            'latitud': [19.431, 19.432, None, 19.433],
+            'longitud': [-99.131, -99.132, -99.133, -99.134],
+            'delito': ['ROBO', 'ROBO </script>', 'ROBO', 'HOMICIDIO']})
+
+    def map_cuad(self, **kwargs):
+        import viz
+
+        output = io.BytesIO()
+        viz.map_cuad(self.crimes, self.PRECINCT, output, 19.43, -99.13,
+                     (19.44, -99.12, 1.2), **kwargs)
+        return output.getvalue().decode()
+
+    def test_markers(self):
+        content = self.map_cuad()
+        # the located crimes, the address and the police station
+        self.assertEqual(content.count('L.marker('), 5)
+        self.assertNotIn('markerClusterGroup', content)
+
+    def test_clustered(self):
+        content = self.map_cuad(cluster_threshold=2)
+        self.assertEqual(content.count('markerClusterGroup'), 1)
+        # the markers of the crimes are created by the loop of the layer
+        self.assertEqual(content.count('L.marker('), 3)
+
+        points = json.loads(re.search(r'var crimes = (.*);', content)
+                            .group(1))
+        self.assertEqual(points['lat'], [19.431, 19.432, 19.433])
+        self.assertEqual(points['lon'], [-99.131, -99.132, -99.134])
+        self.assertEqual([points['delitos'][code]
+                          for code in points['delito']],
+                         ['ROBO', 'ROBO &lt;/script&gt;', 'HOMICIDIO'])
+        self.assertNotIn('</script>"', content)
+
+
+class BarTemplateTests(SimpleTestCase):
+    '''
+    The barplots of viz drawn on the templates of get_bar_template, for
+    both presets and formats.
+    '''
+
+    DIC = {'day': 'Monday', 'hour': [9, 12]}
+
+    def barplot(self, crimes, group_var, preset, fmt):
+        import pandas as pd
+        import viz
+
+        output = io.BytesIO()
+        viz.barplot(pd.DataFrame(crimes, columns=[group_var, 'crimes']),
+                    group_var, output, self.DIC, preset, fmt)
+        return output.getvalue()
+
+    def test_presets(self):
+        import viz
+
+        crimes = [('Monday', 3), ('Friday', 7)]
+        for preset, ((width, height), dpi) in viz.BAR_PRESETS.items():
+            png = self.barplot(crimes, 'weekday', preset, 'png')
+            self.assertEqual(png[:8], b'\x89PNG\r\n\x1a\n')
+            # the size of the IHDR chunk, in pixels
+            self.assertEqual((int.from_bytes(png[16:20], 'big'),
+                              int.from_bytes(png[20:24], 'big')),
+                             (width * dpi, height * dpi))
+
+            svg = self.barplot(crimes, 'weekday', preset, 'svg').decode()
+            self.assertIn('<svg', svg)
+            self.assertIn('width="{}pt"'.format(width * 72), svg)
+            self.assertIn('Crime by day of the week', svg)
+
+    def test_reused(self):
+        import viz
+
+        first = [(10, 4), (11, 2)]
+        png = self.barplot(first, 'hour', 'small', 'png')
+        template = viz.get_bar_template('hour', 'small')
+        self.assertIsNot(template, viz.get_bar_template('hour', 'full'))
+
+        other = self.barplot([(0, 50), (23, 1)], 'hour', 'small', 'png')
+        self.assertNotEqual(other, png)
+        # drawing other bars leaves nothing behind
+        self.assertEqual(self.barplot(first, 'hour', 'small', 'png'), png)
+        self.assertIs(viz.get_bar_template('hour', 'small'), template)
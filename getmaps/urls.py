@@ -1,6 +1,18 @@
-from django.urls import path
+from django.urls import path, re_path
 from . import views
 
 urlpatterns = [
     path('', views.get, name='home'),
-]
\ No newline at end of file
+    re_path(r'^artifacts/(?P<name>[a-z_]+-[0-9a-f]{32}\.(?:html|png))$',
+            views.artifact, name='artifact'),
+    path('choropleth/', views.choropleth, name='choropleth'),
+    path('precincts.geojson', views.precinct_geometry,
+         name='precinct_geometry'),
+    path('precincts/<int:level>.topojson', views.precinct_topology,
+         name='precinct_topology'),
+    path('counts.json', views.precinct_counts, name='precinct_counts'),
+    path('score.json', views.score, name='score'),
+    path('radius.json', views.radius_counts, name='radius_counts'),
+    path('metrics', views.metrics, name='metrics'),
+    path('ready', views.ready, name='ready'),
+]
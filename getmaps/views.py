@@ -5,20 +5,41 @@ Renders the html with the requested information
 
 Calls ---> geo_code from geocoding_helper to get the geocode from the address given by user
       ---> get_viz from queries module to query the information requested
+      ---> artifact_cache to serve the visualizations rendered by get_viz
+      ---> get_precinct_counts from queries module and precincts module for
+           the data-only choropleth (see CHOROPLETH_MODE in settings)
+      ---> scoring to score batches of locations as json
+      ---> count_within from queries module for the crimes near a point
+      ---> timing to time the stages of the requests and serve their
+           latency histograms
+      ---> startup for the readiness check
 
 '''
+import json
+from urllib.parse import urlencode
+from django.conf import settings
 from django.shortcuts import render
+from django.http import HttpResponse, Http404, JsonResponse
+from django.urls import reverse
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import etag, require_POST
 from django import forms
-from queries import get_viz
-from .geocoding_helper import geo_code
+from queries import get_viz, get_precinct_counts, count_within
+import artifact_cache
+import crime_db
+import precincts
+import timing
+import topology
+from . import geocode_cache
+from . import scoring
+from . import startup
+from .geocoding_helper import GeocodingError, geo_code
 
 DAYS = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
 DAYS = [(x, x) for x in DAYS]
 TYPES = [(1, 'walking'), (2, 'public transit'), [3, 'driving']]
-IMAGE_URL_1 = '/viz/bar_week.png'
-IMAGE_URL_2 = '/viz/bar_day.png'
-MAP1_URL = '/viz/map_all.html'
-MAP2_URL = '/viz/map_cuad.html'
+MAX_RADIUS_METERS = 5000
+CONTENT_TYPES = {'html': 'text/html; charset=utf-8', 'png': 'image/png'}
 
 class Multi(forms.widgets.MultiWidget):
     '''
@@ -58,16 +79,11 @@ class HourRange(forms.MultiValueField):
         return data_list
 
 
-class QueryForm(forms.Form):
+class FilterForm(forms.Form):
     '''
-    Class for Django Form
-    -Inputs from user: address (str), day(list of days), hour(integer),
-                      crime_type(categories)
+    Class for Django Form with the filters of the crimes
+    -Inputs: day(list of days), hour(integer), crime_type(categories)
     '''
-    address = forms.CharField(label='Mexico city address',
-                              help_text='e.g. Issac Newton 104 Mexico City',
-                              max_length=150)
-
     day = forms.ChoiceField(label='Days', widget=forms.RadioSelect,
                             choices=DAYS)
 
@@ -79,13 +95,33 @@ class QueryForm(forms.Form):
                                            widget=forms.CheckboxSelectMultiple,
                                            choices=TYPES)
 
+
+class QueryForm(FilterForm):
+    '''
+    Class for Django Form
+    -Inputs from user: address (str), day(list of days), hour(integer),
+                      crime_type(categories)
+    '''
+    field_order = ['address', 'day', 'hour', 'crime_type']
+
+    address = forms.CharField(label='Mexico city address',
+                              help_text='e.g. Issac Newton 104 Mexico City',
+                              max_length=150)
+
     def clean(self):
         '''
-        If the address is not in Mexico City returns an error in the form
+        If the address is not in Mexico City, or the geocoding API could not
+        answer, returns an error in the form
         '''
         if 'address' in self.cleaned_data:
             ad = self.cleaned_data['address']
-            g_code = geo_code(ad)
+            try:
+                with timing.stage('geo_code'):
+                    g_code = geo_code(ad)
+            except GeocodingError:
+                raise forms.ValidationError(
+                    'Geocoding is temporarily unavailable, please try again '
+                    'in a few minutes')
             if not g_code:
                 raise forms.ValidationError('This address is not in Mexico City')
 
@@ -106,37 +142,285 @@ def get(request):
             # check whether it's valid:
         if form.is_valid():
             # Convert form data to an args dictionary for get_maps
-            args = {}
+            args = filter_args(form.cleaned_data)
             address = form.cleaned_data['address']
             args['address'] = address
-            args['day'] = form.cleaned_data['day']
-
-            hour = form.cleaned_data['hour']
-            if hour:
-                args['hour'] = hour
-            else:
-                args['hour'] = [0, 23]
-
-            args['crime_type'] = [int(x) for x in form.cleaned_data['crime_type']]
 
             try:
-                res = get_viz(args)
-                if res is False:
+                res = get_viz(args, choropleth=not data_choropleth())
+                if not res:
                     context['err'] = 'Data requested not found. Try other time ranges'
             except Exception as e:
                 context['err'] = "Error was caught"
     else:
         form = QueryForm()
 
-    if res is True:
+    if res:
         context['result'] = args
-        context['IMAGE_URL_1'] = IMAGE_URL_1
-        context['IMAGE_URL_2'] = IMAGE_URL_2
-        context['map1'] = MAP1_URL
-        context['map2'] = MAP2_URL
+        context['IMAGE_URL_1'] = reverse('artifact', args=[res['bar_week']])
+        context['IMAGE_URL_2'] = reverse('artifact', args=[res['bar_day']])
+        if data_choropleth():
+            context['map1'] = choropleth_url(args)
+        else:
+            context['map1'] = reverse('artifact', args=[res['map_all']])
+        context['map2'] = reverse('artifact', args=[res['map_cuad']])
     else:
         context['result'] = None
 
     context['form'] = form
 
-    return render(request, 'mexcrimespage.html', context)
+    with timing.stage('template'):
+        return render(request, 'mexcrimespage.html', context)
+
+
+def filter_args(cleaned_data):
+    '''
+    Converts the cleaned data of a FilterForm to the args dictionary
+    used by the queries module.
+    '''
+    args = {}
+    args['day'] = cleaned_data['day']
+
+    hour = cleaned_data['hour']
+    if hour:
+        args['hour'] = hour
+    else:
+        args['hour'] = [0, 23]
+
+    args['crime_type'] = [int(x) for x in cleaned_data['crime_type']]
+
+    return args
+
+
+def data_choropleth():
+    '''
+    True if the choropleth is colored in the browser from precinct_counts
+    instead of rendered with folium (CHOROPLETH_MODE = 'data' in settings).
+    '''
+    return getattr(settings, 'CHOROPLETH_MODE', 'folium') == 'data'
+
+
+def choropleth_url(args):
+    '''
+    Url of the data-only choropleth page for a query.
+    '''
+    lat, lon, _ = args['address']
+    query = {'day': args['day'], 'hour_0': args['hour'][0],
+             'hour_1': args['hour'][1], 'crime_type': args['crime_type'],
+             'lat': lat, 'lon': lon}
+
+    return reverse('choropleth') + '?' + urlencode(query, doseq=True)
+
+
+def artifact(request, name):
+    '''
+    Serves a visualization rendered by get_viz. Names are made from the
+    hash of the query and the data, so the content of a name never changes
+    and browsers can keep it.
+    '''
+    content = artifact_cache.get(name)
+    if content is None:
+        raise Http404('Visualization not found')
+
+    ext = name.rsplit('.', 1)[1]
+    response = HttpResponse(content, content_type=CONTENT_TYPES[ext])
+    response['Cache-Control'] = 'public, max-age=31536000, immutable'
+
+    return response
+
+
+def choropleth(request):
+    '''
+    Renders the data-only choropleth: a page that downloads the precinct
+    geometry for its zoom level once (it is cached by the browser) and the
+    crime counts of the query, and colors the map.
+    '''
+    form = FilterForm(request.GET)
+    if not form.is_valid():
+        raise Http404('Invalid query')
+
+    try:
+        lat, lon = float(request.GET['lat']), float(request.GET['lon'])
+    except (KeyError, ValueError):
+        lat = lon = None
+
+    levels = [{'min_zoom': min_zoom,
+               'url': reverse('precinct_topology', args=[level])}
+              for level, (min_zoom, _) in enumerate(topology.LEVELS)]
+
+    context = {'levels': levels,
+               'counts_url': reverse('precinct_counts') + '?' +
+                             request.GET.urlencode(),
+               'lat': lat,
+               'lon': lon}
+
+    return render(request, 'choropleth.html', context)
+
+
+@etag(lambda request: precincts.geojson_etag())
+def precinct_geometry(request):
+    '''
+    Serves the simplified geometry of the precincts as geojson. It only
+    changes with data/cuadrantes.geojson, so browsers keep it and
+    revalidate it with its ETag.
+    '''
+    response = HttpResponse(precincts.get_geojson(),
+                            content_type='application/geo+json')
+    response['Cache-Control'] = 'public, max-age=86400'
+
+    return response
+
+
+def topology_etag(request, level):
+    '''
+    ETag of precinct_topology.
+    '''
+    if not 0 <= level < len(topology.LEVELS):
+        return None
+
+    return precincts.topojson_etag(level)
+
+
+@etag(topology_etag)
+def precinct_topology(request, level):
+    '''
+    Serves the geometry of the precincts as quantized topojson, simplified
+    for a level of topology.LEVELS. Browsers keep it and revalidate it with
+    its ETag.
+    '''
+    if not 0 <= level < len(topology.LEVELS):
+        raise Http404('Unknown level')
+
+    response = HttpResponse(precincts.get_topojson(level),
+                            content_type='application/json')
+    response['Cache-Control'] = 'public, max-age=86400'
+
+    return response
+
+
+def precinct_counts(request):
+    '''
+    Returns as json the number of crimes of each precinct for the day,
+    hour range and crime types of the query string (same fields as the
+    form). counts[i] is the number of crimes of the precinct with id i.
+    '''
+    form = FilterForm(request.GET)
+    if not form.is_valid():
+        return JsonResponse({'errors': form.errors}, status=400)
+
+    args = filter_args(form.cleaned_data)
+    with timing.stage('precinct_counts'):
+        counts = get_precinct_counts(args)
+
+    response = JsonResponse({'day': args['day'], 'hour': args['hour'],
+                             'crime_type': args['crime_type'],
+                             'counts': counts})
+    response['Cache-Control'] = 'public, max-age=3600'
+
+    return response
+
+
+def radius_counts(request):
+    '''
+    Returns as json the number of crimes within a distance (meters, up to
+    MAX_RADIUS_METERS) of a point (lat, lon), for the day, hour range and
+    crime types of the query string (same fields as the form). Unlike the
+    counts of the maps, it is not limited to the precinct of the point.
+    '''
+    form = FilterForm(request.GET)
+    if not form.is_valid():
+        return JsonResponse({'errors': form.errors}, status=400)
+
+    try:
+        lat, lon = float(request.GET['lat']), float(request.GET['lon'])
+        meters = float(request.GET['meters'])
+    except (KeyError, ValueError):
+        return JsonResponse({'errors': 'lat, lon and meters are required'},
+                            status=400)
+    if not 0 < meters <= MAX_RADIUS_METERS:
+        return JsonResponse({'errors': 'meters must be between 0 and {}'
+                                       .format(MAX_RADIUS_METERS)}, status=400)
+
+    args = filter_args(form.cleaned_data)
+    args['address'] = (lat, lon, None)
+    try:
+        with timing.stage('count_within'):
+            crimes = count_within(args, meters)
+    except crime_db.MissingIndexError as error:
+        return JsonResponse({'errors': str(error)}, status=503)
+
+    return JsonResponse({'lat': lat, 'lon': lon, 'meters': meters,
+                         'day': args['day'], 'hour': args['hour'],
+                         'crime_type': args['crime_type'],
+                         'crimes': crimes})
+
+
+@csrf_exempt
+@require_POST
+def score(request):
+    '''
+    Scores a batch of locations for other services, without geocoding or
+    visualizations. The body is a json object with a list of points:
+    {"points": [{"lat": 19.43, "lon": -99.13, "day": "Monday",
+                 "hour": [9, 12], "crime_type": [1, 2]}, ...]}
+    and the response has, in the same order, the precinct, number of crimes
+    and distance to the nearest police station of each point (see
+    scoring.score_points).
+    '''
+    try:
+        with timing.stage('parse_json'):
+            points = json.loads(request.body.decode('utf-8'))['points']
+        results = scoring.score_points(points)
+    except scoring.ScoringError as error:
+        return JsonResponse({'errors': str(error)}, status=400)
+    except (ValueError, KeyError, TypeError):
+        return JsonResponse({'errors': 'Expected a json object with a list '
+                                       'of points'}, status=400)
+
+    return JsonResponse({'results': results})
+
+
+def metrics(request):
+    '''
+    Latency histograms of the requests and their stages (see timing) and
+    the counters of the caches, in the Prometheus text format. Only served
+    to the addresses of METRICS_ALLOWED_IPS in settings.
+    '''
+    allowed = getattr(settings, 'METRICS_ALLOWED_IPS', ['127.0.0.1', '::1'])
+    if request.META.get('REMOTE_ADDR') not in allowed:
+        raise Http404('Not found')
+
+    counters = {}
+    for cache, stats in (('artifact_cache', artifact_cache.stats()),
+                         ('geocode_cache', geocode_cache.get_cache().stats)):
+        for key, value in stats.items():
+            # hits and hit_ratio are computed from the other ones
+            if key in ('hits', 'hit_ratio'):
+                continue
+            description = '{} of the {}'.format(key.replace('_', ' '),
+                                                cache.replace('_', ' '))
+            if key in ('memory_entries', 'memory_bytes'):
+                counters['mexcrimes_{}_{}'.format(cache, key)] = (
+                    description, 'gauge', value)
+            else:
+                counters['mexcrimes_{}_{}_total'.format(cache, key)] = (
+                    description, 'counter', value)
+
+    return HttpResponse(timing.metrics(counters),
+                        content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+def ready(request):
+    '''
+    Readiness check: 200 once the warm up of the process is done (see
+    startup, degraded is true if a step of it failed), 503 with its status
+    before. It only reports the status, the warm up is started when the
+    WSGI application is loaded (mexcrimes/wsgi.py). With WARM_UP = False in
+    settings the process loads everything on first use and is always ready.
+    '''
+    if not getattr(settings, 'WARM_UP', True):
+        return JsonResponse({'ready': True})
+
+    status = startup.status()
+
+    return JsonResponse(status, status=200 if status['ready'] else 503)
@@ -41,6 +41,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'getmaps.middleware.TimingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -119,5 +120,23 @@ USE_TZ = True
 # https://docs.djangoproject.com/en/2.0/howto/static-files/
 
 STATIC_URL = '/static/'
+
 MEDIA_ROOT = os.path.join(os.path.dirname(__file__),'./../viz')
-MEDIA_URL = '/viz/'
\ No newline at end of file
+MEDIA_URL = '/viz/'
+
+
+# 'folium' renders the choropleth of crimes per precinct as a standalone
+# html map. 'data' serves the precinct geometry once and only the crime
+# counts of each query, and the browser colors the map.
+CHOROPLETH_MODE = 'folium'
+
+# Server-Timing header with the duration of the stages of each request, and
+# latency histograms served at /metrics (see getmaps/middleware.py)
+REQUEST_TIMING = True
+# addresses allowed to read /metrics
+METRICS_ALLOWED_IPS = ['127.0.0.1', '::1']
+
+# load the libraries and data of the app in the background when the WSGI
+# application starts, instead of on the first requests. /ready answers 503
+# until it is done (see getmaps/startup.py)
+WARM_UP = True
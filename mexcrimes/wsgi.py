@@ -9,8 +9,14 @@ https://docs.djangoproject.com/en/2.0/howto/deployment/wsgi/
 
 import os
 
+from django.conf import settings
 from django.core.wsgi import get_wsgi_application
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "mexcrimes.settings")
 
 application = get_wsgi_application()
+
+# only server processes load this file, manage.py commands skip the warm up
+if settings.WARM_UP:
+    from getmaps import startup
+    startup.start()
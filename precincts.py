@@ -0,0 +1,211 @@
+'''
+CAPP 30122 W'20: Final Poject
+
+This module keeps the police precincts (cuadrantes) of the process, and
+their simplified geometry (geojson and topojson) for the maps.
+
+Parsing data/cuadrantes.geojson takes hundreds of milliseconds, so the
+first load writes a pickle snapshot next to it, and the dataframe is kept
+in memory afterwards. The snapshot records the size and modification time
+of the geojson file and is rebuilt when the geojson changes.
+'''
+
+import os
+import json
+import pickle
+import threading
+import topology
+
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+GEOJSON_FILENAME = os.path.join(DATA_DIR, 'cuadrantes.geojson')
+SNAPSHOT_FILENAME = os.path.join(DATA_DIR, 'cuadrantes.pkl')
+# in degrees, about 10 meters
+SIMPLIFY_TOLERANCE = 0.0001
+
+_CUADRANTES = None
+_SIGNATURE = None
+_GEOJSON = None
+_TOPOLOGIES = {}
+_LOCK = threading.Lock()
+
+
+def file_signature(filename):
+    '''
+    (size, modification time) of a file, used to notice changes.
+    '''
+
+    stat = os.stat(filename)
+
+    return (stat.st_size, stat.st_mtime_ns)
+
+
+def read_geojson(filename=GEOJSON_FILENAME):
+    '''
+    Reads the precincts from the geojson file.
+    Output:
+        geopandas dataframe with an id column equal to its index
+    '''
+
+    import geopandas as gpd
+
+    cuadrantes = gpd.read_file(filename)
+    cuadrantes["id"] = cuadrantes.index
+
+    return cuadrantes
+
+
+def load_snapshot(signature, filename=SNAPSHOT_FILENAME):
+    '''
+    Loads the precincts from the snapshot if it was built from a geojson
+    file with the given signature. Returns None otherwise.
+    '''
+
+    try:
+        with open(filename, 'rb') as f:
+            snapshot = pickle.load(f)
+    except (OSError, pickle.UnpicklingError, EOFError, AttributeError,
+            ImportError):
+        return None
+
+    if snapshot.get('signature') != signature:
+        return None
+
+    return snapshot['cuadrantes']
+
+
+def write_snapshot(cuadrantes, signature, filename=SNAPSHOT_FILENAME):
+    '''
+    Writes the snapshot of the precincts. The file is replaced atomically
+    so other processes never read half of it.
+    '''
+
+    tmp_filename = '{}.{}.tmp'.format(filename, os.getpid())
+    try:
+        with open(tmp_filename, 'wb') as f:
+            pickle.dump({'signature': signature, 'cuadrantes': cuadrantes}, f,
+                        protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_filename, filename)
+    except OSError:
+        # a read-only data folder only costs the speed up
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+
+
+def get_cuadrantes():
+    '''
+    Returns the precincts geopandas dataframe of the process. It must not be
+    modified by the callers.
+    '''
+
+    global _CUADRANTES, _SIGNATURE
+
+    signature = file_signature(GEOJSON_FILENAME)
+    if _CUADRANTES is not None and _SIGNATURE == signature:
+        return _CUADRANTES
+
+    with _LOCK:
+        if _CUADRANTES is None or _SIGNATURE != signature:
+            cuadrantes = load_snapshot(signature)
+            if cuadrantes is None:
+                cuadrantes = read_geojson()
+                write_snapshot(cuadrantes, signature)
+            _CUADRANTES, _SIGNATURE = cuadrantes, signature
+
+    return _CUADRANTES
+
+
+def get_geojson():
+    '''
+    Simplified geometry of the precincts as a geojson string, with only the
+    id of each precinct as property. Built once per version of the
+    precincts.
+    '''
+
+    global _GEOJSON
+
+    cuadrantes = get_cuadrantes()
+    geojson = _GEOJSON
+    if geojson is not None and geojson[0] is cuadrantes:
+        return geojson[1]
+
+    simple = cuadrantes[["id", "geometry"]].copy()
+    simple["geometry"] = simple.geometry.simplify(SIMPLIFY_TOLERANCE,
+                                                  preserve_topology=True)
+    content = simple.to_json()
+    _GEOJSON = (cuadrantes, content)
+
+    return content
+
+
+def geojson_etag():
+    '''
+    ETag of get_geojson, from the signature of the geojson file.
+    '''
+
+    return '{}-{}-{}'.format(*file_signature(GEOJSON_FILENAME),
+                             SIMPLIFY_TOLERANCE)
+
+
+def topojson_filename(level):
+    '''
+    Topojson file of a level of topology.LEVELS, written by get_data.
+    '''
+
+    return os.path.join(DATA_DIR, 'cuadrantes_z{}.topojson'.format(
+        topology.LEVELS[level][0]))
+
+
+def get_topojson(level):
+    '''
+    Simplified geometry of the precincts as a topojson string, at a level of
+    topology.LEVELS. It is read from the file written by get_data if that
+    file is newer than the geojson, and built from the precincts otherwise.
+    '''
+
+    cuadrantes = get_cuadrantes()
+    cached = _TOPOLOGIES.get(level)
+    if cached is not None and cached[0] is cuadrantes:
+        return cached[1]
+
+    filename = topojson_filename(level)
+    try:
+        fresh = (os.stat(filename).st_mtime_ns >=
+                 file_signature(GEOJSON_FILENAME)[1])
+    except OSError:
+        fresh = False
+
+    if fresh:
+        with open(filename) as f:
+            content = f.read()
+    else:
+        topo = topology.to_topology(cuadrantes, topology.LEVELS[level][1])
+        content = json.dumps(topo, separators=(',', ':'))
+
+    _TOPOLOGIES[level] = (cuadrantes, content)
+
+    return content
+
+
+def get_topology(level):
+    '''
+    Same as get_topojson, as a dictionary. It is a new dictionary on every
+    call, so callers can modify it.
+    '''
+
+    return json.loads(get_topojson(level))
+
+
+def topojson_etag(level):
+    '''
+    ETag of get_topojson, from the signatures of the geojson file and of
+    the topojson file of the level.
+    '''
+
+    try:
+        built = os.stat(topojson_filename(level)).st_mtime_ns
+    except OSError:
+        built = 0
+
+    return '{}-{}-{}-{}'.format(*file_signature(GEOJSON_FILENAME),
+                                topology.LEVELS[level][1], built)
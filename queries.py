@@ -4,59 +4,169 @@ CAPP 30122 W'20: Final Poject
 This module performs queries in the crimes database and calls
 the visualizations file to produce maps and plots
 
+viz (matplotlib, seaborn and folium) and pandas take seconds to import, so
+they are imported by the functions that use them, on the first request or
+during the warm up of getmaps.startup.
 '''
 
-import sqlite3
 import os
-import pandas as pd
-import geopandas as gpd
-import viz
+import math
 import shortest_distance
+import crime_cube
+import crime_db
+import crime_columns
+import precincts
+import artifact_cache
+import render_pool
+import timing
+import topology
 
 
 DATABASE_FILENAME = os.path.join(os.getcwd(), 'data/CrimesDB.sqlite3')
-CSV_FILENAME = os.path.join(os.getcwd(), "data/cuadrantes.geojson")
+METERS_PER_DEGREE = 111320
 
 
-def get_viz(dic):
+def get_viz(dic, choropleth=True):
     '''
     Produces all the visualizations that are shown through django.
+    Visualizations are rendered in memory and cached by their query
+    parameters (see artifact_cache), so they are only rendered the first
+    time a query is made. The counts of the choropleth and the barplots are
+    computed together from the crime cube (see CrimeCube.summary); only the
+    points of the precinct map are read from the database. The ones that
+    are not cached are rendered concurrently (see render_pool).
     Inputs:
         dic (dictionary): contains the data introduced by the user
+        choropleth (bool): False to skip the choropleth, when the browser
+            colors it from get_precinct_counts
     Outputs:
-        tuple of follium map objects. This funcion also exports two barplots
-        to the visualizations folder.
+        dictionary with the names of the two maps and the two barplots
+        (keys map_all, map_cuad, bar_week and bar_day) in artifact_cache,
+        or False if no crimes match the query
 	'''
 
     lat, lon, prec = dic["address"]
+    cuadrantes = precincts.get_cuadrantes()
+    tipos = get_crime_tipos(dic["crime_type"])
+    with timing.stage('cube_summary'):
+        summary = crime_cube.get_cube().summary(prec, dic["day"], dic["hour"],
+                                                tipos, cuadrantes["id"])
 
-    cuadrantes = gpd.read_file(CSV_FILENAME)
-    crime_map = filter_data(dic, "id")
-    crime_map = add_zero_precincts(crime_map, cuadrantes)
-    viz.map(crime_map, cuadrantes, "viz/map_all.html", lat, lon)
-
-    map_cuad = filter_data(dic, None)
-    if map_cuad.empty:
+    if summary["total"] == 0:
         return False
 
+    address = {"lat": float(lat), "lon": float(lon), "precinct": int(prec)}
+    query = {"day": dic["day"], "hour": [int(h) for h in dic["hour"]],
+             "tipos": sorted(tipos)}
+
+    # the address marker is drawn on both maps
+    jobs = {"map_cuad": (dict(query, **address), "html", render_map_cuad,
+                         (dic,)),
+            "bar_week": ({"day": query["day"], "tipos": query["tipos"],
+                          "precinct": address["precinct"]}, "png",
+                         render_barplot,
+                         (crimes_by_weekday(summary["by_weekday"]),
+                          'weekday', dic)),
+            "bar_day": (dict(query, precinct=address["precinct"]), "png",
+                        render_barplot,
+                        (crimes_by_hour(summary["by_hour"]), 'hour', dic))}
+    if choropleth:
+        jobs["map_all"] = (dict(query, lat=address["lat"], lon=address["lon"]),
+                           "html", render_map_all,
+                           (summary["by_precinct"], lat, lon))
+
+    # the ones missing from the cache are rendered together
+    names = {}
+    missing = {}
+    with timing.stage('artifact_cache'):
+        for kind, (params, ext, render, args) in jobs.items():
+            names[kind], cached = artifact_cache.lookup(kind, params, ext)
+            if not cached:
+                missing[names[kind]] = (render, args)
+
+    if missing:
+        with timing.stage('render'):
+            rendered = render_pool.render_all(missing)
+        with timing.stage('artifact_cache'):
+            for name, content in rendered.items():
+                artifact_cache.put(name, content)
+
+    return names
+
+
+def render_map_all(output, crimes, lat, lon):
+    '''
+    Renders the choropleth of crimes per precinct.
+    Inputs:
+        output (binary file object): where to write the html
+        crimes (array): counts per precinct of CrimeCube.summary
+        lat, lon: location of the address
+    '''
+
+    import viz
+
+    crime_map = crimes_by_precinct(crimes, precincts.get_cuadrantes()["id"])
+    level = topology.level_for_zoom(viz.ZOOM_CITY)
+    with timing.stage('viz.map'):
+        viz.map(crime_map, precincts.get_topology(level), output, lat, lon)
+
+
+def render_map_cuad(output, dic):
+    '''
+    Renders the map of the precinct of the address, with its crimes and
+    the nearest police station.
+    Inputs:
+        output (binary file object): where to write the html
+        dic (dictionary): contains the data introduced by the user
+    '''
+
+    import viz
+
+    lat, lon, prec = dic["address"]
+    with timing.stage('filter_data'):
+        map_cuad = filter_data(dic, None)
+    cuadrantes = precincts.get_cuadrantes()
     cuad = cuadrantes[cuadrantes.id == prec]
-    pol_station = shortest_distance.get_police_station(lat, lon)
-    viz.map_cuad(map_cuad, cuad, "viz/map_cuad.html", lat, lon, pol_station)
+    with timing.stage('get_police_station'):
+        pol_station = shortest_distance.get_police_station(lat, lon)
+    with timing.stage('viz.map_cuad'):
+        viz.map_cuad(map_cuad, cuad, output, lat, lon, pol_station)
+
+
+def render_barplot(output, crimes, group_var, dic):
+    '''
+    Renders a barplot (see viz.barplot).
+    '''
 
-    crime_bar_week = filter_data(dic, "weekday")
-    crime_bar_week = add_days(crime_bar_week)
-    viz.barplot(crime_bar_week, 'weekday', 'viz/bar_week.png', dic)
+    import viz
 
-    crime_bar_hour = filter_data(dic, "hour")
-    crime_bar_hour = add_hours(crime_bar_hour)
-    viz.barplot(crime_bar_hour, 'hour', 'viz/bar_day.png', dic)
+    with timing.stage('viz.barplot'):
+        viz.barplot(crimes, group_var, output, dic)
+
+
+def get_precinct_counts(dic):
+    '''
+    Number of crimes of every precinct at the day and hour range introduced
+    by the user.
+    Inputs:
+        dic (dictionary): day, hour and crime_type introduced by the user
+    Outputs:
+        list where position i is the number of crimes of the precinct i
+    '''
 
-    return True
+    cube = crime_cube.get_cube()
+    tipos = get_crime_tipos(dic["crime_type"])
+    ids = precincts.get_cuadrantes()["id"]
+
+    return cube.by_precinct(dic["day"], dic["hour"], tipos, ids).tolist()
 
 
 def filter_data(dic, group_var):
     '''
     Filters and groups crime data necessary to produce visualizations.
+    The columns of the crime table are read from their memory mapped
+    snapshot if there is one of the current database (see crime_columns),
+    and from the database otherwise.
     Inputs:
         dic (dictionary): contains the data introduced by the user.
         group_var (str): variable to group by (none, id, weekday, hour)
@@ -64,19 +174,23 @@ def filter_data(dic, group_var):
         pandas dataframe
 	'''
 
-    connection = sqlite3.connect(DATABASE_FILENAME)
-    c = connection.cursor()
+    columns = crime_columns.get_columns(DATABASE_FILENAME)
+    if columns is not None:
+        return columns.filter_data(dic, group_var,
+                                   get_crime_tipos(dic["crime_type"]))
+
+    import pandas as pd
+
+    connection = crime_db.get_connection(DATABASE_FILENAME)
 
     args, query = get_query(dic, group_var)
-    data_r = c.execute(query, args).fetchall()
+    data_r = connection.execute(query, args).fetchall()
 
     if group_var:
         cols = [group_var, "crimes"]
     else:
         cols = ["latitud", "longitud", "delito"]
 
-    connection.close()
-
     df = pd.DataFrame(data_r, columns=cols)
 
     return df
@@ -95,13 +209,19 @@ def get_query(dic, group_var):
     args = ()
     where = []
 
-    if group_var:
+    # weekday, tipo and delito are codes of lookup tables (see crime_db)
+    if group_var == "weekday":
+        select = ("(SELECT name FROM weekday_lookup WHERE code = weekday), "
+                  "count(*) FROM crime")
+    elif group_var:
         select = "{}, count(*) FROM crime".format(group_var)
     else:
-        select = "latitud, longitud, delito FROM crime".format(group_var)
+        select = ("latitud, longitud, "
+                  "(SELECT name FROM delito_lookup WHERE code = delito) "
+                  "FROM crime")
 
     if group_var != "weekday":
-        where.append("weekday = ?")
+        where.append("weekday = (SELECT code FROM weekday_lookup WHERE name = ?)")
         args += (dic["day"],)
 
     if group_var == "id" or group_var is None:
@@ -127,6 +247,115 @@ def get_query(dic, group_var):
     return (args, query)
 
 
+def filter_data_within(dic, meters, group_var):
+    '''
+    Same as filter_data, for the crimes within a distance of the address
+    instead of the crimes of its precinct.
+    Inputs:
+        dic (dictionary): contains the data introduced by the user.
+        meters (float): distance from the address
+        group_var (str): variable to group by (none, weekday, hour)
+    Outputs:
+        pandas dataframe
+    Raises crime_db.MissingIndexError if the database has no crime_rtree.
+    '''
+
+    import pandas as pd
+
+    connection = crime_db.get_connection(DATABASE_FILENAME)
+    crime_db.require_rtree(connection)
+
+    args, query = get_radius_query(dic, meters, group_var)
+    data_r = connection.execute(query, args).fetchall()
+
+    if group_var:
+        cols = [group_var, "crimes"]
+    else:
+        cols = ["latitud", "longitud", "delito"]
+
+    return pd.DataFrame(data_r, columns=cols)
+
+
+def count_within(dic, meters):
+    '''
+    Number of crimes within a distance of the address at the day, hour
+    range and crime types introduced by the user.
+    Inputs:
+        dic (dictionary): contains the data introduced by the user.
+        meters (float): distance from the address
+    Output:
+        int
+    Raises crime_db.MissingIndexError if the database has no crime_rtree.
+    '''
+
+    connection = crime_db.get_connection(DATABASE_FILENAME)
+    crime_db.require_rtree(connection)
+
+    args, query = get_radius_query(dic, meters, "total")
+
+    return connection.execute(query, args).fetchone()[0]
+
+
+def get_radius_query(dic, meters, group_var):
+    '''
+    Obtain sql query and arguments of the crimes within a distance of the
+    address. The R*Tree of crime_db gives the crimes in the bounding box of
+    the circle, which are then read from the crime table, and the ones
+    outside the circle are dropped with the equirectangular distance (exact
+    to centimeters at a few kilometers).
+    Inputs:
+        dic (dictionary): contains the data introduced by the user.
+        meters (float): distance from the address
+        group_var (str): variable to group by (none, weekday, hour), or
+            total for the number of crimes
+    Output:
+        tuple of query and arguments
+    '''
+
+    lat, lon = float(dic["address"][0]), float(dic["address"][1])
+    lat_meters = METERS_PER_DEGREE
+    lon_meters = METERS_PER_DEGREE * math.cos(math.radians(lat))
+    lat_delta, lon_delta = meters / lat_meters, meters / lon_meters
+
+    if group_var == "weekday":
+        select = "(SELECT name FROM weekday_lookup WHERE code = weekday), count(*)"
+    elif group_var == "hour":
+        select = "hour, count(*)"
+    elif group_var == "total":
+        select = "count(*)"
+    else:
+        select = ("latitud, longitud, "
+                  "(SELECT name FROM delito_lookup WHERE code = delito)")
+
+    where = ["max_lat >= ?", "min_lat <= ?", "max_lon >= ?", "min_lon <= ?",
+             "((latitud - ?) * ?) * ((latitud - ?) * ?) + "
+             "((longitud - ?) * ?) * ((longitud - ?) * ?) <= ?"]
+    args = (lat - lat_delta, lat + lat_delta, lon - lon_delta, lon + lon_delta,
+            lat, lat_meters, lat, lat_meters, lon, lon_meters, lon, lon_meters,
+            meters * meters)
+
+    if group_var != "weekday":
+        where.append("weekday = (SELECT code FROM weekday_lookup WHERE name = ?)")
+        args += (dic["day"],)
+
+    if group_var != "hour":
+        where.append("hour >= ?")
+        where.append("hour <= ?")
+        args += (dic["hour"][0], dic["hour"][1])
+
+    args_type, where_type = get_query_crimetype(dic["crime_type"])
+    args += tuple(args_type)
+    where.append(where_type)
+
+    # CROSS JOIN: sqlite3 keeps the order, the R*Tree is searched first
+    query = ("SELECT {} FROM crime_rtree r CROSS JOIN crime c ON c.n = r.n "
+             "WHERE {}".format(select, ' AND '.join(where)))
+    if group_var in ("weekday", "hour"):
+        query += " GROUP BY {}".format(group_var)
+
+    return (args, query)
+
+
 def get_query_crimetype(crime_type):
     '''
     Produces the part of the query related to the type of crime introduced
@@ -137,57 +366,73 @@ def get_query_crimetype(crime_type):
         tuple containing arguments and query
 	'''
 
-    args = ()
+    tipos = get_crime_tipos(crime_type)
+    args = tipos
+    q_marks = ', '.join(['?'] * len(tipos))
+
+    where = "tipo in (SELECT code FROM tipo_lookup WHERE name in ({}))".format(q_marks)
+
+    return (args, where)
+
+
+def get_crime_tipos(crime_type):
+    '''
+    Types of crime (as stored in the tipo column) that are relevant for the
+    ways of getting around introduced by the user
+    Input:
+        crime_type: list of crime types to be considered
+    Output:
+        tuple of types of crime
+    '''
+
     dic_cat = {1: "walking", 2:"public transit", 3:"personal vehicle"}
-    q_marks = '?' + ', ?'*(len(crime_type))
+    tipos = ()
 
     if 1 in crime_type or 2 in crime_type:
-        args += ("rape",)
-        q_marks += ', ?'
+        tipos += ("rape",)
 
-    args += ("homicide",)
+    tipos += ("homicide",)
 
     for val in crime_type:
-        args += (dic_cat[val],)
-
-    where = "tipo in ({})".format(q_marks)
+        tipos += (dic_cat[val],)
 
-    return (args, where)
+    return tipos
 
 
-def add_zero_precincts(crime_data, precinct_data):
+def crimes_by_precinct(crimes, ids):
     '''
-    adds missing precincts to the data with value 0
+    Number of crimes per precinct at the day and hour range introduced by
+    the user. Precincts without crimes have value 0.
+    Inputs:
+        crimes (array): counts of CrimeCube.summary, aligned with ids
+        ids (series): ids of the precincts
+    Output:
+        pandas dataframe with columns id and crimes
     '''
 
-    crime = pd.merge(crime_data, precinct_data["id"], on="id", how="right")
-    crime = crime.fillna(0)
+    import pandas as pd
 
-    return crime
+    return pd.DataFrame({"id": ids.values, "crimes": crimes})
 
 
-def add_days(crime_data):
+def crimes_by_weekday(crimes):
     '''
-    adds missing days to the data with value 0
+    Number of crimes per day of the week (all hours) in the precinct of the
+    address introduced by the user. Days without crimes have value 0.
     '''
 
-    week_days = ['Sunday', 'Monday', 'Tuesday', 'Wednesday', 'Thursday',
-                 'Friday', 'Saturday']
-    days = pd.Series(week_days, name="weekday")
-    crime = pd.merge(crime_data, days, on="weekday", how="right")
-    crime = crime.fillna(0)
+    import pandas as pd
 
-    return crime
+    return pd.DataFrame({"weekday": crime_cube.WEEK_DAYS, "crimes": crimes})
 
 
-def add_hours(crime_data):
+def crimes_by_hour(crimes):
     '''
-    adds missing hours to the data with value 0
+    Number of crimes per hour on the day introduced by the user in the
+    precinct of the address. Hours without crimes have value 0.
     '''
 
-    hours = pd.Series(list(range(24)), name="hour")
-    crime = pd.merge(crime_data, hours, on="hour", how="right")
-    crime = crime.fillna(0)
-    crime = crime.sort_values(by=['hour'])
+    import pandas as pd
 
-    return crime
+    return pd.DataFrame({"hour": list(range(crime_cube.HOURS)),
+                         "crimes": crimes})
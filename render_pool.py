@@ -0,0 +1,141 @@
+'''
+CAPP 30122 W'20: Final Poject
+
+This module renders the visualizations of a query in parallel.
+
+Rendering is CPU bound and holds the GIL, so threads would not help.
+Instead, the visualizations missing from the cache are rendered by a pool
+of worker processes, started once with viz, matplotlib, the precincts and
+the police stations already loaded, so a request takes the time of its
+slowest visualization instead of the sum of all of them.
+With WORKERS set to 1 (or if the pool breaks) they are rendered one after
+another in the calling process.
+The stages timed by the renderers in the workers are sent back with the
+visualizations and added to the ones of the request (see timing).
+'''
+
+import io
+import os
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import timing
+
+
+WORKERS = min(4, os.cpu_count() or 1)
+
+_POOL = None
+_LOCK = threading.Lock()
+
+
+def render(func, *args):
+    '''
+    Renders a visualization.
+    Inputs:
+        func (function): called with a binary file object and args, writes
+            the visualization to it
+        args: arguments of func
+    Output:
+        bytes of the visualization
+    '''
+
+    output = io.BytesIO()
+    func(output, *args)
+
+    return output.getvalue()
+
+
+def render_timed(func, *args):
+    '''
+    Same as render, timing the stages of func.
+    Output:
+        (bytes of the visualization, stages as returned by timing.stop)
+    '''
+
+    timing.start()
+    try:
+        content = render(func, *args)
+    finally:
+        stages = timing.stop()
+
+    return content, stages
+
+
+def warm_up():
+    '''
+    Loads what the renderers need in a worker process, so the first request
+    it gets does not pay for it.
+    '''
+
+    import queries
+    import crime_columns
+    import precincts
+    import shortest_distance
+    import topology
+    import viz
+
+    precincts.get_topojson(topology.level_for_zoom(viz.ZOOM_CITY))
+    shortest_distance.get_stations()
+    crime_columns.get_columns(queries.DATABASE_FILENAME)
+
+    # the fonts are loaded the first time a figure is drawn
+    for group_var in ('weekday', 'hour'):
+        template = viz.get_bar_template(group_var)
+        template.draw([0] * len(template.bars), [False] * len(template.bars),
+                      '', io.BytesIO())
+
+
+def get_pool():
+    '''
+    Returns the worker pool of the process, starting it on first use.
+    '''
+
+    global _POOL
+
+    if _POOL is None:
+        with _LOCK:
+            if _POOL is None:
+                # spawn: forking a threaded server can copy locks held by
+                # other threads
+                pool = ProcessPoolExecutor(
+                    WORKERS, mp_context=multiprocessing.get_context('spawn'),
+                    initializer=warm_up)
+                # start all the workers now instead of on demand
+                for _ in range(WORKERS):
+                    pool.submit(os.getpid)
+                _POOL = pool
+
+    return _POOL
+
+
+def render_all(jobs):
+    '''
+    Renders visualizations concurrently in the worker pool.
+    Input:
+        jobs (dictionary): name -> (func, args) as in render. func must be
+            a module level function, it is sent to other processes
+    Output:
+        dictionary name -> bytes of the visualization
+    '''
+
+    global _POOL
+
+    if WORKERS > 1 and len(jobs) > 1:
+        pool = get_pool()
+        try:
+            futures = {name: pool.submit(render_timed, func, *args)
+                       for name, (func, args) in jobs.items()}
+            results = {}
+            for name, future in futures.items():
+                results[name], stages = future.result()
+                timing.add(stages)
+            return results
+        except BrokenProcessPool:
+            # a worker died: start a new pool on the next request
+            with _LOCK:
+                if _POOL is pool:
+                    _POOL = None
+            pool.shutdown(wait=False)
+
+    return {name: render(func, *args) for name, (func, args) in jobs.items()}
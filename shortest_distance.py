@@ -3,13 +3,152 @@ File name: shortest_distance.py
 
 This module finds the nearest police station from the given address.
 
+The police stations are loaded once into a KD-tree over their positions
+as 3D unit vectors, where the straight-line (chord) distance grows with
+the distance over the surface of the earth, so nearest neighbours on the
+tree are nearest neighbours on the map.
+
 Calls --> CrimesDB.sqlite3 database
 '''
 from math import radians, cos, sin, asin, sqrt
-import sqlite3
 import os
+import threading
+import numpy as np
+import crime_cube
+import crime_db
 
 DATABASE_FILENAME = os.path.join(os.getcwd(), 'data/CrimesDB.sqlite3')
+EARTH_RADIUS_KM = 6367
+
+_STATIONS = None
+_SIGNATURE = None
+_LOCK = threading.Lock()
+
+
+class StationIndex:
+    '''
+    KD-tree over the locations of the police stations.
+    '''
+
+    def __init__(self, latitudes, longitudes):
+        '''
+        Inputs:
+            -latitudes, longitudes (arrays) location of the police stations
+        '''
+        # scipy takes half a second to import, see getmaps.startup
+        from scipy.spatial import cKDTree
+
+        self.latitudes = np.asarray(latitudes, dtype=float)
+        self.longitudes = np.asarray(longitudes, dtype=float)
+        self.tree = cKDTree(to_unit_vectors(self.latitudes, self.longitudes))
+
+    def nearest(self, latitudes, longitudes, k=1):
+        '''
+        Finds the k nearest police stations of a batch of points.
+
+        Inputs:
+            -latitudes, longitudes (arrays or floats) points to search from
+            -k (int) number of police stations per point
+        Output:
+            -tuple of arrays (indices, kilometers) of shape (n_points, k),
+             sorted by distance. indices point into self.latitudes and
+             self.longitudes, -1 (at infinite kilometers) past the number
+             of police stations
+        '''
+        points = to_unit_vectors(np.atleast_1d(latitudes),
+                                 np.atleast_1d(longitudes))
+        chords, indices = self.tree.query(points, k=k)
+
+        chords = np.asarray(chords).reshape(len(points), -1)
+        indices = np.asarray(indices).reshape(len(points), -1)
+        missing = np.isinf(chords)
+
+        return (np.where(missing, -1, indices),
+                np.where(missing, np.inf, chord_to_km(chords)))
+
+    def within(self, latitudes, longitudes, radius_km):
+        '''
+        Finds the police stations within a radius of a batch of points.
+
+        Inputs:
+            -latitudes, longitudes (arrays or floats) points to search from
+            -radius_km (float) radius in kilometers
+        Output:
+            -list with an array of indices per point, sorted by distance
+        '''
+        points = to_unit_vectors(np.atleast_1d(latitudes),
+                                 np.atleast_1d(longitudes))
+        found = self.tree.query_ball_point(points, km_to_chord(radius_km))
+
+        within = []
+        for point, indices in zip(points, found):
+            indices = np.array(indices, dtype=np.int64)
+            chords = np.linalg.norm(self.tree.data[indices] - point, axis=1)
+            within.append(indices[np.argsort(chords, kind='stable')])
+
+        return within
+
+
+def to_unit_vectors(latitudes, longitudes):
+    '''
+    Converts latitudes and longitudes (in degrees) to points on the
+    unit sphere.
+    '''
+    lat = np.radians(np.asarray(latitudes, dtype=float))
+    lon = np.radians(np.asarray(longitudes, dtype=float))
+
+    return np.column_stack((np.cos(lat) * np.cos(lon),
+                            np.cos(lat) * np.sin(lon),
+                            np.sin(lat)))
+
+
+def chord_to_km(chords):
+    '''
+    Converts chord lengths on the unit sphere to kilometers over the
+    surface of the earth.
+    '''
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.minimum(chords, 2) / 2)
+
+
+def km_to_chord(kilometers):
+    '''
+    Converts kilometers over the surface of the earth to chord lengths on
+    the unit sphere.
+    '''
+    return 2 * np.sin(min(kilometers / EARTH_RADIUS_KM, np.pi) / 2)
+
+
+def load_stations(filename=DATABASE_FILENAME):
+    '''
+    Builds the KD-tree of the police stations in the database (empty if
+    there are none).
+    '''
+    connection = crime_db.get_connection(filename)
+    query = ("SELECT latitud, longitud FROM police_station "
+             "WHERE latitud IS NOT NULL AND longitud IS NOT NULL")
+    rows = np.array(connection.execute(query).fetchall(),
+                    dtype=float).reshape(-1, 2)
+
+    return StationIndex(rows[:, 0], rows[:, 1])
+
+
+def get_stations():
+    '''
+    Returns the police station index of the process, loading it on
+    first use and after the database is updated.
+    '''
+    global _STATIONS, _SIGNATURE
+
+    signature = crime_cube.database_signature(DATABASE_FILENAME)
+    if _STATIONS is not None and _SIGNATURE == signature:
+        return _STATIONS
+
+    with _LOCK:
+        if _STATIONS is None or _SIGNATURE != signature:
+            _STATIONS, _SIGNATURE = load_stations(DATABASE_FILENAME), signature
+
+    return _STATIONS
+
 
 def get_police_station(latitude, longitude):
     '''
@@ -22,20 +161,17 @@ def get_police_station(latitude, longitude):
         -data_row (tuple): latitude of the police station,
                          longitude of police station,
                          distance from address
+         None if there are no police stations
     '''
 
-    connection = sqlite3.connect(DATABASE_FILENAME)
-    c = connection.cursor()
-    connection.create_function('distance', 4, distance)
-
-    sel = "latitud, longitud, min(distance(?, ?, latitud, longitud)) AS kilometers"
-    frm = "police_station"
-    query = "SELECT {} FROM {}".format(sel, frm)
-    args = (latitude, longitude)
-
-    data_row = c.execute(query, args).fetchone()
+    stations = get_stations()
+    indices, kilometers = stations.nearest(latitude, longitude)
+    i = indices[0, 0]
+    if i < 0:
+        return None
 
-    connection.close()
+    data_row = (float(stations.latitudes[i]), float(stations.longitudes[i]),
+                float(kilometers[0, 0]))
 
     return data_row
 
@@ -59,6 +195,6 @@ def distance(lat1, long1, lat2, long2):
     a = sin(dlat / 2)**2 + cos(lat1) * cos(lat2) * sin(dlong / 2)**2
     c = 2 * asin(sqrt(a))
 
-    distance_km = 6367 * c
+    distance_km = EARTH_RADIUS_KM * c
 
     return distance_km
@@ -0,0 +1,198 @@
+'''
+CAPP 30122 W'20: Final Poject
+
+This module generates synthetic crime data over the real police precincts
+(data/cuadrantes.geojson), so the benchmarks can run offline and at any
+scale (e.g. 100k, 1M or 10M crimes).
+
+The crimes are spread over the precincts with random weights with a long
+tail (a few precincts get many more crimes than the rest, as in the real
+data) and placed uniformly inside them. build_database writes them, along
+with synthetic police stations, to a database with the schema of crime_db,
+in batches, so memory use does not grow with the number of crimes.
+
+Run: python3 synthetic.py <number of crimes> <database filename>
+'''
+
+import sys
+import sqlite3
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+try:
+    from shapely import contains_xy
+except ImportError:
+    # Shapely < 2.0
+    from shapely.vectorized import contains as contains_xy
+import crime_db
+import data_cleaning as dc
+import precincts
+
+
+BATCH_SIZE = 500000
+N_STATIONS = 80
+# delitos of the export: the ones the app keeps and a few it drops
+DELITOS = list(dc.DELITO_TIPO) + ['FRAUDE', 'AMENAZAS', 'DESPOJO']
+START = pd.Timestamp('2018-01-01')
+MINUTES = 2 * 365 * 24 * 60
+
+
+def precinct_weights(seed=0, cuadrantes=None):
+    '''
+    Share of the crimes of each precinct (lognormal, so that a few
+    precincts concentrate the crimes).
+    Inputs:
+        seed (int)
+        cuadrantes (geopandas dataframe): by default the precincts of
+            precincts.get_cuadrantes
+    Output:
+        numpy array aligned with cuadrantes, adds up to 1
+    '''
+
+    if cuadrantes is None:
+        cuadrantes = precincts.get_cuadrantes()
+
+    weights = np.random.RandomState(seed).lognormal(0, 1, len(cuadrantes))
+
+    return weights / weights.sum()
+
+
+def sample_points(n_points, rng, weights=None, cuadrantes=None):
+    '''
+    Random points inside the precincts: the number of points of each
+    precinct follows weights, and they are placed uniformly in it (sampled
+    in its bounding box, keeping the ones inside).
+    Inputs:
+        n_points (int)
+        rng (numpy RandomState)
+        weights (array): see precinct_weights, by default the same for all
+            the precincts
+        cuadrantes (geopandas dataframe): by default the precincts of
+            precincts.get_cuadrantes
+    Output:
+        (latitudes, longitudes, ids): numpy arrays with the location and
+        the precinct id of each point, in random order
+    '''
+
+    if cuadrantes is None:
+        cuadrantes = precincts.get_cuadrantes()
+    if weights is None:
+        weights = np.full(len(cuadrantes), 1 / len(cuadrantes))
+
+    counts = rng.multinomial(n_points, weights)
+    latitudes = np.empty(n_points)
+    longitudes = np.empty(n_points)
+    ids = np.empty(n_points, dtype=np.int64)
+
+    start = 0
+    for geometry, precinct_id, count in zip(cuadrantes.geometry,
+                                            cuadrantes.id, counts):
+        end = start + count
+        minx, miny, maxx, maxy = geometry.bounds
+        while start < end:
+            missing = end - start
+            x = rng.uniform(minx, maxx, 2 * missing + 16)
+            y = rng.uniform(miny, maxy, 2 * missing + 16)
+            inside = contains_xy(geometry, x, y)
+            x, y = x[inside][:missing], y[inside][:missing]
+            longitudes[start:start + len(x)] = x
+            latitudes[start:start + len(y)] = y
+            start += len(x)
+        ids[end - count:end] = precinct_id
+
+    order = rng.permutation(n_points)
+
+    return latitudes[order], longitudes[order], ids[order]
+
+
+def raw_crimes(n_rows, seed=0, weights=None, delitos=DELITOS,
+               with_precinct=False):
+    '''
+    Synthetic crime export as returned by the open data portal (before
+    data_cleaning), with n_rows crimes over two years.
+    Inputs:
+        n_rows (int)
+        seed (int)
+        weights (array): share of the crimes of each precinct, see
+            precinct_weights
+        delitos (list): delitos to choose from
+        with_precinct (bool): add the id of the precinct of each crime, as
+            after the spatial join of get_data
+    Output:
+        geopandas dataframe
+    '''
+
+    rng = np.random.RandomState(seed)
+    latitudes, longitudes, ids = sample_points(n_rows, rng, weights)
+    minutes = rng.randint(0, MINUTES, n_rows)
+    fecha = START + pd.to_timedelta(minutes, unit='min')
+
+    crimes = gpd.GeoDataFrame({
+        'delito': rng.choice(delitos, n_rows),
+        'fecha_hechos': fecha.strftime('%Y-%m-%d %H:%M:%S'),
+        'categoria_delito': 'DELITO DE BAJO IMPACTO',
+        'geometry': gpd.points_from_xy(longitudes, latitudes)})
+    if with_precinct:
+        crimes['id'] = ids
+
+    return crimes
+
+
+def police_stations(n_stations=N_STATIONS, seed=0):
+    '''
+    Synthetic police stations, in random precincts.
+    Output:
+        pandas dataframe with the columns of the police_station table
+    '''
+
+    latitudes, longitudes, _ = sample_points(n_stations,
+                                             np.random.RandomState(seed))
+
+    return pd.DataFrame({
+        'nomenclatu': ['MP-{}'.format(i) for i in range(n_stations)],
+        'latitud': latitudes, 'longitud': longitudes})
+
+
+def build_database(filename, n_rows, seed=0, batch_size=BATCH_SIZE):
+    '''
+    Writes a database with the schema of crime_db with n_rows synthetic
+    crimes (all of them of the types the app keeps) and synthetic police
+    stations. The crimes are generated, cleaned and loaded in batches.
+    Inputs:
+        filename (str): path of the sqlite3 database, replaced if it exists
+        n_rows (int): number of crimes
+        seed (int)
+        batch_size (int): crimes per batch
+    '''
+
+    weights = precinct_weights(seed)
+    conn = sqlite3.connect(filename)
+    with conn:
+        conn.execute('DROP TABLE IF EXISTS police_station')
+        crime_db.create_schema(conn)
+
+    for start in range(0, n_rows, batch_size):
+        crimes = raw_crimes(min(batch_size, n_rows - start), seed + start,
+                            weights, list(dc.DELITO_TIPO), with_precinct=True)
+        dc.clean_crimes_data(crimes)
+        crimes['latitud'] = crimes.geometry.y
+        crimes['longitud'] = crimes.geometry.x
+        crimes = pd.DataFrame(crimes.drop(columns='geometry'))
+        high_water_mark = (crimes['date'] + ' ' + crimes['time']).max()
+
+        with conn:
+            previous = crime_db.get_meta(conn, 'high_water_mark')
+            conn.execute('DROP TABLE IF EXISTS crime_new')
+            crimes.to_sql('crime_new', conn, index=False)
+            crime_db.load_staging(conn, 'crime_new',
+                                  max(high_water_mark, previous or ''))
+            conn.execute('DROP TABLE crime_new')
+
+    with conn:
+        police_stations(seed=seed).to_sql('police_station', conn,
+                                          index=False)
+    conn.close()
+
+
+if __name__ == "__main__":
+    build_database(sys.argv[2], int(sys.argv[1]))
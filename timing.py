@@ -0,0 +1,219 @@
+'''
+CAPP 30122 W'20: Final Poject
+
+This module times the stages of the requests of the web app (geocoding,
+precinct lookup, queries, renders...) and keeps latency histograms of them
+in memory, exported in the Prometheus text format.
+
+The code to time is wrapped in stage(name). Stages are only timed while a
+request is being timed (between start and stop, see
+getmaps.middleware.TimingMiddleware), so they cost nothing elsewhere (e.g.
+in get_data or the benchmarks). The time of a stage that runs more than
+once in a request is added up, and each request adds its total of every
+stage to the histograms. Renders in the worker processes of render_pool
+time their own stages and send them back with the visualization (see
+add).
+
+Histograms are per process: with several server processes, each one
+exports its own.
+'''
+
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+
+
+# upper bounds (seconds) of the histogram buckets
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5,
+           5, 10)
+ENABLED = True
+
+_LOCAL = threading.local()
+_LOCK = threading.Lock()
+# metric name -> {label value: Histogram}
+_HISTOGRAMS = {'stage': {}, 'request': {}}
+
+
+class Histogram:
+    '''
+    Number of observations in each bucket of BUCKETS (and above the last
+    one), their sum and their number.
+    '''
+
+    def __init__(self):
+        self.buckets = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, seconds):
+        self.buckets[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.sum += seconds
+        self.count += 1
+
+
+def start():
+    '''
+    Starts timing the stages of the current thread. Calls can be nested:
+    the stages are kept by the innermost one.
+    '''
+
+    if ENABLED:
+        stack = getattr(_LOCAL, 'stack', None)
+        if stack is None:
+            stack = _LOCAL.stack = []
+        stack.append({})
+
+
+def stop():
+    '''
+    Stops timing the stages of the current thread.
+    Output:
+        dictionary stage -> [seconds, number of times it ran] since the
+        matching start, empty if timing is disabled
+    '''
+
+    stack = getattr(_LOCAL, 'stack', None)
+
+    return stack.pop() if stack else {}
+
+
+def add(stages):
+    '''
+    Adds stages timed elsewhere (e.g. in another process) to the ones of
+    the current thread.
+    Input:
+        stages (dictionary): as returned by stop
+    '''
+
+    stack = getattr(_LOCAL, 'stack', None)
+    if not stack:
+        return
+
+    current = stack[-1]
+    for name, (seconds, count) in stages.items():
+        total = current.setdefault(name, [0.0, 0])
+        total[0] += seconds
+        total[1] += count
+
+
+@contextmanager
+def stage(name):
+    '''
+    Times the code of a with block as the stage name, if the stages of
+    the current thread are being timed.
+    '''
+
+    stack = getattr(_LOCAL, 'stack', None)
+    if not stack:
+        yield
+        return
+
+    begin = time.perf_counter()
+    try:
+        yield
+    finally:
+        total = stack[-1].setdefault(name, [0.0, 0])
+        total[0] += time.perf_counter() - begin
+        total[1] += 1
+
+
+def observe(view, seconds, stages):
+    '''
+    Adds a request to the histograms.
+    Inputs:
+        view (str): name of the view that answered the request
+        seconds (float): duration of the request
+        stages (dictionary): as returned by stop
+    '''
+
+    with _LOCK:
+        _histogram('request', view).observe(seconds)
+        for name, (stage_seconds, _) in stages.items():
+            _histogram('stage', name).observe(stage_seconds)
+
+
+def _histogram(metric, label):
+    '''
+    Histogram of a metric and label value, created on first use. The
+    caller holds _LOCK.
+    '''
+
+    histograms = _HISTOGRAMS[metric]
+    if label not in histograms:
+        histograms[label] = Histogram()
+
+    return histograms[label]
+
+
+def server_timing(stages, seconds=None):
+    '''
+    Value of the Server-Timing header of a response, with the duration of
+    every stage in milliseconds (stages rendered concurrently overlap).
+    Inputs:
+        stages (dictionary): as returned by stop
+        seconds (float): duration of the whole request, reported as total
+    Output:
+        str
+    '''
+
+    entries = []
+    for name, (stage_seconds, count) in stages.items():
+        entry = '{};dur={:.1f}'.format(name, stage_seconds * 1000)
+        if count > 1:
+            entry += ';desc="{} calls"'.format(count)
+        entries.append(entry)
+    if seconds is not None:
+        entries.append('total;dur={:.1f}'.format(seconds * 1000))
+
+    return ', '.join(entries)
+
+
+def metrics(counters=None):
+    '''
+    Histograms of the stages and requests in the Prometheus text format.
+    Input:
+        counters (dictionary): other metrics to export, name ->
+            (help text, type, value)
+    Output:
+        str
+    '''
+
+    lines = []
+    for metric, label, description in (
+            ('stage', 'stage', 'Time spent in each stage of a request.'),
+            ('request', 'view', 'Duration of the requests.')):
+        name = 'mexcrimes_{}_seconds'.format(metric)
+        lines.append('# HELP {} {}'.format(name, description))
+        lines.append('# TYPE {} histogram'.format(name))
+
+        with _LOCK:
+            histograms = sorted((key, list(h.buckets), h.sum, h.count)
+                                for key, h in _HISTOGRAMS[metric].items())
+
+        for key, buckets, total, count in histograms:
+            cumulative = 0
+            for bound, observations in zip(BUCKETS + ('+Inf',), buckets):
+                cumulative += observations
+                lines.append('{}_bucket{{{}="{}",le="{}"}} {}'.format(
+                    name, label, key, bound, cumulative))
+            lines.append('{}_sum{{{}="{}"}} {}'.format(name, label, key, total))
+            lines.append('{}_count{{{}="{}"}} {}'.format(name, label, key,
+                                                          count))
+
+    for name, (description, kind, value) in sorted((counters or {}).items()):
+        lines.append('# HELP {} {}'.format(name, description))
+        lines.append('# TYPE {} {}'.format(name, kind))
+        lines.append('{} {}'.format(name, value))
+
+    return '\n'.join(lines) + '\n'
+
+
+def reset():
+    '''
+    Empties the histograms.
+    '''
+
+    with _LOCK:
+        for histograms in _HISTOGRAMS.values():
+            histograms.clear()
@@ -0,0 +1,220 @@
+'''
+CAPP 30122 W'20: Final Poject
+
+This module converts the police precincts to simplified, quantized
+TopoJSON (https://github.com/topojson/topojson-specification).
+
+Neighbouring precincts share their borders, so the rings of the polygons
+are cut into arcs at the points where the precincts that meet change,
+and every arc is stored once. Arcs are simplified on their own (keeping
+their end points), so both sides of a border are simplified the same way
+and no gaps or overlaps appear between precincts. Coordinates are
+quantized to an integer grid and delta encoded.
+'''
+
+import json
+
+
+# (minimum zoom of the map, simplification tolerance in degrees). At the
+# latitude of Mexico City a pixel covers about 0.0006 degrees at zoom 11,
+# and half of that at every next zoom level.
+LEVELS = [(0, 0.0005), (13, 0.00015), (15, 0.00003)]
+QUANTIZATION = 100000
+OBJECT_NAME = 'cuadrantes'
+
+
+def level_for_zoom(zoom):
+    '''
+    Index in LEVELS of the resolution to use at a zoom level.
+    '''
+
+    level = 0
+    for i, (min_zoom, _) in enumerate(LEVELS):
+        if zoom >= min_zoom:
+            level = i
+
+    return level
+
+
+def polygons_of(geometry):
+    '''
+    List of polygons of a Polygon or MultiPolygon.
+    '''
+
+    if geometry.geom_type == 'Polygon':
+        return [geometry]
+
+    return list(geometry.geoms)
+
+
+def quantize_ring(coords, translate, scale):
+    '''
+    Quantizes the coordinates of a ring to the integer grid, dropping
+    repeated points. The closing point is not included.
+    '''
+
+    ring = []
+    for x, y in coords:
+        point = (int(round((x - translate[0]) / scale[0])),
+                 int(round((y - translate[1]) / scale[1])))
+        if not ring or ring[-1] != point:
+            ring.append(point)
+
+    if len(ring) > 1 and ring[0] == ring[-1]:
+        ring.pop()
+
+    return ring
+
+
+def find_junctions(rings):
+    '''
+    Points where the rings that go through them change: a point is a
+    junction if it is reached with different neighbours from different
+    rings (or from different places of the same ring).
+    '''
+
+    neighbours = {}
+    junctions = set()
+
+    for ring in rings:
+        n = len(ring)
+        for i, point in enumerate(ring):
+            pair = frozenset((ring[i - 1], ring[(i + 1) % n]))
+            seen = neighbours.setdefault(point, pair)
+            if seen != pair:
+                junctions.add(point)
+
+    return junctions
+
+
+def cut_ring(ring, junctions):
+    '''
+    Cuts a ring at its junctions. Each arc starts and ends at a junction;
+    a ring without junctions is a single closed arc.
+    '''
+
+    cuts = [i for i, point in enumerate(ring) if point in junctions]
+    if not cuts:
+        # start at the lowest point, so a ring that is also a hole of
+        # another precinct is found as the same (reversed) arc
+        start = ring.index(min(ring))
+        rotated = ring[start:] + ring[:start]
+        return [rotated + [rotated[0]]]
+
+    start = cuts[0]
+    rotated = ring[start:] + ring[:start]
+    cuts = [i - start for i in cuts]
+
+    arcs = []
+    for j, i in enumerate(cuts):
+        end = cuts[j + 1] if j + 1 < len(cuts) else len(rotated)
+        arc = rotated[i:end + 1] if end < len(rotated) else rotated[i:] + [rotated[0]]
+        arcs.append(arc)
+
+    return arcs
+
+
+def simplify_arc(arc, tolerance):
+    '''
+    Douglas-Peucker simplification of an arc, keeping its end points.
+    Closed arcs keep at least four points so the ring stays a polygon.
+    '''
+
+    from shapely.geometry import LineString
+
+    if tolerance <= 0 or len(arc) <= 2:
+        return arc
+
+    simple = LineString(arc).simplify(tolerance, preserve_topology=True)
+    simple = [(int(x), int(y)) for x, y in simple.coords]
+
+    if arc[0] == arc[-1] and len(simple) < 4:
+        return arc
+
+    return simple
+
+
+def delta_encode(arc):
+    '''
+    First point of an arc, then the differences between consecutive
+    points, as TopoJSON expects.
+    '''
+
+    encoded = [list(arc[0])]
+    for (x0, y0), (x1, y1) in zip(arc, arc[1:]):
+        encoded.append([x1 - x0, y1 - y0])
+
+    return encoded
+
+
+def to_topology(precincts, tolerance, quantization=QUANTIZATION):
+    '''
+    Builds the TopoJSON topology of the precincts.
+    Inputs:
+        precincts (geopandas dataframe): precincts with an id column
+        tolerance (float): simplification tolerance in degrees
+        quantization (int): number of grid points per axis
+    Output:
+        dictionary with the topology
+    '''
+
+    min_x, min_y, max_x, max_y = precincts.total_bounds
+    scale = ((max_x - min_x) / (quantization - 1) or 1,
+             (max_y - min_y) / (quantization - 1) or 1)
+    translate = (min_x, min_y)
+
+    shapes = []
+    for precinct_id, geometry in zip(precincts.id, precincts.geometry):
+        polygons = []
+        for polygon in polygons_of(geometry):
+            rings = [quantize_ring(polygon.exterior.coords, translate, scale)]
+            rings += [quantize_ring(ring.coords, translate, scale)
+                      for ring in polygon.interiors]
+            polygons.append([ring for ring in rings if len(ring) >= 3])
+        shapes.append((int(precinct_id), [p for p in polygons if p]))
+
+    junctions = find_junctions(ring for _, polygons in shapes
+                               for polygon in polygons for ring in polygon)
+
+    arc_index = {}
+    arcs = []
+
+    def arc_reference(arc):
+        key = tuple(arc)
+        if key in arc_index:
+            return arc_index[key]
+        reverse = tuple(reversed(arc))
+        if reverse in arc_index:
+            return ~arc_index[reverse]
+        arc_index[key] = len(arcs)
+        arcs.append(arc)
+        return arc_index[key]
+
+    geometries = []
+    for precinct_id, polygons in shapes:
+        polygon_arcs = [[[arc_reference(arc) for arc in cut_ring(ring, junctions)]
+                         for ring in polygon] for polygon in polygons]
+        if len(polygon_arcs) == 1:
+            geometry = {'type': 'Polygon', 'arcs': polygon_arcs[0]}
+        else:
+            geometry = {'type': 'MultiPolygon', 'arcs': polygon_arcs}
+        geometry['properties'] = {'id': precinct_id}
+        geometries.append(geometry)
+
+    grid_tolerance = tolerance / max(scale)
+    arcs = [delta_encode(simplify_arc(arc, grid_tolerance)) for arc in arcs]
+
+    return {'type': 'Topology',
+            'transform': {'scale': list(scale), 'translate': list(translate)},
+            'objects': {OBJECT_NAME: {'type': 'GeometryCollection',
+                                      'geometries': geometries}},
+            'arcs': arcs}
+
+
+def write_topology(topology, filename):
+    '''
+    Writes a topology to a file as compact json.
+    '''
+
+    with open(filename, 'w') as f:
+        json.dump(topology, f, separators=(',', ':'))
@@ -4,23 +4,47 @@ CAPP 30122 W'20: Final Poject
 This module produces all visualizations
 '''
 
+import html
+import json
+import threading
+import numpy as np
+import pandas as pd
 import folium
-import matplotlib.pyplot as plt
+from folium.plugins import MarkerCluster
+from jinja2 import Template
 import matplotlib
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 import seaborn as sns
+import topology
 
 matplotlib.use('Agg')
 
+ZOOM_CITY = 11
+WEEK_DAYS = ['Sunday', 'Monday', 'Tuesday', 'Wednesday', 'Thursday',
+             'Friday', 'Saturday']
+# seaborn draws the bars with their colors desaturated to 75%
+BAR_COLOR = sns.desaturate('steelblue', 0.75)
+HIGHLIGHT_COLOR = sns.desaturate('red', 0.75)
+# (size in inches, dots per inch) of the barplots
+BAR_PRESETS = {'full': ((10, 10), 100), 'small': ((6, 6), 72)}
+# precinct maps with more crimes than this draw them as a CrimeMarkers layer
+CLUSTER_THRESHOLD = 200
+
+_BAR_TEMPLATES = {}
+_TEMPLATES_LOCK = threading.Lock()
+
 def map(crime_data, precinct_data, name_map, latitude=None, longitude=None):
     '''
     Creates choropleth map html
     Input:
         crime_data (dataframe)
-        precinct_data (dataframe)
-        name map
+        precinct_data (dataframe, or topojson dictionary as built by the
+            topology module)
+        name map (str or binary file object): where to write the html
 	'''
 
-    m = folium.Map(location=[19.432608, -99.133209], zoom_start=11)
+    m = folium.Map(location=[19.432608, -99.133209], zoom_start=ZOOM_CITY)
 
     if latitude and longitude:
         popup = 'Your Address'
@@ -29,8 +53,14 @@ def map(crime_data, precinct_data, name_map, latitude=None, longitude=None):
                       icon=folium.Icon(color='red', icon='home'),
                       tooltip='Click me!').add_to(m)
 
+    if isinstance(precinct_data, dict):
+        topojson = 'objects.' + topology.OBJECT_NAME
+    else:
+        topojson = None
+
     folium.Choropleth(
         geo_data=precinct_data,
+        topojson=topojson,
         name='choropleth',
         data=crime_data,
         columns=['id', 'crimes'],
@@ -46,65 +76,189 @@ def map(crime_data, precinct_data, name_map, latitude=None, longitude=None):
     folium.TileLayer('cartodbdark_matter').add_to(m)
     folium.LayerControl().add_to(m)
 
-    m.save(name_map)
+    save_html(m, name_map)
 
 
-def barplot(crimes, group_var, name_plot, dic):
+def barplot(crimes, group_var, name_plot, dic, preset='full', fmt='png'):
     '''
     Creates a barplot showig number of crimes by day and hour.
     Inputs:
         crimes (data frame): filtered crime data frame
         group_var (str): variable to group by (weekday or hour)
-        name_plot (str): name of the figure
+        name_plot (str or binary file object): where to write the image
         dic (dictionary): input from the user
+        preset (str): size and resolution, a key of BAR_PRESETS
+        fmt (str): 'png' or 'svg'
     '''
 
-    sns.set(style="ticks")
-
     if group_var == 'weekday':
-        d = {'Sunday': 0, 'Monday':1, 'Tuesday':2, 'Wednesday':3, 'Thursday':4,
-             'Friday':5, 'Saturday':6}
-        clrs = ['steelblue']*7
-        day = dic['day']
-        clrs[d[day]] = 'red'
-        order = ['Sunday', 'Monday', 'Tuesday', 'Wednesday', 'Thursday',
-                 'Friday', 'Saturday']
+        labels = WEEK_DAYS
+        highlight = [day == dic['day'] for day in labels]
+        title = 'Crime by day of the week (all hours)'
     else:
-        clrs = ['red' if (x >= dic['hour'][0] and x <= dic['hour'][1]) else
-                'steelblue' for x in crimes.hour]
-        order = None
+        labels = list(range(24))
+        highlight = [dic['hour'][0] <= x <= dic['hour'][1] for x in labels]
+        title = 'Crime by time of the day' + ' ({})'.format(dic['day'])
 
-    sns.set(font_scale=1.4) 
-    fig, ax = plt.subplots(figsize=(10, 10))
+    # days or hours without crimes have no bar
+    heights = crimes.set_index(group_var)['crimes'].reindex(labels,
+                                                             fill_value=0)
 
-    sns.barplot(x=group_var,
-                y='crimes',
-                data=crimes,
-                order=order,
-                palette=clrs)
+    template = get_bar_template(group_var, preset)
+    template.draw(heights.tolist(), highlight, title, name_plot, fmt)
 
-    if group_var == 'weekday':
-        title = 'Crime by day of the week (all hours)'
-    else:
-        title = 'Crime by time of the day' + ' ({})'.format(dic['day'])
-    plt.title(title, fontsize=20)
 
-    plt.savefig(name_plot)
-    plt.close()
+class BarTemplate:
+    '''
+    Figure of a barplot kept between requests. Drawing it only changes the
+    heights and colors of the bars, the y axis and the title, instead of
+    building a new figure with seaborn. It looks like the seaborn barplot
+    of previous versions (darkgrid style, font scale 1.4).
+    '''
+
+    def __init__(self, labels, xlabel, figsize, dpi):
+        '''
+        Inputs:
+            labels (list): labels of the bars
+            xlabel (str): label of the x axis
+            figsize (tuple): size of the figure in inches
+            dpi (int): resolution of the image
+        '''
+
+        self.dpi = dpi
+        self.lock = threading.Lock()
+        self.rc = dict(sns.axes_style('darkgrid'))
+        self.rc.update(sns.plotting_context('notebook', font_scale=1.4))
+
+        with matplotlib.rc_context(self.rc):
+            self.figure = Figure(figsize=figsize)
+            FigureCanvasAgg(self.figure)
+            self.ax = self.figure.add_subplot(111)
+            positions = list(range(len(labels)))
+            self.bars = self.ax.bar(positions, [0] * len(labels), width=0.8,
+                                    color=BAR_COLOR)
+            self.ax.set_xticks(positions)
+            self.ax.set_xticklabels(labels)
+            self.ax.set_xlim(-0.5, len(labels) - 0.5)
+            self.ax.xaxis.grid(False)
+            self.ax.set_xlabel(xlabel)
+            self.ax.set_ylabel('crimes')
+            self.title = self.ax.set_title('', fontsize=20)
+
+    def draw(self, heights, highlight, title, output, fmt='png'):
+        '''
+        Writes the barplot with the given bars.
+        Inputs:
+            heights (list): height of each bar
+            highlight (list of bool): bars drawn in HIGHLIGHT_COLOR
+            title (str): title of the plot
+            output (str or binary file object): where to write the image
+            fmt (str): 'png' or 'svg'
+        '''
 
+        with self.lock, matplotlib.rc_context(self.rc):
+            for bar, height, color in zip(self.bars, heights, highlight):
+                bar.set_height(height)
+                bar.set_facecolor(HIGHLIGHT_COLOR if color else BAR_COLOR)
+            self.ax.set_ylim(0, max(max(heights), 1) * 1.05)
+            self.title.set_text(title)
+            self.figure.savefig(output, format=fmt, dpi=self.dpi)
 
-def map_cuad(crimes, cuadrante, name_plot, latitude, longitude, pol_station):
+
+def get_bar_template(group_var, preset='full'):
+    '''
+    Returns the barplot template of the process for a kind of barplot
+    (weekday or hour) and a preset of BAR_PRESETS, building it on first
+    use.
+    '''
+
+    key = (group_var, preset)
+    if key not in _BAR_TEMPLATES:
+        with _TEMPLATES_LOCK:
+            if key not in _BAR_TEMPLATES:
+                if group_var == 'weekday':
+                    labels = WEEK_DAYS
+                else:
+                    labels = [str(hour) for hour in range(24)]
+                figsize, dpi = BAR_PRESETS[preset]
+                _BAR_TEMPLATES[key] = BarTemplate(labels, group_var, figsize,
+                                                  dpi)
+
+    return _BAR_TEMPLATES[key]
+
+
+class CrimeMarkers(MarkerCluster):
+    '''
+    Markers of the crimes of a precinct map, clustered in the browser with
+    Leaflet.markercluster. The crimes are written once to the html as a
+    json object of columns (latitudes, longitudes and the code of the
+    delito of each crime, with the names of the delitos listed once) and
+    the markers are created by the browser, so neither the html nor the
+    time to build it grow with one python object per crime.
+    '''
+
+    _template = Template(u"""
+        {% macro script(this, kwargs) %}
+            var {{ this.get_name() }} = L.markerClusterGroup(
+                {{ this.cluster_options }});
+            (function() {
+                var crimes = {{ this.points }};
+                var icon = L.AwesomeMarkers.icon({icon: 'info-sign',
+                    markerColor: 'blue', iconColor: 'white',
+                    prefix: 'glyphicon'});
+                var markers = [];
+                for (var i = 0; i < crimes.lat.length; i++) {
+                    markers.push(L.marker([crimes.lat[i], crimes.lon[i]],
+                                          {icon: icon})
+                        .bindPopup(crimes.delitos[crimes.delito[i]])
+                        .bindTooltip('Reported Crime!'));
+                }
+                {{ this.get_name() }}.addLayers(markers);
+            })();
+            {{ this._parent.get_name() }}.addLayer({{ this.get_name() }});
+        {% endmacro %}
+        """)
+
+    def __init__(self, crimes):
+        '''
+        Input:
+            crimes: data frame with columns latitud, longitud and delito
+        '''
+        super().__init__(name='Reported crimes')
+        self._name = 'CrimeMarkers'
+
+        crimes = crimes.dropna(subset=['latitud', 'longitud'])
+        codes, delitos = pd.factorize(crimes['delito'])
+        points = {'lat': np.round(crimes['latitud'].values.astype(float),
+                                  6).tolist(),
+                  'lon': np.round(crimes['longitud'].values.astype(float),
+                                  6).tolist(),
+                  'delito': codes.tolist(),
+                  'delitos': [html.escape(str(delito)) for delito in delitos]}
+
+        # '</' would end the script element
+        self.points = json.dumps(points).replace('</', '<\\/')
+        # chunkedLoading: add the markers without blocking the page
+        self.cluster_options = json.dumps({'chunkedLoading': True,
+                                           'disableClusteringAtZoom': 18})
+
+
+def map_cuad(crimes, cuadrante, name_plot, latitude, longitude, pol_station,
+             cluster_threshold=CLUSTER_THRESHOLD):
     '''
     Creates map of a given precinct with markers of crimes ocurred
-    in that area.
+    in that area. Above cluster_threshold crimes, the markers are drawn as
+    one CrimeMarkers layer instead of one folium.Marker per crime.
     Inputs:
         crimes: filtered data frame
         cuadrante(int): id of the oprecinct to map
-        name_plot(str): name of the map
+        name_plot(str or binary file object): where to write the html
         latitude(int): introduced bu the user
         longitude(int): introduced by the user
         pol_station(tuple): (latitude, longitude, distance) of nearest
-        police station
+        police station, None if there are none
+        cluster_threshold(int): number of crimes above which they are
+        clustered
     '''
 
     m = folium.Map(location=[latitude, longitude],
@@ -112,13 +266,18 @@ def map_cuad(crimes, cuadrante, name_plot, latitude, longitude, pol_station):
                    color='RGBA')
     folium.GeoJson(cuadrante).add_to(m)
 
-    for crime in crimes.iterrows():
-        popup = crime[1].delito
-        folium.Marker(location=[crime[1].latitud, crime[1].longitud],
-                      popup=popup,
-                      icon=folium.Icon(color='blue', icon='info-sign'),
-                      tooltip='Reported Crime!'
-                      ).add_to(m)
+    # crimes without location can't be drawn (folium rejects NaN)
+    crimes = crimes.dropna(subset=['latitud', 'longitud'])
+    if len(crimes) > cluster_threshold:
+        CrimeMarkers(crimes).add_to(m)
+    else:
+        for crime in crimes.iterrows():
+            popup = crime[1].delito
+            folium.Marker(location=[crime[1].latitud, crime[1].longitud],
+                          popup=popup,
+                          icon=folium.Icon(color='blue', icon='info-sign'),
+                          tooltip='Reported Crime!'
+                          ).add_to(m)
 
     folium.Marker(location=[latitude, longitude],
 	              popup='To find nearest police station folllow the green line',
@@ -126,15 +285,16 @@ def map_cuad(crimes, cuadrante, name_plot, latitude, longitude, pol_station):
                   tooltip='Your Address'
                   ).add_to(m)
     
-    folium.Marker(location=[pol_station[0], pol_station[1]],
-                  popup='Nearest Police station:'+
-                        ' {:.2f} kilometers'.format(pol_station[2]),
-                  icon=folium.Icon(color='green', icon='cloud'),
-                  tooltip='Police station'
-                  ).add_to(m)
+    if pol_station is not None:
+        folium.Marker(location=[pol_station[0], pol_station[1]],
+                      popup='Nearest Police station:'+
+                            ' {:.2f} kilometers'.format(pol_station[2]),
+                      icon=folium.Icon(color='green', icon='cloud'),
+                      tooltip='Police station'
+                      ).add_to(m)
 
-    points = [[latitude, longitude],[pol_station[0], pol_station[1]]]
-    folium.PolyLine(points,color="green", weight=2.5, opacity=1).add_to(m)
+        points = [[latitude, longitude],[pol_station[0], pol_station[1]]]
+        folium.PolyLine(points,color="green", weight=2.5, opacity=1).add_to(m)
 
     legend_html = """
         <div style='position: fixed; 
@@ -153,4 +313,16 @@ def map_cuad(crimes, cuadrante, name_plot, latitude, longitude, pol_station):
          
     m.get_root().html.add_child(folium.Element(legend_html))
 
-    m.save(name_plot)
+    save_html(m, name_plot)
+
+
+def save_html(m, output):
+    '''
+    Writes a folium map to a file name or to a binary file object (which
+    is left open, unlike with m.save).
+    '''
+
+    if isinstance(output, str):
+        m.save(output)
+    else:
+        output.write(m.get_root().render().encode('utf8'))